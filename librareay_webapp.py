@@ -1,8 +1,60 @@
 # library_web_app.py
-from flask import Flask, render_template_string, request, redirect, url_for, session, flash
+from flask import (Flask, render_template_string, request, redirect, url_for, session, flash, has_request_context,
+                   jsonify, g, send_file, Response)
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 import os
+import argparse
+import ast
+import bisect
+import contextlib
+import cProfile
 import functools
-from datetime import datetime
+import gc
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import marshal
+import math
+import mmap
+import pstats
+import queue
+import re
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import uuid
+import zipfile
+import zlib
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import MappingProxyType
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, locking falls back to this process only
+    fcntl = None
+
+try:
+    from gunicorn.app.base import BaseApplication as GunicornApplication
+except ImportError:  # `serve` falls back to the built-in pre-fork server
+    GunicornApplication = None
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # recommendation rebuilds and fines fall back to plain Python
+    np = sparse = None
 
 app = Flask(__name__)
 app.secret_key = 'library-management-secret-key-2024'
@@ -11,6 +63,178 @@ app.secret_key = 'library-management-secret-key-2024'
 USERS_FILE = "library_users.txt"
 BOOKS_FILE = "library_books.txt"
 BORROWS_FILE = "library_borrows.txt"
+BORROWS_ARCHIVE_FILE = "library_borrows_archive.txt"
+BRANCHES_DIR = "library_branches"
+VERSIONS_FILE = "library_versions.bin"
+FINE_RATES_FILE = "library_fine_rates.txt"
+
+# ============= SHARED DATASET VERSIONS =============
+
+DATASETS = ("books", "users", "borrows", "branches")
+
+class DatasetVersions:
+    """Per-dataset change counters kept in an mmap'd file shared by all workers.
+
+    Every save bumps the counter of the dataset it wrote, so a worker can tell
+    that another process changed a file by reading a few bytes of shared memory
+    instead of re-reading the file itself.
+    """
+
+    SLOTS = struct.Struct("<" + "Q" * len(DATASETS))
+    SLOT = struct.Struct("<Q")
+
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        self._fd = None
+        self._mm = None
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def _open(self):
+        # flock() locks belong to the open file description, which a forked
+        # worker shares with its parent - so every process opens its own.
+        if self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size < self.SLOTS.size:
+                os.ftruncate(fd, self.SLOTS.size)
+            self._mm = mmap.mmap(fd, self.SLOTS.size)
+            self._fd = fd
+            self._pid = os.getpid()
+            self._depth = 0
+        return self._mm
+
+    def get(self, name):
+        """Current version of one dataset"""
+        return self.SLOT.unpack_from(self._open(), DATASETS.index(name) * self.SLOT.size)[0]
+
+    def read_all(self):
+        """Current versions of all datasets as a {name: version} dict"""
+        return dict(zip(DATASETS, self.SLOTS.unpack_from(self._open())))
+
+    @property
+    def write_lock(self):
+        """Re-entrant lock serialising writers across threads and processes"""
+        return self
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self._open()
+            if self._depth == 0 and fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+        return False
+
+    def bump(self, name):
+        """Increment a dataset's version; returns the new value"""
+        with self.write_lock:
+            offset = DATASETS.index(name) * self.SLOT.size
+            version = self.SLOT.unpack_from(self._mm, offset)[0] + 1
+            self.SLOT.pack_into(self._mm, offset, version)
+            return version
+
+dataset_versions = DatasetVersions(VERSIONS_FILE)
+
+# Read once while the process is still single-threaded: os.umask can only be
+# read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+class StagedFiles:
+    """File changes written ahead, then applied together.
+
+    write() puts a file's new contents in a temp file next to it, so a full
+    disk or any other error shows up before a single data file is touched.
+    apply() makes the appends (truncated back if one fails), renames every
+    temp file into place, makes the removals and runs the after() callbacks;
+    discard() deletes temp files that were not applied.
+    """
+
+    def __init__(self):
+        self.renames = []       # (temp path, target)
+        self.appends = []       # (path, lines)
+        self.removals = []
+        self.callbacks = []
+
+    def write(self, filename, lines):
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+        self.renames.append((tmp_path, filename))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        # mkstemp creates the file 0600; keep the mode the data file has
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+
+    def append(self, filename, lines):
+        self.appends.append((filename, list(lines)))
+
+    def remove(self, filename):
+        self.removals.append(filename)
+
+    def after(self, callback):
+        self.callbacks.append(callback)
+
+    def apply(self):
+        appended = []
+        try:
+            for filename, lines in self.appends:
+                appended.append((filename, os.path.getsize(filename) if os.path.exists(filename) else 0))
+                with open(filename, "a", encoding="utf-8") as f:
+                    f.writelines(lines)
+        except Exception:
+            for filename, size in appended:
+                with contextlib.suppress(OSError), open(filename, "r+b") as f:
+                    f.truncate(size)
+            raise
+        # Renames within a directory don't fail for lack of space, so once
+        # the appends are in every file gets replaced
+        while self.renames:
+            tmp_path, filename = self.renames.pop(0)
+            os.replace(tmp_path, filename)
+        for filename in self.removals:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+        for callback in self.callbacks:
+            callback()
+
+    def discard(self):
+        for tmp_path, filename in self.renames:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+        self.renames = []
+
+@contextlib.contextmanager
+def staged_files():
+    """StagedFiles applied when the block completes, discarded if it raises"""
+    staged = StagedFiles()
+    try:
+        yield staged
+        staged.apply()
+    finally:
+        staged.discard()
+
+def atomic_write_lines(filename, lines):
+    """Write lines to a temp file and rename it over filename, so readers in
+    other workers never see a half-written file"""
+    with staged_files() as staged:
+        staged.write(filename, lines)
 
 # ============= BORROW TRACKING FUNCTIONS =============
 
@@ -32,62 +256,69 @@ def load_borrows():
                             
                             if username not in borrows:
                                 borrows[username] = []
-                            borrows[username].append({
+                            borrow = {
                                 'book_id': book_id,
                                 'borrow_date': borrow_date,
                                 'return_date': return_date if return_date != 'None' else None
-                            })
+                            }
+                            if len(parts) > 4 and parts[4]:
+                                borrow['branch'] = parts[4]  # lending branch
+                            borrows[username].append(borrow)
     except Exception as e:
         print(f"❌ Error loading borrows: {e}")
     return borrows
 
+def loan_line(username, borrow):
+    """One borrows-file line; the lending branch is a fifth field, present only when known"""
+    return_date = borrow['return_date'] if borrow['return_date'] else 'None'
+    branch = f"|{borrow['branch']}" if borrow.get('branch') else ""
+    return f"{username}|{borrow['book_id']}|{borrow['borrow_date']}|{return_date}{branch}\n"
+
+def write_borrows_file(borrows_dict, staged):
+    """Stage the borrows file (raises on failure)"""
+    staged.write(BORROWS_FILE, (
+        loan_line(username, borrow)
+        for username, user_borrows in borrows_dict.items()
+        for borrow in user_borrows
+    ))
+
 def save_borrows(borrows_dict):
     """Save borrow records to file"""
-    try:
-        with open(BORROWS_FILE, "w", encoding="utf-8") as f:
-            for username, user_borrows in borrows_dict.items():
-                for borrow in user_borrows:
-                    return_date = borrow['return_date'] if borrow['return_date'] else 'None'
-                    f.write(f"{username}|{borrow['book_id']}|{borrow['borrow_date']}|{return_date}\n")
-        return True
-    except Exception as e:
-        print(f"❌ Error saving borrows: {e}")
-        return False
+    with library_transaction() as txn:
+        txn.replace_dataset("borrows", borrows_dict)
+        return txn.commit()
 
-def borrow_book_for_user(username, book_id):
-    """Borrow a book for specific user"""
-    borrows = load_borrows()
-    if username not in borrows:
-        borrows[username] = []
-    
-    # Check if user already has this book borrowed and not returned
-    for borrow in borrows[username]:
-        if borrow['book_id'] == book_id and not borrow['return_date']:
-            return False  # Already borrowed and not returned
-    
-    # Add new borrow record
-    borrows[username].append({
-        'book_id': book_id,
-        'borrow_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'return_date': None
-    })
-    
-    return save_borrows(borrows)
+def borrow_book_for_user(username, book_id, branch=None):
+    """Borrow a book for specific user, optionally recording the lending branch"""
+    with library_transaction() as txn:
+        # Check if user already has this book borrowed and not returned
+        for borrow in txn.borrows.get(username, ()):
+            if borrow['book_id'] == book_id and not borrow['return_date']:
+                return False  # Already borrowed and not returned
+        
+        # Add new borrow record
+        borrow = {
+            'book_id': book_id,
+            'borrow_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'return_date': None
+        }
+        if branch:
+            borrow['branch'] = branch
+        txn.add_loan(username, borrow)
+        return txn.commit()
 
 def return_book_for_user(username, book_id):
     """Return a book for specific user"""
-    borrows = load_borrows()
-    
-    if username in borrows:
-        for borrow in borrows[username]:
+    with library_transaction() as txn:
+        for index, borrow in enumerate(txn.borrows.get(username, ())):
             if borrow['book_id'] == book_id and not borrow['return_date']:
-                borrow['return_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                return save_borrows(borrows)
+                txn.update_loan(username, index, return_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                return txn.commit()
     return False
 
 def get_user_borrowed_books(username):
     """Get list of books currently borrowed by user"""
-    borrows = load_borrows()
+    borrows = get_borrows()
     user_borrows = []
     
     if username in borrows:
@@ -97,50 +328,380 @@ def get_user_borrowed_books(username):
     
     return user_borrows
 
+def open_loan(username, book_id):
+    """The user's open loan record for a book, or None"""
+    for borrow in get_borrows().get(username, ()):
+        if borrow['book_id'] == book_id and not borrow['return_date']:
+            return borrow
+    return None
+
 def is_book_borrowed_by_user(username, book_id):
     """Check if specific book is borrowed by user"""
     user_borrows = get_user_borrowed_books(username)
     return book_id in user_borrows
 
-# ============= CORE FUNCTIONS =============
+# ============= BATCH CHECKOUT / RETURN =============
+
+def parse_book_ids(values):
+    """Split checkbox values or a pasted/scanned list into unique book IDs, in order"""
+    book_ids = {}
+    for value in values:
+        for book_id in value.replace(",", " ").split():
+            book_ids[book_id] = True
+    return list(book_ids)
+
+def parse_json_batch(data, fields=()):
+    """Book IDs from a JSON batch body, or None if the body is malformed.
+
+    The body must be an object; its book_ids, if given, a list of IDs and
+    each of the named fields, if given, a string or a number.
+    """
+    def scalar(value):
+        return isinstance(value, (str, int)) and not isinstance(value, bool)
+    if not isinstance(data, dict):
+        return None
+    values = data.get('book_ids', [])
+    if not isinstance(values, list) or not all(scalar(value) for value in values):
+        return None
+    if not all(scalar(data[name]) for name in fields if data.get(name) is not None):
+        return None
+    return parse_book_ids(str(value) for value in values)
+
+def run_batch(book_ids, stage_item):
+    """Run stage_item(txn, book_id) for every book in one transaction.
+
+    stage_item returns an error message, or None once it has staged its
+    change. The batch is committed - one write per changed file - only if
+    every item succeeded; otherwise nothing is written.
+    Returns (applied, results) with one result dict per book_id.
+    """
+    results = []
+    with library_transaction() as txn:
+        for book_id in book_ids:
+            book = txn.books.get(book_id)
+            error = stage_item(txn, book_id)
+            results.append({
+                'book_id': book_id,
+                'title': book['Title'] if book else None,
+                'ok': error is None,
+                'message': error or 'OK',
+            })
+        applied = bool(results) and all(result['ok'] for result in results)
+        if applied and not txn.commit():
+            applied = False
+            for result in results:
+                result['ok'] = False
+                result['message'] = 'Error saving data'
+    if not applied:
+        for result in results:
+            if result['ok']:
+                result['ok'] = False
+                result['message'] = 'Not applied: other items failed'
+    return applied, results
+
+def borrow_books_for_user(username, book_ids, branch=None):
+    """Borrow several books for a user, all or nothing"""
+    def stage_item(txn, book_id):
+        book = txn.books.get(book_id)
+        if book is None:
+            return 'Book not found'
+        if book["Available"] <= 0:
+            return 'All copies are borrowed'
+        if is_book_borrowed_by_user(username, book_id):
+            return 'Already borrowed'
+        lent_from, error = lending_branch(txn, book_id, branch)
+        if error:
+            return error
+        borrow_book_for_user(username, book_id, lent_from)
+        txn.update_book(book_id, Available=book["Available"] - 1, Borrowed=book["Borrowed"] + 1)
+        return None
+    return run_batch(book_ids, stage_item)
+
+def return_books_for_user(username, book_ids, branch=None):
+    """Return several books for a user, all or nothing"""
+    def stage_item(txn, book_id):
+        book = txn.books.get(book_id)
+        if book is None:
+            return 'Book not found'
+        loan = open_loan(username, book_id)
+        if loan is None:
+            return 'Not borrowed'
+        if branch and branch not in txn.branches:
+            return f'Unknown branch "{branch}"'
+        return_book_for_user(username, book_id)
+        stage_branch_return(txn, book_id, loan.get('branch'), branch)
+        txn.update_book(book_id, Available=book["Available"] + 1, Borrowed=book["Borrowed"] - 1)
+        return None
+    return run_batch(book_ids, stage_item)
+
+BULK_BOOK_ACTIONS = {
+    'set_copies': 'Set total copies',
+    'add_copies': 'Add copies',
+    'edit': 'Change details',
+    'delete': 'Delete',
+}
+
+def parse_bulk_edit(source):
+    """(action, copies, fields, error) from the bulk edit form or JSON body.
+
+    fields holds only the Title/Author/Year values that were filled in;
+    error is a message for the admin, or None.
+    """
+    action = str(source.get('action') or '')
+    copies, fields = None, {}
+    if action not in BULK_BOOK_ACTIONS:
+        return action, copies, fields, 'Choose an action!'
+    if action in ('set_copies', 'add_copies'):
+        try:
+            copies = int(source.get('copies'))
+        except (TypeError, ValueError):
+            return action, copies, fields, 'Invalid number for copies!'
+        if action == 'add_copies' and copies <= 0:
+            return action, copies, fields, 'Number of copies must be positive!'
+    elif action == 'edit':
+        for name, key in (('Title', 'title'), ('Author', 'author'), ('Year', 'year')):
+            value = str(source.get(key) or '').strip()
+            if value:
+                fields[name] = value
+        if not fields:
+            return action, copies, fields, 'Enter at least one of title, author or year!'
+    return action, copies, fields, None
+
+def edit_books(book_ids, action, copies=None, fields=None):
+    """Apply one catalogue change to several books, all or nothing.
+
+    Each book is checked like on the single-book admin pages (total copies
+    never below the borrowed ones, no deleting a borrowed book), and the
+    whole batch is one transaction, so library_books.txt is written once.
+    """
+    def stage_item(txn, book_id):
+        book = txn.books.get(book_id)
+        if book is None:
+            return 'Book not found'
+        if action == 'delete':
+            if book['Borrowed'] > 0:
+                return f'{book["Borrowed"]} copies are currently borrowed'
+            txn.delete_book(book_id)
+        elif action == 'set_copies':
+            if copies < book['Borrowed']:
+                return 'Total copies cannot be less than borrowed copies'
+            txn.update_book(book_id, TotalCopies=copies, Available=copies - book['Borrowed'])
+        elif action == 'add_copies':
+            txn.update_book(book_id, TotalCopies=book['TotalCopies'] + copies, Available=book['Available'] + copies)
+        else:
+            txn.update_book(book_id, **fields)
+        return None
+    return run_batch(book_ids, stage_item)
+
+# ============= USER STORE =============
+
+# library_users.txt is an append-only log of "username|password|role"
+# records in which a later record for a username replaces the earlier ones.
+# A registration, password or role change appends one line instead of
+# rewriting every account, and a worker reloading the file reads only the
+# bytes appended since its last load. Once the log holds more than
+# USERS_COMPACT_RATIO records per account it is compacted: rewritten as one
+# line per account into a new file, which every worker then reads in full.
+#
+# Passwords are stored as salted PBKDF2-SHA256 hashes. The iteration count
+# (LIBRARY_PASSWORD_ITERATIONS) sets the CPU cost of every login; see
+# `python librareay_webapp.py users --calibrate MS`. Plain-text passwords
+# from older files still work and are re-hashed at the next login, as are
+# hashes made with a different iteration count.
+
+PASSWORD_HASH_SCHEME = "pbkdf2_sha256"
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("LIBRARY_PASSWORD_ITERATIONS", 100_000))
+USERS_COMPACT_RATIO = 2
+USERS_COMPACT_MIN_RECORDS = 1000
+USERNAME_PATTERN = re.compile(r"[^|\s]{1,64}")
+
+def hash_password(password, iterations=None, salt=None):
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{PASSWORD_HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def check_password(stored, password):
+    """True when password matches the stored hash (or legacy plain-text password)"""
+    parts = stored.split("$")
+    if len(parts) != 4 or parts[0] != PASSWORD_HASH_SCHEME:
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+    try:
+        iterations, salt, digest = int(parts[1]), bytes.fromhex(parts[2]), bytes.fromhex(parts[3])
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations))
+
+def password_needs_rehash(stored):
+    parts = stored.split("$")
+    return len(parts) != 4 or parts[0] != PASSWORD_HASH_SCHEME or parts[1] != str(PASSWORD_HASH_ITERATIONS)
+
+def calibrate_password_iterations(target_ms, sample=20_000):
+    """Iterations for which one hash takes about target_ms on this machine"""
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        hashlib.pbkdf2_hmac("sha256", b"calibrate", b"0" * 16, sample)
+        timings.append(time.perf_counter() - started)
+    per_iteration = min(timings) / sample
+    return max(1000, int(target_ms / 1000 / per_iteration) // 1000 * 1000)
+
+class UserLog:
+    """What this process last read from (or wrote to) the users log"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file_id = None    # (st_dev, st_ino): compaction replaces the file
+        self.offset = 0        # bytes consumed; a half-appended last line is left for later
+        self.size = 0          # file size at the last read
+        self.unterminated = False  # last line read has no newline: the next write compacts
+        self.records = 0       # lines in the log, live or superseded
+        self.users = {}        # username -> frozen record
+
+_user_log = UserLog()
+
+def user_line(username, user_info):
+    return f"{username}|{user_info['password']}|{user_info['role']}\n"
 
 def load_users():
-    """Load users from file"""
+    """Load users from file, reading only what was appended since the last load"""
+    log = _user_log
     users = {}
     try:
         if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, "r", encoding="utf-8") as f:
-                for line in f:
+            with log.lock, open(USERS_FILE, "rb") as f:
+                stat = os.fstat(f.fileno())
+                file_id = (stat.st_dev, stat.st_ino)
+                if file_id == log.file_id and stat.st_size >= log.offset:
+                    f.seek(log.offset)
+                    users, records, offset = dict(log.users), log.records, log.offset
+                    # A last line past what was read before may still be being
+                    # appended; it counts as complete once the size stops changing
+                    settled = stat.st_size == log.size
+                else:
+                    records, offset = 0, 0
+                    settled = True
+                data = f.read()
+                complete = len(data) if settled else data.rfind(b"\n") + 1
+                for line in data[:complete].decode("utf-8").splitlines():
                     line = line.strip()
                     if line:
                         username, password, role = line.split("|")
-                        users[username] = {"password": password, "role": role}
+                        users[username] = freeze_record({"password": password, "role": role})
+                        records += 1
+                log.file_id, log.offset, log.records, log.users = file_id, offset + complete, records, dict(users)
+                log.size = stat.st_size
+                if complete:
+                    log.unterminated = data[complete - 1] != ord("\n")
+                elif not offset:
+                    log.unterminated = False
         if not users:
-            users["admin"] = {"password": "admin123", "role": "admin"}
-            save_users(users)
+            if os.path.exists(USERS_FILE) and os.path.getsize(USERS_FILE):
+                print(f"❌ No accounts could be read from {USERS_FILE}, leaving it untouched")
+                return users
+            users["admin"] = freeze_record({"password": hash_password("admin123"), "role": "admin"})
+            # Written directly: this runs while a snapshot is being loaded
+            with dataset_versions.write_lock:
+                with staged_files() as staged:
+                    write_users_file(users, staged)
+                dataset_versions.bump("users")
             print("✅ Default admin user created (username: admin, password: admin123)")
     except Exception as e:
         print(f"❌ Error loading users: {e}")
     return users
 
+def remember_users_file(users_dict, records):
+    """Record the users log just written as read up to its end"""
+    with _user_log.lock:
+        stat = os.stat(USERS_FILE)
+        _user_log.file_id, _user_log.offset = (stat.st_dev, stat.st_ino), stat.st_size
+        _user_log.size, _user_log.unterminated = stat.st_size, False
+        _user_log.records, _user_log.users = records, dict(users_dict)
+
+def write_users_file(users_dict, staged):
+    """Stage the users log rewritten as one record per account (raises on failure)"""
+    staged.write(USERS_FILE, [user_line(username, user_info) for username, user_info in users_dict.items()])
+    staged.after(lambda: remember_users_file(users_dict, len(users_dict)))
+
+def append_users(users_dict, staged):
+    """Stage an append of the accounts that changed since the log was last
+    read, or a compaction once superseded records pile up (raises on failure)"""
+    log = _user_log
+    with log.lock:
+        if log.file_id is None or log.unterminated or log.users.keys() - users_dict.keys():
+            compact = True  # no log read yet, no newline to append after, or accounts were removed
+        else:
+            changed = [user_line(username, user_info) for username, user_info in users_dict.items()
+                       if log.users.get(username) is not user_info]
+            file_id, records = log.file_id, log.records + len(changed)
+            compact = records > max(USERS_COMPACT_MIN_RECORDS, USERS_COMPACT_RATIO * len(users_dict))
+    if compact:
+        write_users_file(users_dict, staged)
+        return
+    
+    def remember():
+        stat = os.stat(USERS_FILE)
+        if (stat.st_dev, stat.st_ino) != file_id:
+            print(f"❌ {USERS_FILE} was replaced while appending, it will be re-read")
+            with log.lock:
+                log.file_id = None
+            return
+        remember_users_file(users_dict, records)
+    staged.append(USERS_FILE, changed)
+    staged.after(remember)
+
+def users_main(argv):
+    """python librareay_webapp.py users [--compact] [--calibrate MS]"""
+    parser = argparse.ArgumentParser(prog="librareay_webapp.py users",
+                                     description="Maintain the user store.")
+    parser.add_argument("--compact", action="store_true",
+                        help="rewrite library_users.txt as one record per account")
+    parser.add_argument("--calibrate", type=float, metavar="MS",
+                        help="print the LIBRARY_PASSWORD_ITERATIONS for about MS milliseconds per login")
+    args = parser.parse_args(argv)
+    if args.calibrate:
+        iterations = calibrate_password_iterations(args.calibrate)
+        stored = hash_password("calibrate", iterations)
+        started = time.perf_counter()
+        check_password(stored, "calibrate")
+        print(f"LIBRARY_PASSWORD_ITERATIONS={iterations}  "
+              f"(login check takes {(time.perf_counter() - started) * 1000:.0f} ms here)")
+    if args.compact:
+        with dataset_versions.write_lock:
+            users = load_users()
+            records = _user_log.records
+            with staged_files() as staged:
+                write_users_file(users, staged)
+            dataset_versions.bump("users")
+        print(f"✅ Compacted {records} records into {len(users)} accounts")
+    if not (args.calibrate or args.compact):
+        parser.print_help()
+    return 0
+
+# ============= CORE FUNCTIONS =============
+
 def save_users(users_dict):
     """Save users to file"""
-    try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            for username, user_info in users_dict.items():
-                f.write(f"{username}|{user_info['password']}|{user_info['role']}\n")
-        return True
-    except Exception as e:
-        print(f"❌ Error saving users: {e}")
-        return False
+    with library_transaction() as txn:
+        txn.replace_dataset("users", users_dict)
+        return txn.commit()
+
+def book_line(book_id, book_info):
+    return f"{book_id},{book_info['Title']},{book_info['Author']},{book_info['Year']},{book_info['TotalCopies']},{book_info['Available']},{book_info['Borrowed']}\n"
+
+def write_books_file(books_dict, filename, staged):
+    """Stage library data for a text file (raises on failure)"""
+    staged.write(filename, (book_line(book_id, book_info) for book_id, book_info in books_dict.items()))
 
 def save_to_file(books_dict, filename):
     """Save library data to text file"""
+    if filename == BOOKS_FILE:
+        with library_transaction() as txn:
+            txn.replace_dataset("books", books_dict)
+            return txn.commit()
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            for book_id, book_info in books_dict.items():
-                line = f"{book_id},{book_info['Title']},{book_info['Author']},{book_info['Year']},{book_info['TotalCopies']},{book_info['Available']},{book_info['Borrowed']}\n"
-                f.write(line)
+        with staged_files() as staged:
+            write_books_file(books_dict, filename, staged)
         return True
     except Exception as e:
         print(f"❌ Error saving data: {e}")
@@ -173,195 +734,3992 @@ def load_from_file(filename):
         print(f"❌ Error loading data: {e}")
     return books
 
-# ============= WEB DECORATORS =============
+# ============= BRANCH INVENTORY =============
 
-def login_required(f):
-    @functools.wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'username' not in session:
-            flash('Please login first!', 'error')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+# Each branch keeps the copies it owns in its own file,
+# library_branches/<branch>.txt, one "book_id,copies" line per book it holds.
+# How many of them are out is not stored there: every loan records the
+# branch that lent it, so a branch's Borrowed count is its open loans and
+# its Available count the rest. A checkout, or a return where the copy was
+# lent, writes the borrows and books files as it always did and no shard;
+# shards change only when copies are added, removed or transferred, or
+# handed in at another branch (which then owns them). A commit rewrites only
+# the shards that changed and a reload re-reads only those.
+#
+# This splits the inventory, not the write path: every commit still takes
+# the one global write lock, and library_books.txt keeps the network-wide
+# totals. Without any branch file the library works as a single site.
 
-def admin_required(f):
-    @functools.wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'username' not in session:
-            flash('Please login first!', 'error')
-            return redirect(url_for('login'))
-        if session.get('role') != 'admin':
-            flash('Access denied! Admin role required.', 'error')
-            return redirect(url_for('dashboard'))
-        return f(*args, **kwargs)
-    return decorated_function
+BRANCH_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")
 
-# ============= HTML TEMPLATES =============
+# branch -> (file signature, frozen inventory) as last read or written by this process
+_branch_shards = {}
 
-BASE_HTML = '''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Library Management System</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <style>
-        .navbar-brand { font-weight: bold; }
-        .book-card { transition: transform 0.2s; }
-        .book-card:hover { transform: translateY(-2px); }
-        .stats-card { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; }
-        .available { color: #28a745; }
-        .borrowed { color: #dc3545; }
-        .my-borrowed { background-color: #fff3cd; border-left: 4px solid #ffc107; }
-        .btn-group-sm > .btn { padding: 0.25rem 0.5rem; font-size: 0.875rem; }
-    </style>
-</head>
-<body>
-    <nav class="navbar navbar-expand-lg navbar-dark bg-dark">
-        <div class="container">
-            <a class="navbar-brand" href="/dashboard">
-                <i class="fas fa-book"></i> Library System
-            </a>
-            
-            {% if session.username %}
-            <div class="navbar-nav ms-auto">
-                <span class="navbar-text me-3">
-                    <i class="fas fa-user"></i> {{ session.username }} ({{ session.role }})
-                </span>
-                <a class="nav-link" href="/my-books">
-                    <i class="fas fa-bookmark"></i> My Books
-                </a>
-                <a class="nav-link" href="/change-password">
-                    <i class="fas fa-key"></i> Change Password
-                </a>
-                <a class="nav-link" href="/logout">
-                    <i class="fas fa-sign-out-alt"></i> Logout
-                </a>
-            </div>
-            {% endif %}
-        </div>
-    </nav>
+def branch_shard_path(branch):
+    return os.path.join(BRANCHES_DIR, f"{branch}.txt")
 
-    <div class="container mt-4">
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="alert alert-{{ 'danger' if category == 'error' else 'success' }} alert-dismissible fade show">
-                        {{ message }}
-                        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
+def file_signature(stat):
+    # Shards are replaced by rename, so a new inode means new contents
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
-        {% block content %}{% endblock %}
-    </div>
+def branch_shard_lines(inventory):
+    return (f"{book_id},{copies}\n" for book_id, copies in inventory.items())
 
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>'''
+def read_branch_shard(branch):
+    """(file signature, frozen inventory) of one shard"""
+    inventory = {}
+    with open(branch_shard_path(branch), "r", encoding="utf-8") as f:
+        signature = file_signature(os.fstat(f.fileno()))
+        for line in f:
+            parts = line.strip().split(",")
+            # Shards written before loans carried their branch have
+            # "book_id,TotalCopies,Available,Borrowed"; only the total is kept
+            if len(parts) in (2, 4):
+                inventory[parts[0]] = int(parts[1])
+    return signature, freeze_inventory(inventory)
 
-LOGIN_HTML = '''<div class="row justify-content-center">
-    <div class="col-md-6">
-        <div class="card">
-            <div class="card-header">
-                <h4 class="mb-0"><i class="fas fa-sign-in-alt"></i> User Login</h4>
-            </div>
-            <div class="card-body">
-                <form method="POST">
-                    <div class="mb-3">
-                        <label for="username" class="form-label">Username</label>
-                        <input type="text" class="form-control" id="username" name="username" required>
-                    </div>
-                    <div class="mb-3">
-                        <label for="password" class="form-label">Password</label>
-                        <input type="password" class="form-control" id="password" name="password" required>
-                    </div>
-                    <button type="submit" class="btn btn-primary w-100">Login</button>
-                </form>
-                <hr>
-                <div class="text-center">
-                    <p>Don't have an account? <a href="/register">Register here</a></p>
-                    <p class="text-muted small">
-                        <i class="fas fa-info-circle"></i> 
-                        Default admin: username: admin, password: admin123
-                    </p>
-                </div>
-            </div>
-        </div>
-    </div>
-</div>'''
+def load_branches():
+    """Load branch shards, re-reading only those whose file changed since last time"""
+    branches = {}
+    try:
+        if os.path.isdir(BRANCHES_DIR):
+            for filename in sorted(os.listdir(BRANCHES_DIR)):
+                branch, ext = os.path.splitext(filename)
+                if ext != ".txt" or not BRANCH_ID_PATTERN.fullmatch(branch):
+                    continue
+                cached = _branch_shards.get(branch)
+                if cached is None or cached[0] != file_signature(os.stat(branch_shard_path(branch))):
+                    cached = _branch_shards[branch] = read_branch_shard(branch)
+                branches[branch] = cached[1]
+        for branch in _branch_shards.keys() - branches.keys():
+            del _branch_shards[branch]
+    except Exception as e:
+        print(f"❌ Error loading branches: {e}")
+    return branches
 
-REGISTER_HTML = '''<div class="row justify-content-center">
-    <div class="col-md-6">
-        <div class="card">
-            <div class="card-header">
-                <h4 class="mb-0"><i class="fas fa-user-plus"></i> User Registration</h4>
-            </div>
-            <div class="card-body">
-                <form method="POST">
-                    <div class="mb-3">
-                        <label for="username" class="form-label">Username</label>
-                        <input type="text" class="form-control" id="username" name="username" required>
-                    </div>
-                    <div class="mb-3">
-                        <label for="password" class="form-label">Password</label>
-                        <input type="password" class="form-control" id="password" name="password" required>
-                        <div class="form-text">Password must be at least 4 characters long.</div>
-                    </div>
-                    <div class="mb-3">
-                        <label for="confirm_password" class="form-label">Confirm Password</label>
-                        <input type="password" class="form-control" id="confirm_password" name="confirm_password" required>
-                    </div>
-                    <button type="submit" class="btn btn-success w-100">Register</button>
-                </form>
-                <hr>
-                <div class="text-center">
-                    <p>Already have an account? <a href="/login">Login here</a></p>
-                </div>
-            </div>
-        </div>
-    </div>
-</div>'''
+def write_branch_shards(branches, staged):
+    """Stage the shards whose inventory changed and the removal of those of removed branches (raises on failure)"""
+    os.makedirs(BRANCHES_DIR, exist_ok=True)
+    written = {}
+    for branch, inventory in branches.items():
+        cached = _branch_shards.get(branch)
+        if cached is not None and cached[1] is inventory:
+            continue  # untouched: still the object loaded from (or written to) the shard
+        staged.write(branch_shard_path(branch), branch_shard_lines(inventory))
+        written[branch] = inventory
+    removed = _branch_shards.keys() - branches.keys()
+    for branch in removed:
+        staged.remove(branch_shard_path(branch))
+    
+    def remember():
+        for branch, inventory in written.items():
+            _branch_shards[branch] = (file_signature(os.stat(branch_shard_path(branch))), inventory)
+        for branch in removed:
+            _branch_shards.pop(branch, None)
+    staged.after(remember)
 
-DASHBOARD_HTML = '''<div class="row mb-4">
-    <div class="col-12">
-        <h2><i class="fas fa-tachometer-alt"></i> Dashboard</h2>
-        <p class="text-muted">Welcome back, {{ username }}!</p>
-    </div>
-</div>
+def open_loans_by_branch(txn, book_id):
+    """Counter of the book's open loans by lending branch, as the transaction has them.
 
-<div class="row mb-4">
-    <div class="col-md-3">
-        <div class="card stats-card">
-            <div class="card-body text-center">
-                <h5 class="card-title"><i class="fas fa-book"></i> Total Books</h5>
+    Starts from branch_index when it is current with the transaction's base
+    and corrects for the users whose loans the transaction changed; scans
+    every loan only while startup indexing lags or after a wholesale replace.
+    """
+    with _publish_lock:
+        current = _index_backlog is None and _snapshot.borrows is txn.base.borrows
+        lent = branch_index.open_loans(book_id) if current else None
+    usernames = txn.touched.get("borrows", ())
+    if lent is None or usernames is None:
+        return Counter(borrow['branch'] for user_borrows in txn.borrows.values() for borrow in user_borrows
+                       if borrow['book_id'] == book_id and borrow.get('branch') and not borrow['return_date'])
+    for borrows, sign in ((txn.base.borrows, -1), (txn.borrows, 1)):
+        for username in usernames:
+            for borrow in borrows.get(username, ()):
+                if borrow['book_id'] == book_id and borrow.get('branch') and not borrow['return_date']:
+                    lent[borrow['branch']] += sign
+    return lent
+
+def shelf_copies(txn, book_id):
+    """{branch: copies of the book it owns that are not out on loan}"""
+    lent = open_loans_by_branch(txn, book_id)
+    return {branch: inventory.get(book_id, 0) - lent[branch] for branch, inventory in txn.branches.items()}
+
+def lending_branch(txn, book_id, branch=None):
+    """(branch, error) to lend a copy from: the requested branch, else the one
+    with the most copies on the shelf. (None, None) when there are no branches."""
+    if not txn.branches:
+        return None, f'Unknown branch "{branch}"' if branch else None
+    if branch and branch not in txn.branches:
+        return None, f'Unknown branch "{branch}"'
+    shelf = shelf_copies(txn, book_id)
+    if branch:
+        if shelf[branch] <= 0:
+            return None, f'No copies available at {branch}'
+        return branch, None
+    available, branch = max((copies, branch) for branch, copies in shelf.items())
+    return (branch, None) if available > 0 else (None, 'All copies are borrowed')
+
+def stage_branch_return(txn, book_id, lent_from, branch=None):
+    """A copy handed in at another branch than the one that lent it now
+    belongs there; returned where it was lent, no shard changes"""
+    if branch and branch != lent_from and branch in txn.branches and lent_from in txn.branches:
+        txn.adjust_holding(lent_from, book_id, -1)
+        txn.adjust_holding(branch, book_id, 1)
+
+# ============= LIBRARY SNAPSHOTS =============
+
+# Readers take the current snapshot without locking; everything in it is
+# read-only. Writers stage changes in a LibraryTransaction, which copies only
+# the top-level dicts it touches (unchanged records are shared with the old
+# snapshot), writes the files and then swaps in the next snapshot in a single
+# assignment - so a page never sees a borrow applied to books but not borrows.
+
+LibrarySnapshot = namedtuple("LibrarySnapshot", "versions books users borrows branches")
+
+def freeze_record(record):
+    """Read-only copy of one book/user/loan record (already frozen ones are shared)"""
+    if isinstance(record, MappingProxyType):
+        return record
+    return MappingProxyType(dict(record))
+
+def freeze_books(books):
+    return MappingProxyType({book_id: freeze_record(book) for book_id, book in books.items()})
+
+def freeze_users(users):
+    return MappingProxyType({username: freeze_record(user) for username, user in users.items()})
+
+def freeze_borrows(borrows):
+    return MappingProxyType({
+        username: tuple(freeze_record(borrow) for borrow in user_borrows)
+        for username, user_borrows in borrows.items()
+    })
+
+def freeze_inventory(inventory):
+    if isinstance(inventory, MappingProxyType):
+        return inventory
+    return MappingProxyType(dict(inventory))
+
+def freeze_branches(branches):
+    # Untouched inventories keep their identity, which is how the writer spots them
+    return MappingProxyType({branch: freeze_inventory(inventory) for branch, inventory in branches.items()})
+
+DATASET_LOADERS = {
+    "books": lambda: load_from_file(BOOKS_FILE),
+    "users": lambda: load_users(),
+    "borrows": lambda: load_borrows(),
+    "branches": lambda: load_branches(),
+}
+
+DATASET_FREEZERS = {
+    "books": freeze_books,
+    "users": freeze_users,
+    "borrows": freeze_borrows,
+    "branches": freeze_branches,
+}
+
+# Each writer stages its files in a StagedFiles; commit() applies them all at once
+DATASET_WRITERS = {
+    "books": lambda books, staged: write_books_file(books, BOOKS_FILE, staged),
+    "users": append_users,
+    "borrows": write_borrows_file,
+    "branches": write_branch_shards,
+}
+
+DATASET_ERRORS = {
+    "books": "Error saving data",
+    "users": "Error saving users",
+    "borrows": "Error saving borrows",
+    "branches": "Error saving branch inventory",
+}
+
+# Borrows are staged before books, matching the order the routes always used
+COMMIT_ORDER = ("borrows", "books", "branches", "users")
+
+_EMPTY = MappingProxyType({})
+_snapshot = LibrarySnapshot(
+    versions=MappingProxyType(dict.fromkeys(DATASETS)),
+    books=_EMPTY, users=_EMPTY, borrows=_EMPTY, branches=_EMPTY
+)
+_publish_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_txn_local = threading.local()
+
+def current_snapshot():
+    """The latest published snapshot; never blocks"""
+    return _snapshot
+
+def changed_keys(old, new):
+    """Keys added, removed or modified between two frozen mappings"""
+    keys = {key for key, value in new.items() if old.get(key) is not value and old.get(key) != value}
+    keys.update(key for key in old if key not in new)
+    return keys
+
+def loan_events(old_borrows, new_borrows, usernames):
+    """Borrow/return events between two borrows mappings for the given users.
+
+    Yields (kind, username, borrow) where kind is 'borrow' for a new loan,
+    'return' when a loan got its return date, 'reopen' when it lost it and
+    'remove' for a loan that disappeared. A loan that arrives already
+    returned produces 'borrow' followed by 'return'.
+    """
+    events = []
+    for username in usernames:
+        before = {}
+        for borrow in old_borrows.get(username, ()):
+            key = (borrow['book_id'], borrow['borrow_date'])
+            before.setdefault(key, []).append(borrow)
+        for borrow in new_borrows.get(username, ()):
+            key = (borrow['book_id'], borrow['borrow_date'])
+            previous = before.get(key)
+            if previous:
+                old_borrow = previous.pop()
+                if old_borrow['return_date'] == borrow['return_date']:
+                    continue
+                if borrow['return_date'] and not old_borrow['return_date']:
+                    events.append(('return', username, borrow))
+                elif old_borrow['return_date'] and not borrow['return_date']:
+                    events.append(('reopen', username, borrow))
+                continue
+            events.append(('borrow', username, borrow))
+            if borrow['return_date']:
+                events.append(('return', username, borrow))
+        for remaining in before.values():
+            events.extend(('remove', username, borrow) for borrow in remaining)
+    return events
+
+_snapshot_listeners = []
+# Publishes whose listener calls wait for a background index build, in
+# publish order; None when listeners run inside publish_snapshot()
+_index_backlog = None
+# Seconds the latest load of each dataset took (read + parse + freeze)
+dataset_load_seconds = {}
+
+def on_snapshot_change(listener):
+    """Register listener(old, new, changes) to run after every publish.
+
+    changes maps each replaced dataset name to the set of keys (book IDs or
+    usernames) that differ between old and new; when borrows changed,
+    changes["loans"] also holds their loan_events(). Listeners run in
+    registration order, once per publish, so derived indexes can be updated
+    incrementally.
+    """
+    _snapshot_listeners.append(listener)
+    return listener
+
+def snapshot_changes(old, new, names, changed=None):
+    """The changes argument listeners get for a publish replacing the named datasets"""
+    changes = {}
+    for name in names:
+        keys = (changed or {}).get(name)
+        changes[name] = keys if keys is not None else changed_keys(getattr(old, name), getattr(new, name))
+    if "borrows" in changes:
+        changes["loans"] = loan_events(old.borrows, new.borrows, changes["borrows"])
+    return changes
+
+def notify_listeners(old, new, changes, timings=None):
+    """Run every listener; timings, if given, accumulates seconds per listener name"""
+    for listener in _snapshot_listeners:
+        started = time.perf_counter()
+        try:
+            listener(old, new, changes)
+        except Exception as e:
+            print(f"❌ Error updating {getattr(listener, '__name__', listener)}: {e}")
+        if timings is not None:
+            name = getattr(listener, '__name__', str(listener))
+            timings[name] = timings.get(name, 0) + time.perf_counter() - started
+
+def publish_snapshot(datasets, changed=None):
+    """Swap in a snapshot with the given {name: (version, frozen data)} replaced.
+
+    A dataset is only replaced by a newer version, so a slow reload can never
+    overwrite data this worker committed in the meantime. changed optionally
+    gives the keys a transaction touched; reloads are diffed instead.
+    """
+    global _snapshot
+    with _publish_lock:
+        old = _snapshot
+        versions = dict(old.versions)
+        fields = {}
+        for name, (version, data) in datasets.items():
+            if versions[name] is None or version >= versions[name]:
+                versions[name] = version
+                fields[name] = data
+        _snapshot = old._replace(versions=MappingProxyType(versions), **fields)
+        if _snapshot_listeners and fields:
+            if _index_backlog is not None:
+                _index_backlog.append((old, _snapshot, tuple(fields), changed))
+            else:
+                notify_listeners(old, _snapshot, snapshot_changes(old, _snapshot, fields, changed))
+        return _snapshot
+
+def defer_index_updates():
+    """Queue listener calls from now on, for run_deferred_index_updates()"""
+    global _index_backlog
+    with _publish_lock:
+        if _index_backlog is None:
+            _index_backlog = []
+
+def run_deferred_index_updates(timings=None):
+    """Run the queued listener calls in publish order, outside the publish lock.
+
+    Publishes that land meanwhile are queued behind them; once the queue is
+    empty, listeners go back to running inside publish_snapshot(). Only one
+    thread may call this at a time.
+    """
+    global _index_backlog
+    while True:
+        with _publish_lock:
+            if not _index_backlog:
+                _index_backlog = None
+                return
+            old, new, names, changed = _index_backlog.pop(0)
+        notify_listeners(old, new, snapshot_changes(old, new, names, changed), timings)
+
+def catch_up_loans(since):
+    """loan_events() between the since snapshot and the current one.
+
+    For an index rebuilt from since without holding any lock: call under
+    _publish_lock, apply the events to the new index and swap it in before
+    releasing the lock. Raises RuntimeError while listener calls are still
+    deferred (startup indexing), as the live indexes then lag the snapshot.
+    """
+    if _index_backlog is not None:
+        raise RuntimeError("Indexes are still being built at startup, please try again shortly")
+    current = _snapshot
+    return loan_events(since.borrows, current.borrows, changed_keys(since.borrows, current.borrows))
+
+def load_datasets(names):
+    """{name: frozen data} for the named datasets, read side by side in threads"""
+    def load(name):
+        started = time.perf_counter()
+        data = DATASET_FREEZERS[name](DATASET_LOADERS[name]())
+        dataset_load_seconds[name] = time.perf_counter() - started
+        return data
+    if len(names) == 1:
+        return {names[0]: load(names[0])}
+    with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="library-load") as pool:
+        return dict(zip(names, pool.map(load, names)))
+
+def refresh_snapshot():
+    """Reload only the datasets whose shared version moved past the snapshot's"""
+    versions = dataset_versions.read_all()
+    snapshot = _snapshot
+    if all(snapshot.versions[name] is not None and snapshot.versions[name] >= versions[name]
+           for name in DATASETS):
+        return snapshot
+    with _refresh_lock:
+        snapshot = _snapshot
+        stale = [name for name in DATASETS
+                 if snapshot.versions[name] is None or snapshot.versions[name] < versions[name]]
+        if not stale:
+            return snapshot
+        loaded = load_datasets(stale)
+        return publish_snapshot({name: (versions[name], loaded[name]) for name in stale})
+
+class LibraryTransaction:
+    """Copy-on-write changes on top of a snapshot, published all at once by commit()"""
+
+    def __init__(self, base):
+        self.base = base
+        self.staged = {}
+        self.touched = {}
+        self.depth = 0
+        self.committed = False
+
+    @property
+    def books(self):
+        return self.staged.get("books", self.base.books)
+
+    @property
+    def users(self):
+        return self.staged.get("users", self.base.users)
+
+    @property
+    def borrows(self):
+        return self.staged.get("borrows", self.base.borrows)
+
+    @property
+    def branches(self):
+        return self.staged.get("branches", self.base.branches)
+
+    def _stage(self, name, key):
+        if name not in self.staged:
+            # Shallow copy: untouched records stay shared with the old snapshot
+            self.staged[name] = dict(getattr(self.base, name))
+            self.touched[name] = set()
+        if self.touched.get(name) is not None:
+            self.touched[name].add(key)
+        return self.staged[name]
+
+    def replace_dataset(self, name, data):
+        self.staged[name] = dict(data)
+        self.touched[name] = None  # diffed against the old snapshot on publish
+
+    def put_book(self, book_id, book):
+        self._stage("books", book_id)[book_id] = freeze_record(book)
+
+    def update_book(self, book_id, **fields):
+        self.put_book(book_id, {**self.books[book_id], **fields})
+
+    def delete_book(self, book_id):
+        del self._stage("books", book_id)[book_id]
+
+    def put_user(self, username, user):
+        self._stage("users", username)[username] = freeze_record(user)
+
+    def update_user(self, username, **fields):
+        self.put_user(username, {**self.users[username], **fields})
+
+    def add_loan(self, username, borrow):
+        borrows = self._stage("borrows", username)
+        borrows[username] = tuple(borrows.get(username, ())) + (freeze_record(borrow),)
+
+    def update_loan(self, username, index, **fields):
+        borrows = self._stage("borrows", username)
+        user_borrows = list(borrows[username])
+        user_borrows[index] = freeze_record({**user_borrows[index], **fields})
+        borrows[username] = tuple(user_borrows)
+
+    def _stage_inventory(self, branch):
+        branches = self._stage("branches", branch)
+        inventory = branches.get(branch)
+        if not isinstance(inventory, dict):
+            inventory = branches[branch] = dict(inventory or {})
+        return inventory
+
+    def add_branch(self, branch):
+        self._stage_inventory(branch)
+
+    def delete_branch(self, branch):
+        del self._stage("branches", branch)[branch]
+
+    def adjust_holding(self, branch, book_id, copies):
+        """Change how many copies of a book a branch owns by copies; returns the new count"""
+        inventory = self._stage_inventory(branch)
+        held = inventory.get(book_id, 0) + copies
+        if held:
+            inventory[book_id] = held
+        else:
+            inventory.pop(book_id, None)
+        return held
+
+    def balance_branches(self):
+        """Spread copy count changes staged without a branch over the branch holdings.
+
+        Added copies go to the branch owning the most copies of the book (or
+        the first branch for a new book), removed ones come off the fullest
+        shelves first, so the holdings always sum to the book's TotalCopies.
+        Borrows and returns leave TotalCopies alone and stage nothing here.
+        """
+        if "books" not in self.staged or not self.branches:
+            return
+        book_ids = self.touched.get("books")
+        if book_ids is None:
+            book_ids = changed_keys(self.base.books, self.staged["books"])
+        for book_id in book_ids:
+            book = self.books.get(book_id)
+            held = {branch: inventory[book_id] for branch, inventory in self.branches.items() if book_id in inventory}
+            delta = (book["TotalCopies"] if book else 0) - sum(held.values())
+            if delta > 0:
+                home = max(held, key=held.get) if held else min(self.branches)
+                self.adjust_holding(home, book_id, delta)
+            elif delta < 0:
+                shelf = shelf_copies(self, book_id)
+                # Copies on the shelf first; copies out on loan only if the books file says there are fewer
+                for limit in (lambda branch: max(shelf[branch], 0), lambda branch: held[branch]):
+                    for branch in sorted(held, key=lambda branch: -shelf[branch]):
+                        change = max(delta, -min(limit(branch), held[branch]))
+                        if change:
+                            held[branch] = self.adjust_holding(branch, book_id, change)
+                            shelf[branch] += change
+                            delta -= change
+
+    def commit(self):
+        """Write staged datasets and publish them; nested callers defer to the outermost.
+
+        Every dataset is first written to temp files; they replace the data
+        files only once all of them were written. If anything fails, no file
+        changes, nothing is published and False is returned.
+        """
+        if self.depth > 1 or self.committed:
+            return True
+        self.committed = True
+        self.balance_branches()
+        frozen = {}
+        staged = StagedFiles()
+        try:
+            for name in COMMIT_ORDER:
+                if name not in self.staged:
+                    continue
+                error = DATASET_ERRORS[name]
+                frozen[name] = DATASET_FREEZERS[name](self.staged[name])
+                DATASET_WRITERS[name](frozen[name], staged)
+            error = "Error saving data"
+            staged.apply()
+        except Exception as e:
+            print(f"❌ {error}: {e}")
+            return False
+        finally:
+            staged.discard()
+        written = {name: (dataset_versions.bump(name), data) for name, data in frozen.items()}
+        if written:
+            publish_snapshot(written, changed={name: self.touched.get(name) for name in written})
+            mark_dirty(self.base, written, self.touched)
+        return True
+
+@contextlib.contextmanager
+def library_transaction():
+    """Read-modify-write on the latest data, serialised across threads and workers.
+
+    Nested calls in the same thread join the outer transaction. Changes that
+    are not committed before the outermost block exits are discarded.
+    """
+    txn = getattr(_txn_local, "txn", None)
+    if txn is not None:
+        txn.depth += 1
+        try:
+            yield txn
+        finally:
+            txn.depth -= 1
+        return
+    with dataset_versions.write_lock:
+        txn = LibraryTransaction(refresh_snapshot())
+        txn.depth = 1
+        _txn_local.txn = txn
+        try:
+            yield txn
+        finally:
+            _txn_local.txn = None
+
+def get_dataset(name):
+    """Read-only view of a dataset: the open transaction's in this thread, else
+    the current snapshot (refreshed once per request by check_dataset_versions)"""
+    txn = getattr(_txn_local, "txn", None)
+    if txn is not None:
+        return getattr(txn, name)
+    if not has_request_context() or _snapshot.versions[name] is None:
+        refresh_snapshot()
+    return getattr(_snapshot, name)
+
+def get_books():
+    return get_dataset("books")
+
+def get_users():
+    return get_dataset("users")
+
+def get_borrows():
+    return get_dataset("borrows")
+
+def get_branches():
+    return get_dataset("branches")
+
+# ============= CATALOGUE INDEXES =============
+
+def parse_year(year):
+    """Publication year as an int, or None when the field isn't a number"""
+    try:
+        return int(str(year).strip())
+    except ValueError:
+        return None
+
+class FacetIndex:
+    """Facet lookups over the books dataset, kept up to date on every change.
+
+    Each book gets a stable ordinal. Year and TotalCopies are sorted
+    (value, ordinal) lists searched with bisect, authors map to sets of
+    ordinals, and availability is one byte per ordinal. Per-value counters
+    give whole-catalogue facet counts without touching any book.
+    """
+
+    FACET_AUTHORS = 15
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ordinals = {}          # book_id -> ordinal
+        self.book_ids = []          # ordinal -> book_id
+        self.attrs = []             # ordinal -> (year, author, total_copies), None once deleted
+        self.by_year = []           # sorted (year, ordinal); non-numeric years left out
+        self.by_copies = []         # sorted (total_copies, ordinal)
+        self.by_author = {}         # author -> set of ordinals
+        self.available = bytearray()
+        self.available_count = 0
+        self.year_counts = Counter()
+        self.copies_counts = Counter()
+        self.live = 0
+
+    def _ordinal(self, book_id):
+        ordinal = self.ordinals.get(book_id)
+        if ordinal is None:
+            ordinal = self.ordinals[book_id] = len(self.book_ids)
+            self.book_ids.append(book_id)
+            self.attrs.append(None)
+            self.available.append(0)
+        return ordinal
+
+    def _set_available(self, ordinal, flag):
+        if self.available[ordinal] != flag:
+            self.available[ordinal] = flag
+            self.available_count += 1 if flag else -1
+
+    def _remove(self, ordinal):
+        year, author, copies = self.attrs[ordinal]
+        if year is not None:
+            del self.by_year[bisect.bisect_left(self.by_year, (year, ordinal))]
+            self.year_counts[year] -= 1
+            if not self.year_counts[year]:
+                del self.year_counts[year]
+        del self.by_copies[bisect.bisect_left(self.by_copies, (copies, ordinal))]
+        self.copies_counts[copies] -= 1
+        if not self.copies_counts[copies]:
+            del self.copies_counts[copies]
+        ordinals = self.by_author[author]
+        ordinals.discard(ordinal)
+        if not ordinals:
+            del self.by_author[author]
+        self._set_available(ordinal, 0)
+        self.attrs[ordinal] = None
+        self.live -= 1
+
+    def _add(self, ordinal, attrs, available):
+        year, author, copies = attrs
+        if year is not None:
+            bisect.insort(self.by_year, (year, ordinal))
+            self.year_counts[year] += 1
+        bisect.insort(self.by_copies, (copies, ordinal))
+        self.copies_counts[copies] += 1
+        self.by_author.setdefault(author, set()).add(ordinal)
+        self._set_available(ordinal, 1 if available else 0)
+        self.attrs[ordinal] = attrs
+        self.live += 1
+
+    @staticmethod
+    def _attrs(book):
+        return (parse_year(book['Year']), book['Author'], book['TotalCopies'])
+
+    def rebuild(self, books):
+        """Index a whole books mapping from scratch (sorted once, not per insert)"""
+        with self._lock:
+            self.__init__()
+            for book_id, book in books.items():
+                ordinal = self._ordinal(book_id)
+                attrs = self.attrs[ordinal] = self._attrs(book)
+                year, author, copies = attrs
+                if year is not None:
+                    self.by_year.append((year, ordinal))
+                    self.year_counts[year] += 1
+                self.by_copies.append((copies, ordinal))
+                self.copies_counts[copies] += 1
+                self.by_author.setdefault(author, set()).add(ordinal)
+                self._set_available(ordinal, 1 if book['Available'] > 0 else 0)
+            self.by_year.sort()
+            self.by_copies.sort()
+            self.live = len(books)
+
+    def update(self, books, book_ids):
+        """Re-index the given book IDs from a new books mapping"""
+        if not self.live or len(book_ids) > max(self.live, 1000) // 4:
+            return self.rebuild(books)
+        with self._lock:
+            for book_id in book_ids:
+                book = books.get(book_id)
+                ordinal = self.ordinals.get(book_id)
+                old_attrs = self.attrs[ordinal] if ordinal is not None else None
+                if book is None:
+                    if old_attrs is not None:
+                        self._remove(ordinal)
+                    continue
+                ordinal = self._ordinal(book_id)
+                attrs = self._attrs(book)
+                if attrs == old_attrs:
+                    # Borrow/return: only availability moved
+                    self._set_available(ordinal, 1 if book['Available'] > 0 else 0)
+                    continue
+                if old_attrs is not None:
+                    self._remove(ordinal)
+                self._add(ordinal, attrs, book['Available'] > 0)
+
+    def search(self, year_from=None, year_to=None, author=None, available_only=False, min_copies=None):
+        """Book IDs matching every given facet, in catalogue order.
+
+        Returns None when no facet is set (i.e. the whole catalogue). The
+        smallest candidate list drives the lookup; other facets are checked
+        per candidate against the stored attributes.
+        """
+        with self._lock:
+            drivers = []
+            checks = []
+            if author:
+                ordinals = self.by_author.get(author, ())
+                drivers.append((len(ordinals), lambda: ordinals))
+                checks.append(lambda attrs: attrs[1] == author)
+            if year_from is not None or year_to is not None:
+                low = year_from if year_from is not None else -float("inf")
+                high = year_to if year_to is not None else float("inf")
+                year_start = bisect.bisect_left(self.by_year, (low,))
+                year_end = bisect.bisect_right(self.by_year, (high, float("inf")))
+                drivers.append((max(year_end - year_start, 0),
+                                lambda: (o for _, o in self.by_year[year_start:year_end])))
+                checks.append(lambda attrs: attrs[0] is not None and low <= attrs[0] <= high)
+            if min_copies is not None:
+                copies_start = bisect.bisect_left(self.by_copies, (min_copies,))
+                drivers.append((len(self.by_copies) - copies_start,
+                                lambda: (o for _, o in self.by_copies[copies_start:])))
+                checks.append(lambda attrs: attrs[2] >= min_copies)
+            if available_only:
+                drivers.append((self.available_count,
+                                lambda: itertools.compress(range(len(self.available)), self.available)))
+            if not drivers:
+                return None
+            
+            size, candidates = min(drivers, key=lambda driver: driver[0])
+            available = self.available
+            matches = [
+                ordinal for ordinal in candidates()
+                if self.attrs[ordinal] is not None
+                and (not available_only or available[ordinal])
+                and all(check(self.attrs[ordinal]) for check in checks)
+            ]
+            matches.sort()
+            return [self.book_ids[ordinal] for ordinal in matches]
+
+    def facet_counts(self, book_ids=None):
+        """Counts per year, author, copies and availability.
+
+        For the whole catalogue (book_ids None) these come straight from the
+        maintained counters; for a result set only its own books are counted.
+        """
+        with self._lock:
+            if book_ids is None:
+                years, copies = dict(self.year_counts), dict(self.copies_counts)
+                authors = {author: len(ordinals) for author, ordinals in self.by_author.items()}
+                available, total = self.available_count, self.live
+            else:
+                years, authors, copies = Counter(), Counter(), Counter()
+                available = total = 0
+                for book_id in book_ids:
+                    ordinal = self.ordinals.get(book_id)
+                    attrs = self.attrs[ordinal] if ordinal is not None else None
+                    if attrs is None:
+                        continue
+                    if attrs[0] is not None:
+                        years[attrs[0]] += 1
+                    authors[attrs[1]] += 1
+                    copies[attrs[2]] += 1
+                    available += self.available[ordinal]
+                    total += 1
+        return {
+            'total': total,
+            'available': available,
+            'years': sorted(years.items()),
+            'copies': sorted(copies.items()),
+            'authors': heapq.nlargest(self.FACET_AUTHORS, authors.items(), key=lambda item: (item[1], item[0])),
+        }
+
+facet_index = FacetIndex()
+
+@on_snapshot_change
+def update_facet_index(old, new, changes):
+    if "books" in changes:
+        facet_index.update(new.books, changes["books"])
+
+def normalize_words(text):
+    """Lower-cased alphanumeric words of a title/author/query"""
+    return re.findall(r"\w+", text.lower())
+
+def word_trigrams(word):
+    """Character trigrams of one word, padded so word starts and ends count"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def text_trigrams(text):
+    trigrams = set()
+    for word in normalize_words(text):
+        trigrams |= word_trigrams(word)
+    return trigrams
+
+class TrigramIndex:
+    """Character-trigram index over book titles and authors for typo-tolerant search.
+
+    Each trigram maps to the set of book ordinals whose title/author words
+    contain it. A fuzzy query only counts hits in the posting lists of its
+    own trigrams - rarest first, dropping candidates that can no longer
+    reach the threshold - so it never compares against every book.
+    """
+
+    SIMILARITY = 0.5
+    MAX_RESULTS = 50
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ordinals = {}          # book_id -> ordinal
+        self.book_ids = []          # ordinal -> book_id
+        self.doc_trigrams = []      # ordinal -> frozenset of trigrams, None once deleted
+        self.texts = []             # ordinal -> (lower title, lower author)
+        self.postings = {}          # trigram -> set of ordinals
+        self.live = 0
+
+    def _index(self, book_id, book):
+        ordinal = self.ordinals.get(book_id)
+        if ordinal is None:
+            ordinal = self.ordinals[book_id] = len(self.book_ids)
+            self.book_ids.append(book_id)
+            self.doc_trigrams.append(None)
+            self.texts.append(None)
+        trigrams = frozenset(text_trigrams(book['Title']) | text_trigrams(book['Author']))
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, set()).add(ordinal)
+        self.doc_trigrams[ordinal] = trigrams
+        self.texts[ordinal] = (book['Title'].lower(), book['Author'].lower())
+        self.live += 1
+
+    def _unindex(self, book_id):
+        ordinal = self.ordinals.get(book_id)
+        if ordinal is None or self.doc_trigrams[ordinal] is None:
+            return
+        for trigram in self.doc_trigrams[ordinal]:
+            posting = self.postings[trigram]
+            posting.discard(ordinal)
+            if not posting:
+                del self.postings[trigram]
+        self.doc_trigrams[ordinal] = None
+        self.texts[ordinal] = None
+        self.live -= 1
+
+    def rebuild(self, books):
+        with self._lock:
+            self.__init__()
+            for book_id, book in books.items():
+                self._index(book_id, book)
+
+    def update(self, books, book_ids):
+        """Re-index the given book IDs from a new books mapping"""
+        if not self.live:
+            return self.rebuild(books)
+        with self._lock:
+            for book_id in book_ids:
+                book = books.get(book_id)
+                ordinal = self.ordinals.get(book_id)
+                if (book is not None and ordinal is not None
+                        and self.texts[ordinal] == (book['Title'].lower(), book['Author'].lower())):
+                    continue  # only counts changed
+                self._unindex(book_id)
+                if book is not None:
+                    self._index(book_id, book)
+
+    def substring_matches(self, query):
+        """Book IDs whose title or author contains query, in catalogue order.
+
+        Candidates are the books holding every in-word trigram of the query;
+        only those are checked with the plain substring test. Returns None
+        when the query has no trigram (under three letters per word).
+        """
+        term = query.lower()
+        trigrams = {word[i:i + 3] for word in normalize_words(term) for i in range(len(word) - 2)}
+        if not trigrams:
+            return None
+        with self._lock:
+            postings = sorted((self.postings.get(trigram, set()) for trigram in trigrams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+            hits = sorted(ordinal for ordinal in candidates
+                          if term in self.texts[ordinal][0] or term in self.texts[ordinal][1])
+            return [self.book_ids[ordinal] for ordinal in hits]
+
+    def similar(self, query, threshold=SIMILARITY, limit=MAX_RESULTS):
+        """Up to limit (book_id, score) pairs, best first.
+
+        score is the share of the query's trigrams found in the book's
+        title/author words. By pigeonhole, a book reaching the threshold must
+        hold one of the (len - needed + 1) rarest query trigrams, so only those
+        posting lists generate candidates; the rest are membership checks.
+        """
+        trigrams = text_trigrams(query)
+        if not trigrams:
+            return []
+        needed = max(1, math.ceil(threshold * len(trigrams)))
+        with self._lock:
+            postings = sorted((self.postings.get(trigram, set()) for trigram in trigrams), key=len)
+            prefix = len(postings) - needed + 1
+            counts = Counter()
+            for posting in postings[:prefix]:
+                counts.update(posting)
+            for position, posting in enumerate(postings[prefix:], prefix):
+                for ordinal in counts.keys() & posting:
+                    counts[ordinal] += 1
+                # Drop candidates that can't reach the threshold any more
+                remaining = len(postings) - position - 1
+                if remaining and len(counts) > self.MAX_RESULTS:
+                    counts = Counter({ordinal: count for ordinal, count in counts.items()
+                                      if count + remaining >= needed})
+            best = heapq.nlargest(
+                limit,
+                (ordinal for ordinal, count in counts.items() if count >= needed),
+                key=lambda ordinal: (counts[ordinal], -len(self.doc_trigrams[ordinal]))
+            )
+            return [(self.book_ids[ordinal], counts[ordinal] / len(trigrams)) for ordinal in best]
+
+trigram_index = TrigramIndex()
+
+@on_snapshot_change
+def update_trigram_index(old, new, changes):
+    if "books" in changes:
+        trigram_index.update(new.books, changes["books"])
+
+class LoanCounters:
+    """Loan counts per book and open loans per user, kept current from loan events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total_by_book = Counter()   # every loan ever recorded
+        self.open_by_book = Counter()
+        self.open_by_user = Counter()
+
+    def apply(self, events):
+        """Apply loan_events(); returns the set of book IDs whose counts moved"""
+        books = set()
+        with self._lock:
+            for kind, username, borrow in events:
+                book_id = borrow['book_id']
+                is_open = not borrow['return_date']
+                if kind == 'borrow':
+                    self.total_by_book[book_id] += 1
+                    # A loan arriving already returned is followed by its own 'return'
+                    self.open_by_book[book_id] += 1
+                    self.open_by_user[username] += 1
+                elif kind == 'return':
+                    self.open_by_book[book_id] -= 1
+                    self.open_by_user[username] -= 1
+                elif kind == 'reopen':
+                    self.open_by_book[book_id] += 1
+                    self.open_by_user[username] += 1
+                elif kind == 'remove':
+                    self.total_by_book[book_id] -= 1
+                    if is_open:
+                        self.open_by_book[book_id] -= 1
+                        self.open_by_user[username] -= 1
+                books.add(book_id)
+        return books
+
+    def popularity(self, book_id):
+        """Historical plus open loans, so titles out on loan now rank a little higher"""
+        return self.total_by_book[book_id] + self.open_by_book[book_id]
+
+loan_counters = LoanCounters()
+
+@on_snapshot_change
+def update_loan_counters(old, new, changes):
+    if "loans" in changes:
+        changes["popular_books"] = loan_counters.apply(changes["loans"])
+
+class TrieNode:
+    __slots__ = ("children", "terms", "top")
+
+    def __init__(self):
+        self.children = {}
+        self.terms = {}     # term -> number of its keys ending (or truncated) here
+        self.top = []       # best TOP_K terms in this subtree, best first
+
+class PrefixIndex:
+    """Trie of title and author completions ranked by loan popularity.
+
+    Every node caches the TOP_K most popular terms below it, so a lookup is
+    a walk down the prefix and a slice. Titles are also reachable from the
+    start of each later word ("learn" -> "Machine Learning Fundamentals")
+    and authors from their surname. Keys are only branched for MAX_DEPTH
+    characters; longer prefixes filter the few terms stored at that depth.
+    When a term is added, removed or changes score, only the nodes on its
+    key paths are recomputed, each from its children's cached lists.
+    """
+
+    MAX_DEPTH = 12
+    TOP_K = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.root = TrieNode()
+        self.terms = {}             # (kind, key) -> {'text': ..., 'book_ids': set()}
+        self.scores = {}            # (kind, key) -> popularity
+        self.book_terms = {}        # book_id -> ((kind, key), ...)
+
+    @staticmethod
+    def _book_terms(book):
+        terms = []
+        for kind, text in (('title', book['Title']), ('author', book['Author'])):
+            key = " ".join(normalize_words(text))
+            if key:
+                terms.append(((kind, key), text))
+        return terms
+
+    @staticmethod
+    def _term_keys(term):
+        kind, key = term
+        words = key.split(" ")
+        keys = {" ".join(words[i:]) for i in range(len(words))} if kind == 'title' else {key, words[-1]}
+        return keys
+
+    def _path(self, key, create=False):
+        node, path = self.root, [self.root]
+        for char in key[:self.MAX_DEPTH]:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = TrieNode()
+            node = child
+            path.append(node)
+        return path
+
+    def _recompute(self, path):
+        score = self.scores.get
+        for node in reversed(path):
+            candidates = set(node.terms)
+            for child in node.children.values():
+                candidates.update(child.top)
+            node.top = heapq.nlargest(self.TOP_K, candidates, key=lambda term: (score(term, 0), term))
+
+    def _link(self, term, add):
+        for key in self._term_keys(term):
+            path = self._path(key, create=add)
+            node = path[-1]
+            if add:
+                node.terms[term] = node.terms.get(term, 0) + 1
+            else:
+                node.terms[term] -= 1
+                if not node.terms[term]:
+                    del node.terms[term]
+            self._recompute(path)
+            if not add:
+                # Prune branches left without terms
+                for parent, child, char in zip(reversed(path[:-1]), reversed(path[1:]), reversed(key[:self.MAX_DEPTH])):
+                    if child.terms or child.children:
+                        break
+                    del parent.children[char]
+
+    def _rescore(self, term):
+        info = self.terms.get(term)
+        if info is None:
+            return
+        score = sum(loan_counters.popularity(book_id) for book_id in info['book_ids'])
+        if self.scores.get(term) != score:
+            self.scores[term] = score
+            for key in self._term_keys(term):
+                self._recompute(self._path(key))
+
+    def rebuild(self, books):
+        """Index a whole catalogue, filling every node's cache in one bottom-up pass"""
+        with self._lock:
+            self.__init__()
+            for book_id, book in books.items():
+                terms = self._book_terms(book)
+                for term, text in terms:
+                    info = self.terms.get(term)
+                    if info is None:
+                        info = self.terms[term] = {'text': text, 'book_ids': set()}
+                        for key in self._term_keys(term):
+                            node = self._path(key, create=True)[-1]
+                            node.terms[term] = node.terms.get(term, 0) + 1
+                    info['book_ids'].add(book_id)
+                self.book_terms[book_id] = tuple(term for term, _ in terms)
+            for term, info in self.terms.items():
+                self.scores[term] = sum(loan_counters.popularity(book_id) for book_id in info['book_ids'])
+            # Post-order walk so children are ready before their parent
+            stack = [(self.root, False)]
+            while stack:
+                node, ready = stack.pop()
+                if ready:
+                    self._recompute([node])
+                else:
+                    stack.append((node, True))
+                    stack.extend((child, False) for child in node.children.values())
+
+    def update(self, books, book_ids=(), popular_book_ids=()):
+        """Re-index changed books and re-rank the terms of books whose loans moved"""
+        if not self.book_terms or len(book_ids) > max(len(self.book_terms), 1000) // 4:
+            return self.rebuild(books)
+        with self._lock:
+            dirty = set()
+            for book_id in book_ids:
+                book = books.get(book_id)
+                new_terms = self._book_terms(book) if book is not None else []
+                old_terms = self.book_terms.pop(book_id, ())
+                if tuple(term for term, _ in new_terms) == old_terms:
+                    self.book_terms[book_id] = old_terms
+                    continue
+                for term in old_terms:
+                    info = self.terms[term]
+                    info['book_ids'].discard(book_id)
+                    if info['book_ids']:
+                        dirty.add(term)
+                    else:
+                        del self.terms[term]
+                        self.scores.pop(term, None)
+                        self._link(term, add=False)
+                for term, text in new_terms:
+                    info = self.terms.get(term)
+                    if info is None:
+                        info = self.terms[term] = {'text': text, 'book_ids': set()}
+                        self.scores[term] = 0
+                        self._link(term, add=True)
+                    info['book_ids'].add(book_id)
+                    dirty.add(term)
+                if new_terms:
+                    self.book_terms[book_id] = tuple(term for term, _ in new_terms)
+            for book_id in popular_book_ids:
+                dirty.update(self.book_terms.get(book_id, ()))
+            for term in dirty:
+                self._rescore(term)
+
+    def complete(self, prefix, limit=TOP_K):
+        """Top completions for prefix as dicts with text, kind, popularity and book_ids"""
+        key = " ".join(normalize_words(prefix))
+        if not key:
+            return []
+        if prefix[-1:].isspace():
+            key += " "
+        with self._lock:
+            path = self._path(key)
+            if path is None:
+                return []
+            node = path[-1]
+            if len(key) <= self.MAX_DEPTH:
+                terms = node.top[:limit]
+            else:
+                matching = [term for term in node.terms
+                            if any(k.startswith(key) for k in self._term_keys(term))]
+                terms = heapq.nlargest(limit, matching, key=lambda term: (self.scores.get(term, 0), term))
+            return [{
+                'text': self.terms[term]['text'],
+                'kind': term[0],
+                'popularity': self.scores.get(term, 0),
+                'book_ids': sorted(self.terms[term]['book_ids'])[:5],
+            } for term in terms]
+
+prefix_index = PrefixIndex()
+
+@on_snapshot_change
+def update_prefix_index(old, new, changes):
+    if "books" in changes or "popular_books" in changes:
+        prefix_index.update(new.books, changes.get("books", ()), changes.get("popular_books", ()))
+
+class CooccurrenceIndex:
+    """Sparse item-item counts of how many patrons borrowed both books.
+
+    pairs[a][b] is the number of users whose history holds both a and b.
+    Each new (user, book) pair adds one to the book's row against every
+    other book that user borrowed, and the cached top neighbours of only
+    the touched books are dropped. rebuild() recomputes everything as
+    X.T @ X over the user x book matrix, using SciPy when it is installed.
+    """
+
+    TOP_N = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.user_books = {}        # username -> Counter(book_id -> loans)
+        self.pairs = {}             # book_id -> Counter(other book_id -> users)
+        self._top = {}              # book_id -> cached [(book_id, users), ...]
+
+    def _link(self, username, book_id, step):
+        others = [other for other in self.user_books.get(username, ()) if other != book_id]
+        row = self.pairs.setdefault(book_id, Counter())
+        for other in others:
+            row[other] += step
+            column = self.pairs.setdefault(other, Counter())
+            column[book_id] += step
+            if not column[book_id]:
+                del column[book_id]
+            if not row[other]:
+                del row[other]
+            self._top.pop(other, None)
+        self._top.pop(book_id, None)
+
+    def apply(self, events):
+        """Update counts from loan_events(): only new or vanished (user, book) pairs matter"""
+        with self._lock:
+            for kind, username, borrow in events:
+                book_id = borrow['book_id']
+                if kind == 'borrow':
+                    books = self.user_books.setdefault(username, Counter())
+                    if not books[book_id]:
+                        self._link(username, book_id, 1)
+                    books[book_id] += 1
+                elif kind == 'remove':
+                    books = self.user_books.get(username)
+                    if books and books[book_id]:
+                        books[book_id] -= 1
+                        if not books[book_id]:
+                            del books[book_id]
+                            self._link(username, book_id, -1)
+
+    def rebuild(self, borrows):
+        """Recompute every count from a full borrows mapping"""
+        user_books = {username: Counter(borrow['book_id'] for borrow in user_borrows)
+                      for username, user_borrows in borrows.items()}
+        if sparse is not None:
+            pairs = self._sparse_pairs(user_books)
+        else:
+            pairs = {}
+            for books in user_books.values():
+                for book_id in books:
+                    row = pairs.setdefault(book_id, Counter())
+                    row.update(other for other in books if other != book_id)
+        with self._lock:
+            self.user_books = user_books
+            self.pairs = pairs
+            self._top = {}
+
+    def replace_with(self, other):
+        """Take over the counts of an index rebuilt elsewhere"""
+        with self._lock:
+            self.user_books = other.user_books
+            self.pairs = other.pairs
+            self._top = {}
+
+    @staticmethod
+    def _sparse_pairs(user_books):
+        book_ids = sorted({book_id for books in user_books.values() for book_id in books})
+        column = {book_id: i for i, book_id in enumerate(book_ids)}
+        rows, cols = [], []
+        for row, books in enumerate(user_books.values()):
+            rows.extend([row] * len(books))
+            cols.extend(column[book_id] for book_id in books)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=(len(user_books), len(book_ids))
+        )
+        counts = (matrix.T @ matrix).tocsr()
+        counts.setdiag(0)
+        counts.eliminate_zeros()
+        pairs = {}
+        for i, book_id in enumerate(book_ids):
+            start, end = counts.indptr[i], counts.indptr[i + 1]
+            if start != end:
+                pairs[book_id] = Counter(dict(zip(
+                    (book_ids[j] for j in counts.indices[start:end]),
+                    counts.data[start:end].tolist()
+                )))
+        return pairs
+
+    def neighbours(self, book_id, limit=TOP_N):
+        """Books most often borrowed by the same patrons, as [(book_id, users), ...]"""
+        with self._lock:
+            top = self._top.get(book_id)
+            if top is None:
+                row = self.pairs.get(book_id, {})
+                top = self._top[book_id] = heapq.nlargest(
+                    self.TOP_N, row.items(), key=lambda item: (item[1], item[0]))
+            return top[:limit]
+
+    def recommend(self, book_ids, limit=TOP_N):
+        """Neighbours of several books combined, leaving out the books themselves"""
+        scores = Counter()
+        for book_id in book_ids:
+            for other, users in self.neighbours(book_id):
+                scores[other] += users
+        for book_id in book_ids:
+            scores.pop(book_id, None)
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+
+cooccurrence_index = CooccurrenceIndex()
+
+@on_snapshot_change
+def update_cooccurrence_index(old, new, changes):
+    if "loans" not in changes:
+        return
+    if old.versions["borrows"] is None:
+        cooccurrence_index.rebuild(new.borrows)
+    else:
+        cooccurrence_index.apply(changes["loans"])
+
+class LoanHistoryIndex:
+    """Each patron's loans ordered by borrow date, for paging one history.
+
+    The borrows file is rewritten on every save, so there are no stable
+    offsets to keep; instead each user's entry holds the sorted borrow dates
+    (for bisecting a date range) and the frozen loan records themselves.
+    Only the users a publish changed are re-sorted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_user = {}       # username -> (sorted borrow dates, loans in the same order)
+
+    def update(self, borrows, usernames):
+        entries = {}
+        for username in usernames:
+            loans = borrows.get(username)
+            if loans:
+                ordered = sorted(loans, key=lambda borrow: borrow['borrow_date'])
+                entries[username] = ([borrow['borrow_date'] for borrow in ordered], ordered)
+            else:
+                entries[username] = None
+        with self._lock:
+            for username, entry in entries.items():
+                if entry is None:
+                    self.by_user.pop(username, None)
+                else:
+                    self.by_user[username] = entry
+
+    def page(self, username, date_from=None, date_to=None, page=1, per_page=20):
+        """(loans newest first, matching count) for dates within [date_from, date_to] (YYYY-MM-DD)"""
+        dates, loans = self.by_user.get(username, ((), ()))
+        lo = bisect.bisect_left(dates, date_from) if date_from else 0
+        hi = bisect.bisect_right(dates, date_to + " 23:59:59") if date_to else len(dates)
+        total = max(0, hi - lo)
+        end = hi - (page - 1) * per_page
+        start = max(lo, end - per_page)
+        return loans[start:end][::-1] if end > lo else [], total
+
+loan_history_index = LoanHistoryIndex()
+
+@on_snapshot_change
+def update_loan_history_index(old, new, changes):
+    if "borrows" in changes:
+        loan_history_index.update(new.borrows, changes["borrows"])
+
+class BookLoanIndex:
+    """Each book's loans ordered by borrow date, and its open loans, for /books/<id>.
+
+    Like LoanHistoryIndex this keeps the frozen loan records rather than file
+    offsets, since the borrows file is rewritten on every save. A book's entry
+    is three parallel lists (borrow dates, usernames, loans) of references
+    into the snapshot, so a loan costs three pointers. Loan events insert,
+    update or remove single entries; only the first load sorts everything.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_book = {}       # book_id -> (sorted borrow dates, usernames, loans in the same order)
+        self.open = {}          # book_id -> {(borrow date, username): loan} for loans not returned
+
+    def rebuild(self, borrows):
+        rows = {}
+        for username, user_borrows in borrows.items():
+            for borrow in user_borrows:
+                rows.setdefault(borrow['book_id'], []).append((borrow['borrow_date'], username, borrow))
+        by_book, open_loans = {}, {}
+        for book_id, book_rows in rows.items():
+            book_rows.sort(key=lambda row: row[:2])
+            by_book[book_id] = tuple(list(column) for column in zip(*book_rows))
+            open_loans[book_id] = {(date, username): borrow for date, username, borrow in book_rows
+                                   if not borrow['return_date']}
+        with self._lock:
+            self.by_book = by_book
+            self.open = {book_id: loans for book_id, loans in open_loans.items() if loans}
+
+    def _find(self, book_id, username, borrow, match):
+        """Position of the first entry for this user and borrow date whose loan satisfies match"""
+        dates, usernames, loans = self.by_book.get(book_id, ((), (), ()))
+        i = bisect.bisect_left(dates, borrow['borrow_date'])
+        while i < len(dates) and dates[i] == borrow['borrow_date']:
+            if usernames[i] == username and match(loans[i]):
+                return i
+            i += 1
+        return None
+
+    def apply(self, events):
+        """Update entries from loan_events()"""
+        with self._lock:
+            for kind, username, borrow in events:
+                book_id, key = borrow['book_id'], (borrow['borrow_date'], username)
+                if kind == 'borrow':
+                    dates, usernames, loans = self.by_book.setdefault(book_id, ([], [], []))
+                    i = bisect.bisect_right(dates, borrow['borrow_date'])
+                    dates.insert(i, borrow['borrow_date'])
+                    usernames.insert(i, username)
+                    loans.insert(i, borrow)
+                    if not borrow['return_date']:
+                        self.open.setdefault(book_id, {})[key] = borrow
+                elif kind in ('return', 'reopen'):
+                    i = self._find(book_id, username, borrow,
+                                   lambda loan: bool(loan['return_date']) != bool(borrow['return_date']))
+                    if i is not None:
+                        self.by_book[book_id][2][i] = borrow
+                    if kind == 'return':
+                        self._close(book_id, key)
+                    else:
+                        self.open.setdefault(book_id, {})[key] = borrow
+                elif kind == 'remove':
+                    i = self._find(book_id, username, borrow, lambda loan: loan == borrow)
+                    if i is not None:
+                        for column in self.by_book[book_id]:
+                            del column[i]
+                        if not self.by_book[book_id][0]:
+                            del self.by_book[book_id]
+                    if not borrow['return_date']:
+                        self._close(book_id, key)
+
+    def _close(self, book_id, key):
+        loans = self.open.get(book_id)
+        if loans is not None:
+            loans.pop(key, None)
+            if not loans:
+                del self.open[book_id]
+
+    def borrowers(self, book_id):
+        """[(username, loan)] of the book's open loans, longest out first"""
+        with self._lock:
+            return [(username, loan) for (date, username), loan in sorted(self.open.get(book_id, {}).items())]
+
+    def page(self, book_id, page=1, per_page=20):
+        """([(username, loan)] newest first, total loans) for one page of the book's history"""
+        with self._lock:
+            dates, usernames, loans = self.by_book.get(book_id, ((), (), ()))
+            total = len(dates)
+            end = total - (page - 1) * per_page
+            start = max(0, end - per_page)
+            rows = list(zip(usernames[start:end], loans[start:end]))[::-1] if end > 0 else []
+        return rows, total
+
+book_loan_index = BookLoanIndex()
+
+@on_snapshot_change
+def update_book_loan_index(old, new, changes):
+    if "loans" not in changes:
+        return
+    if old.versions["borrows"] is None:
+        book_loan_index.rebuild(new.borrows)
+    else:
+        book_loan_index.apply(changes["loans"])
+
+class BranchIndex:
+    """Per-branch totals and per-book holdings across branches.
+
+    Answers "which branches have this on the shelf?" and "how many copies
+    does each branch hold?" without walking every shard or loan. Holdings
+    come from the shards and open loans are counted by the branch that lent
+    them; only the books and users a publish changed are re-counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}      # branch -> Counter of "TotalCopies" and "Titles"
+        self.by_book = {}     # book_id -> {branch: copies owned}
+        self.lent = {}        # book_id -> Counter of open loans by lending branch
+        self.borrowed = Counter()   # branch -> open loans
+
+    def update(self, old_branches, new_branches, branches):
+        with self._lock:
+            for branch in branches:
+                old_inventory = old_branches.get(branch, _EMPTY)
+                new_inventory = new_branches.get(branch, _EMPTY)
+                totals = self.totals.setdefault(branch, Counter(TotalCopies=0, Titles=0))
+                for book_id in changed_keys(old_inventory, new_inventory):
+                    before, after = old_inventory.get(book_id), new_inventory.get(book_id)
+                    holders = self.by_book.setdefault(book_id, {})
+                    if before is not None:
+                        totals["TotalCopies"] -= before
+                        totals["Titles"] -= 1
+                        del holders[branch]
+                    if after is not None:
+                        totals["TotalCopies"] += after
+                        totals["Titles"] += 1
+                        holders[branch] = after
+                    if not holders:
+                        del self.by_book[book_id]
+                if branch not in new_branches:
+                    del self.totals[branch]
+
+    def update_loans(self, old_borrows, new_borrows, usernames):
+        """Re-count the open loans of the given users by lending branch"""
+        with self._lock:
+            for borrows, sign in ((old_borrows, -1), (new_borrows, 1)):
+                for username in usernames:
+                    for borrow in borrows.get(username, ()):
+                        if borrow.get('branch') and not borrow['return_date']:
+                            lent = self.lent.setdefault(borrow['book_id'], Counter())
+                            lent[borrow['branch']] += sign
+                            self.borrowed[borrow['branch']] += sign
+                            if not any(lent.values()):
+                                del self.lent[borrow['book_id']]
+
+    def open_loans(self, book_id):
+        """Counter of the book's open loans by lending branch"""
+        with self._lock:
+            return Counter(self.lent.get(book_id, ()))
+
+    def _counts(self, copies, borrowed):
+        return {"TotalCopies": copies, "Available": copies - borrowed, "Borrowed": borrowed}
+
+    def availability(self, book_id):
+        """[(branch, counts)] for every branch holding the book, most copies on the shelf first"""
+        with self._lock:
+            lent = self.lent.get(book_id, Counter())
+            holders = [(branch, self._counts(copies, lent[branch]))
+                       for branch, copies in self.by_book.get(book_id, {}).items()]
+        return sorted(holders, key=lambda item: (-item[1]["Available"], item[0]))
+
+    def summary(self):
+        """[(branch, totals)] sorted by branch"""
+        with self._lock:
+            return sorted((branch, {**self._counts(totals["TotalCopies"], self.borrowed[branch]),
+                                    "Titles": totals["Titles"]})
+                          for branch, totals in self.totals.items())
+
+branch_index = BranchIndex()
+
+@on_snapshot_change
+def update_branch_index(old, new, changes):
+    if "branches" in changes:
+        branch_index.update(old.branches, new.branches, changes["branches"])
+    if "borrows" in changes:
+        # Diffed here rather than from changes["loans"]: loan events don't
+        # cover a loan that only had its branch filled in
+        branch_index.update_loans(old.borrows, new.borrows, changes["borrows"])
+
+class UserDirectory:
+    """Usernames kept sorted, overall and per role, for paging and prefix search.
+
+    A publish re-slots only the accounts it changed; a bulk change (or the
+    first load) re-sorts instead of inserting one name at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.roles = {}      # username -> role
+        self.names = []      # every username, sorted
+        self.by_role = {}    # role -> sorted usernames
+
+    def update(self, users, usernames):
+        with self._lock:
+            if len(usernames) > len(self.roles) // 8 + 64:
+                self.roles = {username: user['role'] for username, user in users.items()}
+                self.names = sorted(self.roles)
+                self.by_role = {}
+                for username in self.names:
+                    self.by_role.setdefault(self.roles[username], []).append(username)
+                return
+            for username in usernames:
+                old_role = self.roles.pop(username, None)
+                user = users.get(username)
+                if old_role is not None:
+                    self._remove(self.names, username)
+                    self._remove(self.by_role[old_role], username)
+                if user is not None:
+                    self.roles[username] = user['role']
+                    bisect.insort(self.names, username)
+                    bisect.insort(self.by_role.setdefault(user['role'], []), username)
+
+    @staticmethod
+    def _remove(names, username):
+        index = bisect.bisect_left(names, username)
+        if index < len(names) and names[index] == username:
+            del names[index]
+
+    def page(self, prefix="", role=None, page=1, per_page=50):
+        """(usernames on the page, matching count) for names starting with prefix"""
+        with self._lock:
+            names = self.names if not role else self.by_role.get(role, [])
+            lo = bisect.bisect_left(names, prefix)
+            hi = bisect.bisect_left(names, prefix + "\U0010ffff") if prefix else len(names)
+            start = lo + (page - 1) * per_page
+            return names[start:min(hi, start + per_page)], hi - lo
+
+    def role_counts(self):
+        with self._lock:
+            return sorted((role, len(names)) for role, names in self.by_role.items() if names)
+
+user_directory = UserDirectory()
+
+@on_snapshot_change
+def update_user_directory(old, new, changes):
+    if "users" in changes:
+        user_directory.update(new.users, changes["users"])
+
+# Chart window per rollup period, in buckets back from today
+ROLLUP_PERIODS = {"day": 30, "week": 12, "month": 12}
+
+@functools.lru_cache(maxsize=8192)
+def rollup_buckets(day):
+    """{period: bucket key} for a YYYY-MM-DD day"""
+    year, week, weekday = datetime.strptime(day, "%Y-%m-%d").isocalendar()
+    return {"day": day, "week": f"{year}-W{week:02d}", "month": day[:7]}
+
+def recent_buckets(period, count, today=None):
+    """The last count bucket keys of a period, oldest first, ending with today's"""
+    today = today or datetime.now()
+    if period == "month":
+        keys, year, month = [], today.year, today.month
+        for i in range(count):
+            keys.append(f"{year}-{month:02d}")
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+        return keys[::-1]
+    step = timedelta(days=7 if period == "week" else 1)
+    return [rollup_buckets((today - step * i).strftime("%Y-%m-%d"))[period] for i in range(count)][::-1]
+
+class CirculationRollups:
+    """Borrows and returns per day, ISO week and month, library-wide and per book.
+
+    counts[period][book_id][bucket] = [borrows, returns], with book_id ""
+    for the whole library; active holds the loans open right now. Loan events
+    add to the buckets of their borrow and return dates. Loans removed by
+    history compaction stay counted, since the rollups are the long-term
+    record; backfill() rebuilds them in one pass over the archive and loans.
+    A chart reads only its window of buckets, so it costs the same however
+    long the history is.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {period: {} for period in ROLLUP_PERIODS}
+        self.active = Counter()
+
+    def _add(self, counts, active, book_id, date, column, step=1):
+        try:
+            buckets = rollup_buckets(date[:10])
+        except (TypeError, ValueError):
+            return
+        for period, bucket in buckets.items():
+            for key in ("", book_id):
+                entry = counts[period].setdefault(key, {}).setdefault(bucket, [0, 0])
+                entry[column] += step
+        delta = step if column == 0 else -step
+        active[""] += delta
+        active[book_id] += delta
+
+    def apply(self, events):
+        with self._lock:
+            for kind, username, borrow in events:
+                if kind == 'borrow':
+                    self._add(self.counts, self.active, borrow['book_id'], borrow['borrow_date'], 0)
+                elif kind == 'return':
+                    self._add(self.counts, self.active, borrow['book_id'], borrow['return_date'], 1)
+
+    def backfill(self, loans):
+        """Rebuild from (book_id, borrow_date, return_date or None) rows in one pass"""
+        counts = {period: {} for period in ROLLUP_PERIODS}
+        active = Counter()
+        for book_id, borrow_date, return_date in loans:
+            self._add(counts, active, book_id, borrow_date, 0)
+            if return_date:
+                self._add(counts, active, book_id, return_date, 1)
+        with self._lock:
+            self.counts, self.active = counts, active
+
+    def replace_with(self, other):
+        """Take over the counts of rollups rebuilt elsewhere"""
+        with self._lock:
+            self.counts, self.active = other.counts, other.active
+
+    def series(self, period, book_id="", today=None):
+        """[{'bucket', 'borrows', 'returns', 'active'}] for the period's chart window"""
+        keys = recent_buckets(period, ROLLUP_PERIODS[period], today)
+        with self._lock:
+            buckets = self.counts[period].get(book_id, {})
+            rows = [(key, *buckets.get(key, (0, 0))) for key in keys]
+            active = self.active[book_id]
+        # Loans open at the end of each bucket, walking back from now
+        series = []
+        for key, borrows, returns in reversed(rows):
+            series.append({'bucket': key, 'borrows': borrows, 'returns': returns, 'active': active})
+            active -= borrows - returns
+        return series[::-1]
+
+def iter_loan_file(filename):
+    """(book_id, borrow_date, return_date or None) per line of a borrows-format file, streamed"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split("|")
+            if len(parts) >= 4:
+                yield parts[1], parts[2], None if parts[3] == "None" else parts[3]
+
+circulation_rollups = CirculationRollups()
+
+@on_snapshot_change
+def update_circulation_rollups(old, new, changes):
+    if "loans" not in changes:
+        return
+    if old.versions["borrows"] is None:
+        # First load: archived history from disk, current loans from the snapshot
+        circulation_rollups.backfill(itertools.chain(
+            iter_loan_file(BORROWS_ARCHIVE_FILE),
+            ((borrow['book_id'], borrow['borrow_date'], borrow['return_date'])
+             for user_borrows in new.borrows.values() for borrow in user_borrows)
+        ))
+    else:
+        circulation_rollups.apply(changes["loans"])
+
+# ============= FINES =============
+
+# A loan is due LOAN_PERIOD_DAYS after the day it was borrowed. Past the
+# role's grace period every further day costs the daily rate, up to the cap.
+# Amounts are in cents. library_fine_rates.txt can override the daily rate
+# and cap of single books ("book_id,daily_rate,cap", e.g. "B001,1.00,20.00");
+# roles with no fine (staff) stay exempt.
+
+LOAN_PERIOD_DAYS = 14
+
+FineRule = namedtuple("FineRule", "daily_rate grace_days cap")
+
+ROLE_FINE_RULES = {
+    "member": FineRule(daily_rate=25, grace_days=2, cap=1000),
+    "admin": FineRule(daily_rate=0, grace_days=0, cap=0),
+}
+DEFAULT_FINE_RULE = ROLE_FINE_RULES["member"]
+
+FineTable = namedtuple("FineTable", "day usernames book_ids due_dates days_late fines rows_by_user totals")
+
+def load_book_fine_rates():
+    """{book_id: (daily_rate, cap)} in cents from the optional rates file"""
+    rates = {}
+    try:
+        if os.path.exists(FINE_RATES_FILE):
+            with open(FINE_RATES_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.strip().split(",")
+                    if len(parts) == 3 and not line.startswith("#"):
+                        rates[parts[0]] = (round(float(parts[1]) * 100), round(float(parts[2]) * 100))
+    except Exception as e:
+        print(f"❌ Error loading fine rates: {e}")
+    return rates
+
+def format_money(cents):
+    return f"${cents / 100:,.2f}"
+
+class FineEngine:
+    """Fines for every open loan, priced in one batch.
+
+    The open loans are laid out as columns (borrower, book, borrow day) and
+    priced with a few NumPy array operations instead of parsing a datetime
+    per loan; without NumPy the same rules run as a plain loop. Lateness is
+    counted in whole days, so a table stays valid until the next borrow or
+    return (a new borrows version), a role or rate change, or midnight.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._table = None
+
+    def table(self):
+        """The FineTable for today's date and the current data"""
+        snapshot = refresh_snapshot()
+        today = datetime.now().strftime("%Y-%m-%d")
+        try:
+            rates_signature = file_signature(os.stat(FINE_RATES_FILE))
+        except OSError:
+            rates_signature = None
+        key = (snapshot.versions["borrows"], snapshot.versions["users"], rates_signature, today)
+        with self._lock:
+            if self._key != key:
+                self._table = self.compute(snapshot, today, load_book_fine_rates())
+                self._key = key
+            return self._table
+
+    def compute(self, snapshot, today, book_rates):
+        open_loans = [(username, borrow['book_id'], borrow['borrow_date'])
+                      for username, user_borrows in snapshot.borrows.items()
+                      for borrow in user_borrows if not borrow['return_date']]
+        usernames, book_ids, borrow_dates = (list(column) for column in zip(*open_loans)) if open_loans else ([], [], [])
+        rules = {username: ROLE_FINE_RULES.get(user['role'], DEFAULT_FINE_RULE)
+                 for username, user in snapshot.users.items()}
+        if np is not None and open_loans:
+            due_dates, days_late, fines = self._price_arrays(usernames, book_ids, borrow_dates, rules, book_rates, today)
+        else:
+            due_dates, days_late, fines = self._price_loop(usernames, book_ids, borrow_dates, rules, book_rates, today)
+        rows_by_user, totals = {}, Counter()
+        for row, username in enumerate(usernames):
+            rows_by_user.setdefault(username, []).append(row)
+            totals[username] += fines[row]
+        return FineTable(today, usernames, book_ids, due_dates, days_late, fines, rows_by_user,
+                         {username: total for username, total in totals.items() if total})
+
+    def _price_arrays(self, usernames, book_ids, borrow_dates, rules, book_rates, today):
+        # One rule lookup per distinct borrower and book, then everything is per-column
+        users, user_codes = np.unique(np.array(usernames), return_inverse=True)
+        user_rules = np.array([rules.get(username, DEFAULT_FINE_RULE) for username in users], dtype=np.int64)
+        rate, grace, cap = (user_rules[user_codes, i] for i in range(3))
+        if book_rates:
+            books, book_codes = np.unique(np.array(book_ids), return_inverse=True)
+            overrides = np.array([book_rates.get(book_id, (-1, -1)) for book_id in books], dtype=np.int64)[book_codes]
+            override = (overrides[:, 0] >= 0) & (rate > 0)
+            rate = np.where(override, overrides[:, 0], rate)
+            cap = np.where(override, overrides[:, 1], cap)
+        days = np.array(borrow_dates, dtype="U10")
+        try:
+            borrowed = days.astype("datetime64[D]")
+        except ValueError:
+            borrowed = np.array([self._parse_day(day) for day in days.tolist()], dtype="datetime64[D]")
+        due = borrowed + np.timedelta64(LOAN_PERIOD_DAYS, "D")
+        late = (np.datetime64(today) - due).astype(np.int64)
+        late = np.where(np.isnat(due) | (late < 0), 0, late)
+        fines = np.minimum(np.maximum(late - grace, 0) * rate, cap)
+        return np.datetime_as_string(due).tolist(), late.tolist(), fines.tolist()
+
+    def _price_loop(self, usernames, book_ids, borrow_dates, rules, book_rates, today):
+        today = datetime.strptime(today, "%Y-%m-%d")
+        due_dates, days_late, fines = [], [], []
+        for username, book_id, borrow_date in zip(usernames, book_ids, borrow_dates):
+            rate, grace, cap = rules.get(username, DEFAULT_FINE_RULE)
+            if book_id in book_rates and rate > 0:
+                rate, cap = book_rates[book_id]
+            try:
+                due = datetime.strptime(borrow_date[:10], "%Y-%m-%d") + timedelta(days=LOAN_PERIOD_DAYS)
+            except ValueError:
+                due_dates.append("NaT")
+                days_late.append(0)
+                fines.append(0)
+                continue
+            late = max(0, (today - due).days)
+            due_dates.append(due.strftime("%Y-%m-%d"))
+            days_late.append(late)
+            fines.append(min(max(late - grace, 0) * rate, cap))
+        return due_dates, days_late, fines
+
+    @staticmethod
+    def _parse_day(day):
+        try:
+            return np.datetime64(day, "D")
+        except ValueError:
+            return np.datetime64("NaT")
+
+    def for_user(self, username):
+        """{book_id: {'due', 'days_late', 'fine'}} for the user's open loans"""
+        table = self.table()
+        return {table.book_ids[row]: {'due': table.due_dates[row], 'days_late': table.days_late[row],
+                                      'fine': table.fines[row]}
+                for row in table.rows_by_user.get(username, ())}
+
+    def overdue(self):
+        """Overdue loans as row dicts, largest fine (then longest overdue) first"""
+        table = self.table()
+        rows = [row for row, late in enumerate(table.days_late) if late > 0]
+        rows.sort(key=lambda row: (-table.fines[row], -table.days_late[row], table.usernames[row]))
+        return [{'username': table.usernames[row], 'book_id': table.book_ids[row], 'due': table.due_dates[row],
+                 'days_late': table.days_late[row], 'fine': table.fines[row]} for row in rows]
+
+fine_engine = FineEngine()
+
+# ============= LIVE AVAILABILITY FEED =============
+
+STREAM_BUFFER_SIZE = 256        # pending book deltas per client before it must resync
+STREAM_POLL_SECONDS = 1.0
+STREAM_HEARTBEAT_SECONDS = 15
+# Every open stream holds a request thread, so a process serves at most
+# STREAM_MAX_CLIENTS of them; more get a 503 telling them to retry in
+# STREAM_REFUSED_RETRY_MS. A stream also ends after STREAM_MAX_SECONDS and
+# the browser reconnects, so streams don't pin threads forever.
+STREAM_MAX_CLIENTS = int(os.environ.get("LIBRARY_STREAM_MAX_CLIENTS", 100))
+STREAM_MAX_SECONDS = 300
+STREAM_REFUSED_RETRY_MS = 30000
+AVAILABILITY_FIELDS = ("Available", "Borrowed", "TotalCopies")
+
+class AvailabilitySubscriber:
+    """One /books/stream client's pending deltas, coalesced per book"""
+
+    __slots__ = ("pending", "overflowed")
+
+    def __init__(self):
+        self.pending = {}
+        self.overflowed = False
+
+class AvailabilityFeed:
+    """In-process pub/sub of availability deltas for /books/stream.
+
+    Each client only keeps the latest delta per book, and at most
+    STREAM_BUFFER_SIZE of them: a client that falls further behind is told
+    to resync (reload) instead of holding memory for it.
+    """
+
+    def __init__(self, buffer_size=STREAM_BUFFER_SIZE, max_subscribers=STREAM_MAX_CLIENTS):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._condition = threading.Condition()
+        self._subscribers = set()
+
+    def subscribe(self):
+        """A new subscriber, or None when max_subscribers are already connected"""
+        with self._condition:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = AvailabilitySubscriber()
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._condition:
+            self._subscribers.discard(subscriber)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def publish(self, deltas):
+        with self._condition:
+            for subscriber in self._subscribers:
+                if subscriber.overflowed:
+                    continue
+                for delta in deltas:
+                    subscriber.pending[delta['book_id']] = delta
+                if len(subscriber.pending) > self.buffer_size:
+                    subscriber.pending.clear()
+                    subscriber.overflowed = True
+            self._condition.notify_all()
+
+    def wait(self, subscriber, timeout):
+        """(deltas, overflowed) for subscriber, waiting up to timeout for some"""
+        with self._condition:
+            if not subscriber.pending and not subscriber.overflowed:
+                self._condition.wait(timeout)
+            deltas, overflowed = list(subscriber.pending.values()), subscriber.overflowed
+            subscriber.pending = {}
+            subscriber.overflowed = False
+            return deltas, overflowed
+
+availability_feed = AvailabilityFeed()
+
+@on_snapshot_change
+def publish_availability(old, new, changes):
+    if "books" not in changes or old.versions["books"] is None or not availability_feed.has_subscribers():
+        return
+    deltas = []
+    for book_id in changes["books"]:
+        book, before = new.books.get(book_id), old.books.get(book_id)
+        if book is None:
+            deltas.append({'book_id': book_id, 'deleted': True})
+        elif before is None or any(before[field] != book[field] for field in AVAILABILITY_FIELDS):
+            deltas.append({'book_id': book_id, **{field: book[field] for field in AVAILABILITY_FIELDS}})
+    if deltas:
+        availability_feed.publish(deltas)
+
+def availability_events(subscriber):
+    """Server-sent events for a subscriber until the client disconnects or
+    STREAM_MAX_SECONDS have passed (the browser then reconnects).
+
+    Each poll also refreshes the snapshot, so commits made by other worker
+    processes reach this process's subscribers within STREAM_POLL_SECONDS.
+    """
+    try:
+        yield "retry: 3000\n\n"
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < STREAM_MAX_SECONDS:
+            refresh_snapshot()
+            deltas, overflowed = availability_feed.wait(subscriber, STREAM_POLL_SECONDS)
+            if overflowed:
+                yield "event: resync\ndata: {}\n\n"
+            if deltas:
+                yield f"event: availability\ndata: {json.dumps(deltas)}\n\n"
+            if overflowed or deltas:
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= STREAM_HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+    finally:
+        availability_feed.unsubscribe(subscriber)
+
+# ============= WEB DECORATORS =============
+
+def login_required(f):
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'username' not in session:
+            flash('Please login first!', 'error')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'username' not in session:
+            flash('Please login first!', 'error')
+            return redirect(url_for('login'))
+        if session.get('role') != 'admin':
+            flash('Access denied! Admin role required.', 'error')
+            return redirect(url_for('dashboard'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ============= RATE LIMITING =============
+
+# A script hammering /login, /register or /borrow/<id> makes the app hash
+# passwords, reload the users file or rewrite the data files on every hit,
+# starving everyone else. Each limited route has a token bucket per client
+# IP and one per user (the session user, or the username being registered):
+# a bucket holds `burst` requests and refills at `per_minute`. A login is
+# only charged to its IP up front; the account's bucket is charged by
+# login() after a wrong password, so guessing from many addresses gets 429s
+# but can never lock the owner out - a correct password always gets in.
+# On top of that at most MAX_CONCURRENT_WRITES mutating
+# requests (POSTs, and the borrow/return/delete links) run at once in a
+# process; writes are serialised by the write lock anyway, so more would
+# only tie up threads that reads could use. Logins and registrations hash
+# passwords rather than queue on the write lock, so they draw on a pool of
+# their own (MAX_CONCURRENT_LOGINS) and a burst of logins can't turn
+# borrows and returns away. Both checks run in the first before_request
+# hook, ahead of the snapshot refresh, so a rejected request touches no
+# file: it gets a 429 with Retry-After. The limits are per process, so N
+# workers allow up to N times the budget.
+# LIBRARY_RATE_LIMITS=off turns both off (e.g. for load tests).
+#
+# Buckets are keyed on the address the request came from. Behind a reverse
+# proxy that is the proxy's, so every client would share one bucket: set
+# LIBRARY_PROXY_HOPS to the number of proxies in front of the app and the
+# client address is taken from X-Forwarded-For instead, trusting only the
+# entries those proxies appended (werkzeug's ProxyFix). Leave it at 0 when
+# clients connect directly, or anyone can pick their own address.
+
+RATE_LIMITS_ENABLED = os.environ.get("LIBRARY_RATE_LIMITS", "on").lower() not in ("off", "0", "false")
+MAX_CONCURRENT_WRITES = int(os.environ.get("LIBRARY_MAX_CONCURRENT_WRITES", 4))
+MAX_CONCURRENT_LOGINS = int(os.environ.get("LIBRARY_MAX_CONCURRENT_LOGINS", 2))
+PROXY_HOPS = int(os.environ.get("LIBRARY_PROXY_HOPS", 0))
+RATE_LIMIT_MAX_BUCKETS = 50_000
+
+if PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+RateLimit = namedtuple("RateLimit", "burst per_minute methods", defaults=(("POST",),))
+
+ROUTE_RATE_LIMITS = {
+    'login': RateLimit(burst=10, per_minute=20),
+    'register': RateLimit(burst=3, per_minute=5),
+    'change_password': RateLimit(burst=5, per_minute=10),
+    'borrow_book': RateLimit(burst=20, per_minute=60, methods=("GET",)),
+    'return_book': RateLimit(burst=20, per_minute=60, methods=("GET",)),
+    'batch_checkout': RateLimit(burst=10, per_minute=30),
+    # Wrong passwords per account, charged by login() after the check
+    'failed_login': RateLimit(burst=5, per_minute=5),
+}
+# Routes that change data on a GET; every POST counts as mutating
+MUTATING_GET_ENDPOINTS = {'borrow_book', 'return_book', 'delete_book'}
+# Mutating routes counted against MAX_CONCURRENT_LOGINS instead of MAX_CONCURRENT_WRITES
+LOGIN_ENDPOINTS = {'login', 'register'}
+
+class RateLimiter:
+    """Token buckets per (kind, client, endpoint) and the concurrency caps, with hit counts"""
+
+    def __init__(self, max_writes=MAX_CONCURRENT_WRITES, max_logins=MAX_CONCURRENT_LOGINS,
+                 max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = {}           # (kind, client, endpoint) -> (tokens, monotonic time of last update)
+        self.max_buckets = max_buckets
+        self.slots = {'writes': max_writes, 'logins': max_logins}
+        self.in_flight = Counter()  # 'writes' | 'logins' -> requests running
+        self.allowed = Counter()    # endpoint -> requests let through
+        self.limited = Counter()    # (endpoint, 'ip' | 'user' | 'concurrency') -> requests refused
+
+    def acquire(self, endpoint, keys, limit):
+        """Take a token from every key's bucket; returns 0, or seconds until all of them have one"""
+        now = time.monotonic()
+        rate = limit.per_minute / 60
+        with self._lock:
+            if len(self.buckets) >= self.max_buckets:
+                self._prune(now)
+            levels = []
+            for key in keys:
+                tokens, updated = self.buckets.get(key, (limit.burst, now))
+                levels.append(min(limit.burst, tokens + (now - updated) * rate))
+            short = [(key, level) for key, level in zip(keys, levels) if level < 1]
+            if short:
+                for key, level in short:
+                    self.limited[endpoint, key[0]] += 1
+                return max((1 - level) / rate for key, level in short)
+            for key, level in zip(keys, levels):
+                self.buckets[key] = (level - 1, now)
+            self.allowed[endpoint] += 1
+            return 0
+
+    def _prune(self, now):
+        """Forget buckets that have refilled (a new one starts full anyway), then the stalest"""
+        for key, (tokens, updated) in list(self.buckets.items()):
+            limit = ROUTE_RATE_LIMITS.get(key[2])
+            if limit is None or tokens + (now - updated) * limit.per_minute / 60 >= limit.burst:
+                del self.buckets[key]
+        if len(self.buckets) > self.max_buckets * 3 // 4:
+            stalest = sorted(self.buckets, key=lambda key: self.buckets[key][1])
+            for key in stalest[:len(stalest) - self.max_buckets // 2]:
+                del self.buckets[key]
+
+    def enter(self, pool, endpoint):
+        """Take a slot in the 'writes' or 'logins' pool; False when all are in use"""
+        with self._lock:
+            if self.in_flight[pool] >= self.slots[pool]:
+                self.limited[endpoint, 'concurrency'] += 1
+                return False
+            self.in_flight[pool] += 1
+            return True
+
+    def leave(self, pool):
+        with self._lock:
+            self.in_flight[pool] -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': RATE_LIMITS_ENABLED,
+                'buckets': len(self.buckets),
+                'writes_in_flight': self.in_flight['writes'],
+                'max_concurrent_writes': self.slots['writes'],
+                'logins_in_flight': self.in_flight['logins'],
+                'max_concurrent_logins': self.slots['logins'],
+                'proxy_hops': PROXY_HOPS,
+                'allowed': dict(self.allowed),
+                'limited': {f"{endpoint}:{kind}": count for (endpoint, kind), count in self.limited.items()},
+            }
+
+rate_limiter = RateLimiter()
+
+def too_many_requests(wait):
+    retry_after = max(1, math.ceil(wait))
+    if request.is_json:
+        response = jsonify(error='Too many requests', retry_after=retry_after)
+    else:
+        response = Response(f"Too many requests - try again in {retry_after}s.\n", mimetype='text/plain')
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.before_request
+def enforce_rate_limits():
+    if not RATE_LIMITS_ENABLED:
+        return None
+    endpoint = request.endpoint
+    limit = ROUTE_RATE_LIMITS.get(endpoint)
+    if limit is not None and request.method in limit.methods:
+        keys = [('ip', request.remote_addr, endpoint)]
+        username = session.get('username')
+        if username is None and endpoint == 'register':
+            username = request.form.get('username', '').strip()
+        if username:
+            keys.append(('user', username, endpoint))
+        wait = rate_limiter.acquire(endpoint, keys, limit)
+        if wait:
+            return too_many_requests(wait)
+    if request.method == 'POST' or endpoint in MUTATING_GET_ENDPOINTS:
+        pool = 'logins' if endpoint in LOGIN_ENDPOINTS else 'writes'
+        if not rate_limiter.enter(pool, endpoint):
+            return too_many_requests(1)
+        g.slot_pool = pool
+    return None
+
+def charge_failed_login(username):
+    """Count a wrong password against the account; returns 0, or seconds to wait"""
+    if not RATE_LIMITS_ENABLED or not username:
+        return 0
+    return rate_limiter.acquire('failed_login', [('user', username, 'failed_login')],
+                                ROUTE_RATE_LIMITS['failed_login'])
+
+@app.teardown_request
+def release_write_slot(exc):
+    pool = g.pop('slot_pool', None)
+    if pool is not None:
+        rate_limiter.leave(pool)
+
+# ============= REQUEST PROFILER =============
+
+PROFILE_RING_SIZE = 20
+PROFILE_TOP_FUNCTIONS = 25
+# Functions whose cumulative time is pulled out on /admin/profiles, to see at a
+# glance whether a slow page spent its time loading data or rendering
+PROFILE_HIGHLIGHTS = ("refresh_snapshot", "load_from_file", "load_users",
+                      "load_borrows", "render_template_string", "commit")
+
+_profiles = deque(maxlen=PROFILE_RING_SIZE)
+_profile_ids = itertools.count(1)
+
+def profile_requested():
+    """Admins opt a single request in with ?_profile=1 or an X-Profile: 1 header"""
+    return (session.get('role') == 'admin' and
+            (request.args.get('_profile') == '1' or request.headers.get('X-Profile') == '1'))
+
+def function_label(func):
+    filename, line, name = func
+    if filename == '~':  # builtins have no file
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+def summarize_profile(stats):
+    """Top cumulative functions and the PROFILE_HIGHLIGHTS totals of a pstats.Stats"""
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    top = [{
+        'function': function_label(func),
+        'calls': nc,
+        'primitive_calls': cc,
+        'tottime': tt,
+        'cumtime': ct,
+    } for func, (cc, nc, tt, ct, callers) in rows[:PROFILE_TOP_FUNCTIONS]]
+    highlights = {}
+    for (filename, line, name), (cc, nc, tt, ct, callers) in rows:
+        if name in PROFILE_HIGHLIGHTS and name not in highlights:
+            highlights[name] = {'calls': nc, 'cumtime': ct}
+    return top, highlights
+
+@app.before_request
+def start_request_profile():
+    if not profile_requested():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is already active on this interpreter
+        return
+    g.profiler = profiler
+    g.profile_started = datetime.now()
+
+@app.after_request
+def finish_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    top, highlights = summarize_profile(stats)
+    profile_id = next(_profile_ids)
+    _profiles.appendleft({
+        'id': profile_id,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'username': session.get('username'),
+        'status': response.status_code,
+        'started': g.profile_started.strftime("%Y-%m-%d %H:%M:%S"),
+        'total_time': stats.total_tt,
+        'total_calls': stats.total_calls,
+        'top': top,
+        'highlights': highlights,
+        'raw': marshal.dumps(stats.stats),  # same format as pstats.dump_stats()
+    })
+    response.headers['X-Profile-Id'] = str(profile_id)
+    return response
+
+def get_profile(profile_id):
+    for profile in list(_profiles):
+        if profile['id'] == profile_id:
+            return profile
+    return None
+
+# ============= MEMORY PROFILER =============
+
+# Opt-in: tracing starts from /admin/memory, or at launch with the standard
+# PYTHONTRACEMALLOC=<frames> environment variable. Tracing slows every
+# allocation down, so it stays off unless someone is looking.
+
+TRACEMALLOC_FRAMES = 25
+MEMORY_TOP_FUNCTIONS = 20
+# A dataset that keeps changing is re-walked at most this often for /admin/metrics
+DATASET_SIZE_MAX_AGE = 300
+
+_memory_lock = threading.Lock()
+_memory_baseline = {}           # {'snapshot': tracemalloc.Snapshot, 'taken': str}
+_dataset_sizes = {}             # name -> (version, bytes, monotonic time sized)
+
+def deep_sizeof(root):
+    """Approximate bytes reachable from root, counting shared objects once.
+
+    Follows gc.get_referents() so mapping proxies, tuples, Counters and slot
+    objects are all covered; classes, modules and functions are not counted.
+    """
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        objects = []
+        for obj in pending:
+            if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            objects.append(obj)
+        pending = gc.get_referents(*objects)
+    return size
+
+def dataset_memory(max_age=DATASET_SIZE_MAX_AGE):
+    """{name: {'records', 'bytes', 'sized_version'}} for the current snapshot.
+
+    A dataset is re-walked only when its version changed and its estimate is
+    over max_age seconds old, so 'bytes' may belong to an older version
+    ('sized_version'); max_age=0 sizes every changed dataset now.
+    """
+    snapshot = current_snapshot()
+    now = time.monotonic()
+    estimates = {}
+    for name in DATASETS:
+        data = getattr(snapshot, name)
+        version = snapshot.versions[name]
+        cached = _dataset_sizes.get(name)
+        if cached is None or (cached[0] != version and now - cached[2] >= max_age):
+            cached = _dataset_sizes[name] = (version, deep_sizeof(data), now)
+        estimates[name] = {'records': len(data), 'bytes': cached[1], 'sized_version': cached[0]}
+    return estimates
+
+def index_memory():
+    """Bytes held by each derived index; walks every index, so only on demand"""
+    return {
+        'facets': deep_sizeof(facet_index),
+        'trigrams': deep_sizeof(trigram_index),
+        'autocomplete': deep_sizeof(prefix_index),
+        'loan_counters': deep_sizeof(loan_counters),
+        'borrowed_together': deep_sizeof(cooccurrence_index),
+        'user_directory': deep_sizeof(user_directory),
+        'branches': deep_sizeof(branch_index),
+        'book_loans': deep_sizeof(book_loan_index),
+    }
+
+@functools.lru_cache(maxsize=None)
+def function_spans():
+    """Sorted (first line, last line, qualified name) of every def in this file"""
+    with open(__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    spans = []
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = prefix + child.name
+                if not isinstance(child, ast.ClassDef):
+                    spans.append((child.lineno, child.end_lineno, name))
+                visit(child, name + ".")
+
+    visit(tree, "")
+    spans.sort()
+    return spans
+
+@functools.lru_cache(maxsize=4096)
+def function_at(lineno):
+    """Innermost function of this file containing lineno, or <module>"""
+    name = "<module>"
+    for first, last, qualname in function_spans():
+        if first > lineno:
+            break
+        if lineno <= last:
+            name = qualname
+    return name
+
+def allocations_by_function(snapshot):
+    """{function: [bytes, blocks]} attributing each live allocation to the most
+    recent frame inside this file; allocations that never pass through it
+    (Flask, Werkzeug internals) are summed under <other>"""
+    filename = os.path.abspath(__file__)
+    groups = {}
+    for stat in snapshot.statistics("traceback"):
+        name = "<other>"
+        for frame in reversed(stat.traceback):
+            if frame.filename == filename:
+                name = function_at(frame.lineno)
+                break
+        entry = groups.setdefault(name, [0, 0])
+        entry[0] += stat.size
+        entry[1] += stat.count
+    return groups
+
+def take_memory_snapshot():
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+def memory_report():
+    """Top allocating functions now, and their growth since the baseline"""
+    snapshot = take_memory_snapshot()
+    current = allocations_by_function(snapshot)
+    baseline = _memory_baseline.get('snapshot')
+    before = allocations_by_function(baseline) if baseline is not None else {}
+    rows = [{
+        'function': name,
+        'bytes': size,
+        'blocks': count,
+        'bytes_diff': size - before.get(name, (0, 0))[0],
+        'blocks_diff': count - before.get(name, (0, 0))[1],
+    } for name, (size, count) in current.items()]
+    for name, (size, count) in before.items():
+        if name not in current:
+            rows.append({'function': name, 'bytes': 0, 'blocks': 0,
+                         'bytes_diff': -size, 'blocks_diff': -count})
+    key = (lambda row: abs(row['bytes_diff'])) if baseline is not None else (lambda row: row['bytes'])
+    rows.sort(key=key, reverse=True)
+    return rows[:MEMORY_TOP_FUNCTIONS]
+
+def tracemalloc_status():
+    if not tracemalloc.is_tracing():
+        return {'tracing': False}
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'tracing': True,
+        'frames': tracemalloc.get_traceback_limit(),
+        'traced_bytes': current,
+        'peak_bytes': peak,
+        'overhead_bytes': tracemalloc.get_tracemalloc_memory(),
+        'baseline': _memory_baseline.get('taken'),
+    }
+
+# ============= BACKGROUND JOBS =============
+
+# Heavy admin work runs on a small in-process thread pool instead of a
+# request worker. Each job's state is persisted as one line in
+# JOBS_DIR/<id>.job, next to its result file, so any worker process can
+# report status and serve the result; progress is only live in the process
+# running the job.
+
+JOBS_DIR = "library_jobs"
+JOB_WORKERS = 2
+JOB_QUEUE_SIZE = 8
+JOBS_KEPT = 100
+JOB_FIELDS = ("job_id", "kind", "status", "progress", "username", "submitted", "finished", "message", "result", "pid")
+JOB_ACTIVE = ("queued", "running")
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """One unit of background work and its persisted state"""
+
+    PERSIST_INTERVAL = 1.0
+
+    def __init__(self, kind, username, params=None, **state):
+        # Millisecond timestamp first, so IDs sort in submission order
+        self.job_id = state.get("job_id") or f"{int(time.time() * 1000):011x}{uuid.uuid4().hex[:5]}"
+        self.kind = kind
+        self.username = username
+        self.params = params or {}
+        self.status = state.get("status", "queued")
+        self.progress = int(state.get("progress", 0))
+        self.submitted = state.get("submitted") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.finished = state.get("finished") or None
+        self.message = state.get("message", "")
+        self.result = state.get("result") or None
+        self.pid = int(state.get("pid") or os.getpid())
+        self.cancel_requested = threading.Event()
+        self._persisted_at = 0.0
+
+    def path(self, extension):
+        return os.path.join(JOBS_DIR, f"{self.job_id}.{extension}")
+
+    def result_path(self, filename):
+        """Where to write the downloadable result; filename is what the admin gets"""
+        self.result = filename
+        return self.path("result")
+
+    def update(self, done, total, message=None):
+        """Report progress; raises JobCancelled once cancellation was requested"""
+        if self.cancel_requested.is_set():
+            raise JobCancelled()
+        self.progress = min(99, done * 100 // total) if total else 0
+        if message is not None:
+            self.message = message
+        if time.monotonic() - self._persisted_at >= self.PERSIST_INTERVAL:
+            self.persist()
+
+    def persist(self):
+        self._persisted_at = time.monotonic()
+        values = [("" if getattr(self, field) is None else str(getattr(self, field))).replace("|", "/").replace("\n", " ")
+                  for field in JOB_FIELDS]
+        try:
+            atomic_write_lines(self.path("job"), ["|".join(values) + "\n"])
+        except Exception as e:
+            print(f"❌ Error saving job {self.job_id}: {e}")
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                values = f.readline().rstrip("\n").split("|")
+        except OSError:
+            return None
+        if len(values) != len(JOB_FIELDS):
+            return None
+        state = dict(zip(JOB_FIELDS, values))
+        try:
+            job = cls(state.pop("kind"), state.pop("username"), **state)
+        except ValueError:
+            return None
+        if job.status in JOB_ACTIVE and not process_alive(job.pid):
+            job.status, job.message = "failed", "Interrupted: the worker process exited"
+        return job
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'label': JOB_TYPES[self.kind][0] if self.kind in JOB_TYPES else self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'username': self.username,
+            'submitted': self.submitted,
+            'finished': self.finished,
+            'message': self.message,
+            'result': self.result if self.status == "done" else None,
+        }
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # exists but belongs to someone else, or no kill() here
+        return True
+    return True
+
+JOB_TYPES = {}
+
+def job_type(kind, label):
+    """Register func(job, params) -> summary message as a background job kind"""
+    def register(func):
+        JOB_TYPES[kind] = (label, func)
+        return func
+    return register
+
+class JobRunner:
+    """Fixed pool of worker threads fed by a bounded queue.
+
+    Threads start on the first submit in each process, so a server that
+    forks workers after import does not inherit dead threads.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_workers(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self.jobs = {}
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"library-job-{i}", daemon=True).start()
+
+    def submit(self, kind, username, params=None, prepare=None):
+        """Queue a job; returns it, or None when the queue is full.
+
+        prepare(job) runs before queueing, e.g. to save an uploaded file.
+        """
+        self._ensure_workers()
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        job = Job(kind, username, params)
+        if prepare is not None:
+            prepare(job)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            if prepare is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(job.path("input"))
+            return None
+        self.jobs[job.job_id] = job
+        job.persist()
+        self._prune()
+        return job
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job):
+        if job.cancel_requested.is_set():
+            return
+        job.status = "running"
+        job.persist()
+        try:
+            job.message = JOB_TYPES[job.kind][1](job, job.params) or "Done"
+            job.status, job.progress = "done", 100
+        except JobCancelled:
+            job.status, job.message = "cancelled", "Cancelled while running"
+        except Exception as e:
+            print(f"❌ Error in {job.kind} job {job.job_id}: {e}")
+            job.status, job.message = "failed", str(e)
+        finally:
+            job.finished = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            job.persist()
+            with contextlib.suppress(OSError):
+                os.remove(job.path("input"))
+
+    def get(self, job_id):
+        if not re.fullmatch(r"[0-9a-f]{16}", job_id):
+            return None
+        return self.jobs.get(job_id) or Job.load(os.path.join(JOBS_DIR, f"{job_id}.job"))
+
+    def all_jobs(self):
+        """All persisted jobs, newest first (this process's live progress included)"""
+        jobs = []
+        if os.path.isdir(JOBS_DIR):
+            for name in os.listdir(JOBS_DIR):
+                if name.endswith(".job"):
+                    job = self.jobs.get(name[:-4]) or Job.load(os.path.join(JOBS_DIR, name))
+                    if job is not None:
+                        jobs.append(job)
+        jobs.sort(key=lambda job: job.job_id, reverse=True)
+        return jobs
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or ask a running one to stop at its next progress update"""
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in JOB_ACTIVE:
+            return False
+        job.cancel_requested.set()
+        if job.status == "queued":
+            job.status, job.message = "cancelled", "Cancelled before it started"
+            job.finished = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            job.persist()
+        return True
+
+    def _prune(self):
+        for job in self.all_jobs()[JOBS_KEPT:]:
+            if job.status in JOB_ACTIVE:
+                continue
+            self.jobs.pop(job.job_id, None)
+            for extension in ("job", "result"):
+                with contextlib.suppress(OSError):
+                    os.remove(job.path(extension))
+
+job_runner = JobRunner()
+
+@job_type("stats", "Full statistics report")
+def run_stats_job(job, params):
+    """Per-book CSV recomputed from the full borrow history"""
+    snapshot = current_snapshot()
+    total_loans, open_loans, borrowers = Counter(), Counter(), {}
+    users = list(snapshot.borrows.items())
+    for i, (username, user_borrows) in enumerate(users):
+        for borrow in user_borrows:
+            total_loans[borrow['book_id']] += 1
+            if not borrow['return_date']:
+                open_loans[borrow['book_id']] += 1
+            borrowers.setdefault(borrow['book_id'], set()).add(username)
+        if i % 1000 == 0:
+            job.update(i, len(users) * 2, "Scanning borrow history")
+    mismatches = 0
+    books = list(snapshot.books.items())
+    with open(job.result_path("library_stats.csv"), "w", encoding="utf-8") as f:
+        f.write("book_id,title,author,year,total_copies,available,borrowed,open_loans,total_loans,unique_borrowers,consistent\n")
+        for i, (book_id, book) in enumerate(books):
+            consistent = (book['Available'] + book['Borrowed'] == book['TotalCopies'] and
+                          book['Borrowed'] == open_loans[book_id])
+            mismatches += not consistent
+            f.write(f"{book_id},{book['Title']},{book['Author']},{book['Year']},{book['TotalCopies']},"
+                    f"{book['Available']},{book['Borrowed']},{open_loans[book_id]},{total_loans[book_id]},"
+                    f"{len(borrowers.get(book_id, ()))},{'yes' if consistent else 'no'}\n")
+            if i % 1000 == 0:
+                job.update(len(books) + i, len(books) * 2, "Writing report")
+    return f"{len(books)} books, {sum(total_loans.values())} loans, {mismatches} inconsistent book(s)"
+
+@job_type("export", "Export catalogue and loans")
+def run_export_job(job, params):
+    """Zip of the books, borrows and branch files plus the user list (without passwords)"""
+    snapshot = current_snapshot()
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    with zipfile.ZipFile(job.result_path(f"library-export-{stamp}.zip"), "w", zipfile.ZIP_DEFLATED) as archive:
+        steps = (
+            (BOOKS_FILE, lambda: (book_line(book_id, book) for book_id, book in snapshot.books.items())),
+            (BORROWS_FILE, lambda: (
+                loan_line(username, borrow)
+                for username, user_borrows in snapshot.borrows.items() for borrow in user_borrows)),
+            ("library_users_roles.txt", lambda: (
+                f"{username}|{user['role']}\n" for username, user in snapshot.users.items())),
+        ) + tuple(
+            (f"{BRANCHES_DIR}/{branch}.txt", functools.partial(branch_shard_lines, inventory))
+            for branch, inventory in snapshot.branches.items()
+        )
+        for i, (name, lines) in enumerate(steps):
+            job.update(i, len(steps), f"Writing {name}")
+            with archive.open(name, "w") as f:
+                for line in lines():
+                    f.write(line.encode("utf-8"))
+    return f"Exported {len(snapshot.books)} books and {sum(map(len, snapshot.borrows.values()))} loans"
+
+@job_type("import", "Import books")
+def run_import_job(job, params):
+    """Add or update books from an uploaded file in the library_books.txt format.
+
+    Each line is id,title,author,year,copies (any extra Available/Borrowed
+    columns are ignored: those are derived from loans). Rows follow the
+    add/update book rules; all valid rows are saved in one write. Rows are
+    checked against a snapshot first; the write lock is only held to re-check
+    the books that changed since and to commit.
+    """
+    with open(job.path("input"), "r", encoding="utf-8-sig") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    rows, report = [], []
+    for i, line in enumerate(lines, 1):
+        parts = [part.strip() for part in line.split(",")]
+        if len(parts) not in (5, 7) or not parts[0]:
+            report.append((i, parts[0] if parts else "", "Expected id,title,author,year,copies"))
+            continue
+        try:
+            copies = int(parts[4])
+        except ValueError:
+            report.append((i, parts[0], "Invalid number for copies"))
+            continue
+        if copies <= 0:
+            report.append((i, parts[0], "Number of copies must be positive"))
+            continue
+        rows.append((i, parts[0], parts[1], parts[2], parts[3], copies))
+        if i % 1000 == 0:
+            job.update(i, len(lines) * 2, "Validating rows")
+    
+    def apply_row(book, title, author, year, copies):
+        """(new record or None, result) of one row against the book's record"""
+        if book is None:
+            return freeze_record({"Title": title, "Author": author, "Year": year,
+                                  "TotalCopies": copies, "Available": copies, "Borrowed": 0}), "Added"
+        if copies < book['Borrowed']:
+            return None, "Total copies cannot be less than borrowed copies"
+        return freeze_record({**book, "Title": title, "Author": author, "Year": year,
+                              "TotalCopies": copies, "Available": copies - book['Borrowed']}), "Updated"
+    
+    # Plan every row against a snapshot (and the rows before it), with no lock held
+    books = refresh_snapshot().books
+    planned, plans = {}, []
+    for n, (i, book_id, *fields) in enumerate(rows):
+        base = planned.get(book_id, books.get(book_id))
+        record, result = apply_row(base, *fields)
+        if record is not None:
+            planned[book_id] = record
+        plans.append((i, book_id, fields, base, record, result))
+        if n % 1000 == 0:
+            job.update(len(lines) + n, len(lines) * 2, "Checking rows")
+    
+    job.update(1, 1, "Saving")
+    results, changed = [], False
+    with library_transaction() as txn:
+        for i, book_id, fields, base, record, result in plans:
+            book = txn.books.get(book_id)
+            if book is not base and book != base:  # changed by someone else meanwhile
+                record, result = apply_row(book, *fields)
+            if record is not None:
+                txn.put_book(book_id, record)
+                changed = True
+            results.append((i, book_id, result))
+        if changed and not txn.commit():
+            raise RuntimeError("Error saving data")
+    
+    added = sum(result == "Added" for i, book_id, result in results)
+    updated = sum(result == "Updated" for i, book_id, result in results)
+    report.extend(results)
+    report.sort()
+    with open(job.result_path("import-report.csv"), "w", encoding="utf-8") as f:
+        f.write("line,book_id,result\n")
+        f.writelines(f"{i},{book_id},{result}\n" for i, book_id, result in report)
+    return f"{added} added, {updated} updated, {len(report) - added - updated} rejected"
+
+@job_type("compact", "Compact borrow history")
+def run_compact_job(job, params):
+    """Move returned loans older than params['days'] out of the borrows file.
+
+    The moved lines are appended to library_borrows_archive.txt and are also
+    the job's downloadable result. Open loans are never touched. Loans are
+    scanned from a snapshot; the write lock is only held to rescan the
+    patrons whose loans changed since and to save.
+    """
+    days = int(params.get('days', 365))
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    
+    def split(username, user_borrows):
+        """(loans kept, archive lines) of one patron"""
+        remaining, archived = [], []
+        for borrow in user_borrows:
+            if borrow['return_date'] and borrow['return_date'] < cutoff:
+                archived.append(loan_line(username, borrow))
+            else:
+                remaining.append(borrow)
+        return (remaining if archived else user_borrows), archived
+    
+    snapshot = refresh_snapshot()
+    kept, archived = {}, {}
+    users = list(snapshot.borrows.items())
+    for i, (username, user_borrows) in enumerate(users):
+        kept[username], lines = split(username, user_borrows)
+        if lines:
+            archived[username] = lines
+        if i % 1000 == 0:
+            job.update(i, len(users), "Scanning loans")
+    
+    job.update(1, 1, "Saving")
+    with library_transaction() as txn:
+        for username in changed_keys(snapshot.borrows, txn.borrows):
+            kept.pop(username, None)
+            archived.pop(username, None)
+            if username in txn.borrows:
+                kept[username], lines = split(username, txn.borrows[username])
+                if lines:
+                    archived[username] = lines
+        if not archived:
+            return f"No returned loans older than {days} days"
+        lines = [line for user_lines in archived.values() for line in user_lines]
+        with open(job.result_path("archived-loans.txt"), "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        txn.replace_dataset("borrows", {username: loans for username, loans in kept.items() if loans})
+        if not txn.commit():
+            raise RuntimeError("Error saving borrows")
+        # After the commit, so a failed save can't leave loans in both files
+        # (if this append fails the job's result file still holds them), and
+        # before the write lock is released, so a reader holding it sees each
+        # loan in exactly one of the two files
+        with open(BORROWS_ARCHIVE_FILE, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+    return f"Archived {len(lines)} returned loans older than {days} days"
+
+@job_type("rollups", "Backfill circulation rollups")
+def run_rollups_job(job, params):
+    """Rebuild the circulation rollups from the archive file and the current loans.
+
+    The snapshot and the archive's length are taken together under the write
+    lock (compaction moves loans from one to the other under it), then both
+    are counted with no lock held. Loans published meanwhile are replayed
+    onto the new rollups under the publish lock just before the swap.
+    """
+    with dataset_versions.write_lock:
+        snapshot = refresh_snapshot()
+        archive_bytes = os.path.getsize(BORROWS_ARCHIVE_FILE) if os.path.exists(BORROWS_ARCHIVE_FILE) else 0
+    users = list(snapshot.borrows.items())
+    
+    def rows():
+        if archive_bytes:
+            done = 0
+            with open(BORROWS_ARCHIVE_FILE, "rb") as f:
+                for i, line in enumerate(f):
+                    done += len(line)
+                    if done > archive_bytes:  # appended after the snapshot
+                        break
+                    parts = line.decode("utf-8").strip().split("|")
+                    if len(parts) >= 4:
+                        yield parts[1], parts[2], None if parts[3] == "None" else parts[3]
+                    if i % 10000 == 0:
+                        job.update(done, archive_bytes, f"Reading {BORROWS_ARCHIVE_FILE}")
+        for i, (username, user_borrows) in enumerate(users):
+            for borrow in user_borrows:
+                yield borrow['book_id'], borrow['borrow_date'], borrow['return_date']
+            if i % 1000 == 0:
+                job.update(i, len(users), "Counting current loans")
+    
+    rebuilt = CirculationRollups()
+    rebuilt.backfill(rows())
+    with _publish_lock:
+        events = catch_up_loans(snapshot)
+        rebuilt.apply(events)
+        circulation_rollups.replace_with(rebuilt)
+    return (f"Rollups rebuilt from {archive_bytes} archived bytes and {len(users)} patrons' loans"
+            f" ({len(events)} loan events caught up)")
+
+@job_type("recommendations", 'Rebuild "borrowed together"')
+def run_recommendations_job(job, params):
+    """Recompute the co-occurrence counts from the full borrow history.
+
+    The counts are built from a snapshot without holding any lock; loans
+    published meanwhile are replayed onto them under the publish lock just
+    before they replace the live index.
+    """
+    refresh_snapshot()
+    snapshot = current_snapshot()
+    job.update(0, 2, f"Counting {len(snapshot.borrows)} patrons' histories")
+    rebuilt = CooccurrenceIndex()
+    rebuilt.rebuild(snapshot.borrows)
+    job.update(1, 2, "Catching up with new loans")
+    with _publish_lock:
+        events = catch_up_loans(snapshot)
+        rebuilt.apply(events)
+        cooccurrence_index.replace_with(rebuilt)
+    return (f'"Borrowed together" rebuilt from {len(rebuilt.user_books)} patrons\' histories'
+            f' ({len(events)} loan events caught up)')
+
+# ============= RECONCILER =============
+
+# Book counts and loans are two files that can drift apart (hand edits, a
+# crash between the borrows and books writes, old bugs). The reconciler joins
+# them by book_id without loading either file: a full run hash-partitions
+# both into temp files of at most RECONCILE_PARTITION_BYTES and checks one
+# partition at a time. Every commit appends the book IDs it changed to
+# DIRTY_LOG_FILE, so an incremental run only checks those books - against
+# the snapshot and the book-to-loans index when this process has them
+# loaded (the app), or by streaming the files otherwise (the CLI).
+
+DIRTY_LOG_FILE = "library_dirty.log"
+RECONCILE_CHECKPOINT_FILE = "library_reconcile.chk"
+RECONCILE_PARTITION_BYTES = 32 * 1024 * 1024
+
+def mark_dirty(base, written, touched):
+    """Append the book IDs a commit changed to the dirty log (under the write lock)"""
+    book_ids = set()
+    if "books" in written:
+        keys = touched.get("books")
+        book_ids.update(keys if keys is not None else changed_keys(base.books, written["books"][1]))
+    if "borrows" in written:
+        new_borrows = written["borrows"][1]
+        keys = touched.get("borrows")
+        usernames = keys if keys is not None else changed_keys(base.borrows, new_borrows)
+        book_ids.update(borrow['book_id'] for kind, username, borrow in
+                        loan_events(base.borrows, new_borrows, usernames))
+    if not book_ids:
+        return
+    try:
+        with open(DIRTY_LOG_FILE, "a", encoding="utf-8") as f:
+            f.writelines(f"{book_id}\n" for book_id in book_ids)
+    except Exception as e:
+        print(f"❌ Error writing dirty log: {e}")
+
+def take_dirty_book_ids():
+    """Book IDs changed since the last run; the log is emptied as they are taken"""
+    with dataset_versions.write_lock:
+        try:
+            with open(DIRTY_LOG_FILE, "r+", encoding="utf-8") as f:
+                book_ids = {line.strip() for line in f if line.strip()}
+                f.truncate(0)
+        except FileNotFoundError:
+            book_ids = set()
+    return book_ids
+
+def return_dirty_book_ids(book_ids):
+    """Put book IDs back after a failed run so the next one checks them"""
+    with dataset_versions.write_lock:
+        with open(DIRTY_LOG_FILE, "a", encoding="utf-8") as f:
+            f.writelines(f"{book_id}\n" for book_id in book_ids)
+
+def iter_book_rows(filename=BOOKS_FILE):
+    """(book_id, total, available, borrowed) per line, streamed; bad lines are skipped"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split(",")
+            if len(parts) == 7:
+                try:
+                    yield parts[0], int(parts[4]), int(parts[5]), int(parts[6])
+                except ValueError:
+                    continue
+
+def iter_open_loans(filename=BORROWS_FILE):
+    """(username, book_id) of every open loan, streamed"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split("|")
+            if len(parts) >= 4 and parts[3] == "None":
+                yield parts[0], parts[1]
+
+def check_partition(book_rows, open_loans):
+    """Discrepancies between one partition's books and the open loans on them"""
+    loans, holders, found = Counter(), set(), []
+    for username, book_id in open_loans:
+        loans[book_id] += 1
+        if (username, book_id) in holders:
+            found.append({'kind': 'duplicate_open_loan', 'book_id': book_id,
+                          'detail': f"{username} has more than one open loan"})
+        holders.add((username, book_id))
+    seen = set()
+    for book_id, total, available, borrowed in book_rows:
+        seen.add(book_id)
+        if borrowed != loans[book_id]:
+            found.append({'kind': 'borrowed_mismatch', 'book_id': book_id,
+                          'detail': f"Borrowed is {borrowed} but {loans[book_id]} loans are open"})
+        if available + borrowed != total:
+            found.append({'kind': 'total_mismatch', 'book_id': book_id,
+                          'detail': f"Available {available} + Borrowed {borrowed} != TotalCopies {total}"})
+        if available < 0:
+            found.append({'kind': 'negative_available', 'book_id': book_id,
+                          'detail': f"Available is {available}"})
+    for book_id in sorted(loans.keys() - seen):
+        found.append({'kind': 'orphan_loans', 'book_id': book_id,
+                      'detail': f"{loans[book_id]} open loan(s) for a book that does not exist"})
+    return found
+
+def indexed_book_state(book_ids):
+    """(book rows, open loans) of the given books from memory, or None.
+
+    Reads the latest snapshot and book_loan_index together under the publish
+    lock, so both reflect the same commits. None when this process has not
+    loaded the data, or while startup indexing still lags the snapshot.
+    """
+    if current_snapshot().versions["borrows"] is None:
+        return None
+    refresh_snapshot()
+    with _publish_lock:
+        if _index_backlog is not None:
+            return None
+        books = _snapshot.books
+        rows = [(book_id, book['TotalCopies'], book['Available'], book['Borrowed'])
+                for book_id, book in ((book_id, books.get(book_id)) for book_id in book_ids) if book]
+        with book_loan_index._lock:
+            loans = []
+            for book_id in book_ids:
+                dates, usernames, book_loans = book_loan_index.by_book.get(book_id, ((), (), ()))
+                loans.extend((username, book_id) for username, loan in zip(usernames, book_loans)
+                             if not loan['return_date'])
+    return rows, loans
+
+def find_discrepancies(book_ids=None, progress=None):
+    """Join the books and borrows data by book_id and list what disagrees.
+
+    book_ids limits the check to those books (an incremental run), which are
+    looked up in memory when possible. A full run streams both files; over
+    RECONCILE_PARTITION_BYTES it is done as a grace hash join, so memory
+    stays bounded by one partition. progress(done, total) is called once per
+    partition.
+    """
+    if book_ids is not None:
+        state = indexed_book_state(book_ids)
+        if state is not None:
+            return check_partition(*state)
+        return check_partition((row for row in iter_book_rows() if row[0] in book_ids),
+                               (loan for loan in iter_open_loans() if loan[1] in book_ids))
+    size = sum(os.path.getsize(name) for name in (BOOKS_FILE, BORROWS_FILE) if os.path.exists(name))
+    partitions = max(1, -(-size // RECONCILE_PARTITION_BYTES))
+    if partitions == 1:
+        return check_partition(iter_book_rows(), iter_open_loans())
+    
+    found = []
+    with tempfile.TemporaryDirectory(prefix="reconcile-", dir=".") as directory:
+        def partition_files(prefix):
+            return [open(os.path.join(directory, f"{prefix}-{i}"), "w+", encoding="utf-8")
+                    for i in range(partitions)]
+        
+        def partition_of(book_id):
+            return zlib.crc32(book_id.encode("utf-8")) % partitions
+        
+        book_parts, loan_parts = partition_files("books"), partition_files("loans")
+        try:
+            for row in iter_book_rows():
+                book_parts[partition_of(row[0])].write("|".join(map(str, row)) + "\n")
+            for username, book_id in iter_open_loans():
+                loan_parts[partition_of(book_id)].write(f"{username}|{book_id}\n")
+            for i, (book_part, loan_part) in enumerate(zip(book_parts, loan_parts)):
+                book_part.seek(0)
+                loan_part.seek(0)
+                book_rows = ((book_id, int(total), int(available), int(borrowed))
+                             for book_id, total, available, borrowed
+                             in (line.rstrip("\n").split("|") for line in book_part))
+                open_loans = (line.rstrip("\n").split("|") for line in loan_part)
+                found.extend(check_partition(book_rows, open_loans))
+                if progress is not None:
+                    progress(i + 1, partitions)
+        finally:
+            for f in book_parts + loan_parts:
+                f.close()
+    return found
+
+def repair_discrepancies(found):
+    """Fix what find_discrepancies reported, re-checked on the latest data.
+
+    Open loans are the source of truth: orphan and duplicate open loans are
+    closed (returned now), then Borrowed is set to the open-loan count and
+    Available to TotalCopies - Borrowed (TotalCopies is raised if more
+    copies are out than it allows). Returns a list of repair descriptions,
+    or None if saving failed.
+    """
+    book_ids = {entry['book_id'] for entry in found}
+    if not book_ids:
+        return []
+    repairs = []
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with library_transaction() as txn:
+        open_loans = Counter()
+        for username, user_borrows in list(txn.borrows.items()):
+            holding = set()
+            for index, borrow in enumerate(user_borrows):
+                book_id = borrow['book_id']
+                if borrow['return_date'] or book_id not in book_ids:
+                    continue
+                if book_id not in txn.books:
+                    txn.update_loan(username, index, return_date=now)
+                    repairs.append(f"{book_id}: closed {username}'s open loan of a missing book")
+                elif book_id in holding:
+                    txn.update_loan(username, index, return_date=now)
+                    repairs.append(f"{book_id}: closed {username}'s duplicate open loan")
+                else:
+                    holding.add(book_id)
+                    open_loans[book_id] += 1
+        for book_id in sorted(book_ids):
+            book = txn.books.get(book_id)
+            if book is None:
+                continue
+            borrowed = open_loans[book_id]
+            total = max(book['TotalCopies'], borrowed)
+            if (book['Borrowed'], book['Available'], book['TotalCopies']) != (borrowed, total - borrowed, total):
+                txn.update_book(book_id, Borrowed=borrowed, Available=total - borrowed, TotalCopies=total)
+                repairs.append(f"{book_id}: Borrowed {book['Borrowed']}->{borrowed}; "
+                               f"Available {book['Available']}->{total - borrowed}; "
+                               f"TotalCopies {book['TotalCopies']}->{total}")
+        if repairs and not txn.commit():
+            return None
+    return repairs
+
+def reconcile(full=False, repair=False, progress=None):
+    """Check (and optionally repair) the books/borrows join.
+
+    Incremental unless full is set or no run has been checkpointed yet.
+    Returns (mode, discrepancies, repairs).
+    """
+    full = full or not os.path.exists(RECONCILE_CHECKPOINT_FILE)
+    dirty = take_dirty_book_ids()
+    try:
+        found = find_discrepancies(None if full else dirty, progress)
+        repairs = repair_discrepancies(found) if repair else []
+        if repairs is None:
+            raise RuntimeError("Error saving repairs")
+    except Exception:
+        return_dirty_book_ids(dirty)
+        raise
+    if found and not repair:
+        # Still wrong: keep them on the list for the next incremental run
+        return_dirty_book_ids({entry['book_id'] for entry in found})
+    mode = "full" if full else f"incremental ({len(dirty)} changed book(s))"
+    atomic_write_lines(RECONCILE_CHECKPOINT_FILE, [
+        f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}|{mode}|{len(found)}|{len(repairs)}\n"
+    ])
+    return mode, found, repairs
+
+def reconcile_main(argv):
+    """python librareay_webapp.py reconcile [--full] [--repair]"""
+    parser = argparse.ArgumentParser(prog="librareay_webapp.py reconcile",
+                                     description="Check Borrowed/Available counts against open loans.")
+    parser.add_argument("--full", action="store_true", help="check every book, not just those changed since the last run")
+    parser.add_argument("--repair", action="store_true", help="fix the discrepancies found")
+    args = parser.parse_args(argv)
+    mode, found, repairs = reconcile(full=args.full, repair=args.repair)
+    print(f"🔎 Reconcile ({mode}): {len(found)} discrepancy(ies)")
+    for entry in found:
+        print(f"   - {entry['book_id']}: {entry['kind']}: {entry['detail']}")
+    for repair in repairs:
+        print(f"   🔧 {repair}")
+    return 1 if found and not repairs else 0
+
+@job_type("reconcile", "Reconcile counts with loans")
+def run_reconcile_job(job, params):
+    mode, found, repairs = reconcile(full=params.get('full', False), repair=params.get('repair', False),
+                                     progress=lambda done, total: job.update(done, total, "Checking partitions"))
+    with open(job.result_path("reconcile-report.csv"), "w", encoding="utf-8") as f:
+        f.write("book_id,kind,detail\n")
+        f.writelines(f"{entry['book_id']},{entry['kind']},{entry['detail']}\n" for entry in found)
+        f.writelines(f",repaired,{repair}\n" for repair in repairs)
+    return f"{mode}: {len(found)} discrepancy(ies), {len(repairs)} repair(s)"
+
+# ============= HTML TEMPLATES =============
+
+BASE_HTML = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Library Management System</title>
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
+    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
+    <style>
+        .navbar-brand { font-weight: bold; }
+        .book-card { transition: transform 0.2s; }
+        .book-card:hover { transform: translateY(-2px); }
+        .stats-card { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; }
+        .available { color: #28a745; }
+        .borrowed { color: #dc3545; }
+        .my-borrowed { background-color: #fff3cd; border-left: 4px solid #ffc107; }
+        .btn-group-sm > .btn { padding: 0.25rem 0.5rem; font-size: 0.875rem; }
+    </style>
+</head>
+<body>
+    <nav class="navbar navbar-expand-lg navbar-dark bg-dark">
+        <div class="container">
+            <a class="navbar-brand" href="/dashboard">
+                <i class="fas fa-book"></i> Library System
+            </a>
+            
+            {% if session.username %}
+            <div class="navbar-nav ms-auto">
+                <span class="navbar-text me-3">
+                    <i class="fas fa-user"></i> {{ session.username }} ({{ session.role }})
+                </span>
+                <a class="nav-link" href="/my-books">
+                    <i class="fas fa-bookmark"></i> My Books
+                </a>
+                <a class="nav-link" href="/my-history">
+                    <i class="fas fa-history"></i> My History
+                </a>
+                <a class="nav-link" href="/branches">
+                    <i class="fas fa-map-marker-alt"></i> Branches
+                </a>
+                <a class="nav-link" href="/change-password">
+                    <i class="fas fa-key"></i> Change Password
+                </a>
+                <a class="nav-link" href="/logout">
+                    <i class="fas fa-sign-out-alt"></i> Logout
+                </a>
+            </div>
+            {% endif %}
+        </div>
+    </nav>
+
+    <div class="container mt-4">
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                {% for category, message in messages %}
+                    <div class="alert alert-{{ 'danger' if category == 'error' else 'success' }} alert-dismissible fade show">
+                        {{ message }}
+                        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
+                    </div>
+                {% endfor %}
+            {% endif %}
+        {% endwith %}
+
+        {% block content %}{% endblock %}
+    </div>
+
+    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
+</body>
+</html>'''
+
+LOGIN_HTML = '''<div class="row justify-content-center">
+    <div class="col-md-6">
+        <div class="card">
+            <div class="card-header">
+                <h4 class="mb-0"><i class="fas fa-sign-in-alt"></i> User Login</h4>
+            </div>
+            <div class="card-body">
+                <form method="POST">
+                    <div class="mb-3">
+                        <label for="username" class="form-label">Username</label>
+                        <input type="text" class="form-control" id="username" name="username" required>
+                    </div>
+                    <div class="mb-3">
+                        <label for="password" class="form-label">Password</label>
+                        <input type="password" class="form-control" id="password" name="password" required>
+                    </div>
+                    <button type="submit" class="btn btn-primary w-100">Login</button>
+                </form>
+                <hr>
+                <div class="text-center">
+                    <p>Don't have an account? <a href="/register">Register here</a></p>
+                    <p class="text-muted small">
+                        <i class="fas fa-info-circle"></i> 
+                        Default admin: username: admin, password: admin123
+                    </p>
+                </div>
+            </div>
+        </div>
+    </div>
+</div>'''
+
+REGISTER_HTML = '''<div class="row justify-content-center">
+    <div class="col-md-6">
+        <div class="card">
+            <div class="card-header">
+                <h4 class="mb-0"><i class="fas fa-user-plus"></i> User Registration</h4>
+            </div>
+            <div class="card-body">
+                <form method="POST">
+                    <div class="mb-3">
+                        <label for="username" class="form-label">Username</label>
+                        <input type="text" class="form-control" id="username" name="username" required>
+                    </div>
+                    <div class="mb-3">
+                        <label for="password" class="form-label">Password</label>
+                        <input type="password" class="form-control" id="password" name="password" required>
+                        <div class="form-text">Password must be at least 4 characters long.</div>
+                    </div>
+                    <div class="mb-3">
+                        <label for="confirm_password" class="form-label">Confirm Password</label>
+                        <input type="password" class="form-control" id="confirm_password" name="confirm_password" required>
+                    </div>
+                    <button type="submit" class="btn btn-success w-100">Register</button>
+                </form>
+                <hr>
+                <div class="text-center">
+                    <p>Already have an account? <a href="/login">Login here</a></p>
+                </div>
+            </div>
+        </div>
+    </div>
+</div>'''
+
+DASHBOARD_HTML = '''<div class="row mb-4">
+    <div class="col-12">
+        <h2><i class="fas fa-tachometer-alt"></i> Dashboard</h2>
+        <p class="text-muted">Welcome back, {{ username }}!</p>
+    </div>
+</div>
+
+<div class="row mb-4">
+    <div class="col-md-3">
+        <div class="card stats-card">
+            <div class="card-body text-center">
+                <h5 class="card-title"><i class="fas fa-book"></i> Total Books</h5>
                 <h2 class="display-4">{{ total_books }}</h2>
             </div>
         </div>
     </div>
     <div class="col-md-3">
-        <div class="card bg-success text-white">
+        <div class="card bg-success text-white">
+            <div class="card-body text-center">
+                <h5 class="card-title"><i class="fas fa-check-circle"></i> Available</h5>
+                <h2 class="display-4">{{ total_available }}</h2>
+            </div>
+        </div>
+    </div>
+    <div class="col-md-3">
+        <div class="card bg-warning text-white">
+            <div class="card-body text-center">
+                <h5 class="card-title"><i class="fas fa-users"></i> Borrowed</h5>
+                <h2 class="display-4">{{ total_borrowed }}</h2>
+            </div>
+        </div>
+    </div>
+    <div class="col-md-3">
+        <div class="card bg-info text-white">
+            <div class="card-body text-center">
+                <h5 class="card-title"><i class="fas fa-bookmark"></i> My Books</h5>
+                <h2 class="display-4">{{ user_borrowed_count }}</h2>
+            </div>
+        </div>
+    </div>
+</div>
+
+<div class="row">
+    <div class="col-md-6">
+        <div class="card">
+            <div class="card-header">
+                <h5 class="mb-0"><i class="fas fa-compass"></i> Quick Navigation</h5>
+            </div>
+            <div class="card-body">
+                <div class="d-grid gap-2">
+                    <a href="/books" class="btn btn-outline-primary">
+                        <i class="fas fa-book-open"></i> View All Books
+                    </a>
+                    <a href="/books/available" class="btn btn-outline-success">
+                        <i class="fas fa-check"></i> Available Books
+                    </a>
+                    <a href="/my-books" class="btn btn-outline-warning">
+                        <i class="fas fa-bookmark"></i> My Borrowed Books
+                    </a>
+                    <a href="/checkout" class="btn btn-outline-info">
+                        <i class="fas fa-layer-group"></i> Desk Checkout &amp; Return
+                    </a>
+                    {% if role == 'admin' %}
+                    <a href="/admin" class="btn btn-outline-danger">
+                        <i class="fas fa-cog"></i> Admin Panel
+                    </a>
+                    {% endif %}
+                </div>
+            </div>
+        </div>
+    </div>
+    
+    <div class="col-md-6">
+        <div class="card">
+            <div class="card-header">
+                <h5 class="mb-0"><i class="fas fa-info-circle"></i> System Info</h5>
+            </div>
+            <div class="card-body">
+                <p><strong>Role:</strong> <span class="badge bg-{{ 'danger' if role == 'admin' else 'primary' }}">{{ role|title }}</span></p>
+                <p><strong>Username:</strong> {{ username }}</p>
+                <p><strong>My Borrowed Books:</strong> {{ user_borrowed_count }}</p>
+                <p><strong>Access Level:</strong> 
+                    {% if role == 'admin' %}
+                        Full System Access
+                    {% else %}
+                        Book Browsing & Borrowing
+                    {% endif %}
+                </p>
+            </div>
+        </div>
+    </div>
+</div>'''
+
+BOOKS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2>
+        <i class="fas fa-book"></i> 
+        {% if available_only %}Available Books{% else %}All Books{% endif %}
+    </h2>
+    
+    <div class="d-flex gap-2">
+        <form method="GET" id="filter-form" class="d-flex">
+            <input type="text" name="search" class="form-control me-2" placeholder="Search books..." value="{{ search_term }}"
+                   list="search-suggestions" autocomplete="off">
+            <datalist id="search-suggestions"></datalist>
+            <button type="submit" class="btn btn-outline-primary">
+                <i class="fas fa-search"></i>
+            </button>
+        </form>
+        {% if not available_only %}
+        <a href="/books/available" class="btn btn-success">
+            <i class="fas fa-check"></i> Available Only
+        </a>
+        {% endif %}
+        <a href="/my-books" class="btn btn-warning">
+            <i class="fas fa-bookmark"></i> My Books
+        </a>
+        <button type="submit" form="batch-form" class="btn btn-primary">
+            <i class="fas fa-layer-group"></i> Borrow Selected
+        </button>
+        {% if role == 'admin' %}
+        <a href="/admin/books/bulk?{{ request.query_string.decode() }}" class="btn btn-outline-success" title="Bulk edit the books matching these filters">
+            <i class="fas fa-pen-square"></i> Bulk Edit
+        </a>
+        {% endif %}
+        <a href="/books" class="btn btn-secondary">
+            <i class="fas fa-redo"></i> Reset
+        </a>
+    </div>
+</div>
+
+<div class="card mb-4">
+    <div class="card-body">
+        <div class="row g-2 align-items-end">
+            <div class="col-md-2">
+                <label class="form-label small mb-0">Year from</label>
+                <input type="number" name="year_from" form="filter-form" class="form-control form-control-sm" value="{{ filters.year_from or '' }}">
+            </div>
+            <div class="col-md-2">
+                <label class="form-label small mb-0">Year to</label>
+                <input type="number" name="year_to" form="filter-form" class="form-control form-control-sm" value="{{ filters.year_to or '' }}">
+            </div>
+            <div class="col-md-3">
+                <label class="form-label small mb-0">Author</label>
+                <select name="author" form="filter-form" class="form-select form-select-sm">
+                    <option value="">Any author</option>
+                    {% if filters.author and filters.author not in facets.authors|map('first') %}
+                    <option value="{{ filters.author }}" selected>{{ filters.author }}</option>
+                    {% endif %}
+                    {% for author, count in facets.authors %}
+                    <option value="{{ author }}" {% if author == filters.author %}selected{% endif %}>{{ author }} ({{ count }})</option>
+                    {% endfor %}
+                </select>
+            </div>
+            <div class="col-md-2">
+                <label class="form-label small mb-0">Min copies</label>
+                <input type="number" name="min_copies" form="filter-form" min="0" class="form-control form-control-sm" value="{{ filters.min_copies if filters.min_copies is not none else '' }}">
+            </div>
+            <div class="col-md-2">
+                {% if not available_only %}
+                <div class="form-check">
+                    <input class="form-check-input" type="checkbox" name="available" value="1" id="available" form="filter-form" {% if filters.available %}checked{% endif %}>
+                    <label class="form-check-label small" for="available">Available ({{ facets.available }})</label>
+                </div>
+                {% endif %}
+            </div>
+            <div class="col-md-1">
+                <button type="submit" form="filter-form" class="btn btn-sm btn-outline-primary w-100">Filter</button>
+            </div>
+        </div>
+        <div class="small text-muted mt-2">
+            {{ facets.total }} book(s) &middot; {{ facets.available }} with copies available
+            {% if facets.years %}
+            &middot; Years:
+            {% for year, count in facets.years[-8:]|reverse %}
+            <span class="badge bg-light text-dark">{{ year }} ({{ count }})</span>
+            {% endfor %}
+            {% endif %}
+        </div>
+    </div>
+</div>
+
+{% if books %}
+<form id="batch-form" method="POST" action="/checkout">
+    <input type="hidden" name="action" value="borrow">
+</form>
+<div class="row">
+    {% for book_id, book in books.items() %}
+    <div class="col-md-6 col-lg-4 mb-4" data-book-id="{{ book_id }}">
+        <div class="card book-card h-100 {% if book_id in user_borrowed_ids %}my-borrowed{% endif %}">
+            <div class="card-body">
+                {% if book_id not in user_borrowed_ids %}
+                <input class="form-check-input float-end js-borrow {% if book.Available <= 0 %}d-none{% endif %}" type="checkbox"
+                       name="book_ids" value="{{ book_id }}" form="batch-form" title="Select for batch borrow">
+                {% endif %}
+                <h5 class="card-title"><a href="/books/{{ book_id }}" class="text-reset text-decoration-none">{{ book.Title }}</a></h5>
+                <p class="card-text">
+                    <strong>Author:</strong> {{ book.Author }}<br>
+                    <strong>Year:</strong> {{ book.Year }}<br>
+                    <strong>Book ID:</strong> <code>{{ book_id }}</code>
+                </p>
+                <div class="mb-3">
+                    <span class="badge bg-{{ 'success' if book.Available > 0 else 'danger' }} js-availability">
+                        {{ book.Available }}/{{ book.TotalCopies }} Available
+                    </span>
+                    {% if book_id in user_borrowed_ids %}
+                    <span class="badge bg-warning mt-1">Borrowed by You</span>
+                    {% endif %}
+                    {% if book_id in close_matches %}
+                    <span class="badge bg-secondary mt-1">Close match</span>
+                    {% endif %}
+                </div>
+                {% if branch_stock.get(book_id) %}
+                <p class="small text-muted mb-0">
+                    <i class="fas fa-map-marker-alt"></i>
+                    {% for name, stock in branch_stock[book_id] %}
+                    {{ name }} {{ stock.Available }}/{{ stock.TotalCopies }}{% if not loop.last %} &middot; {% endif %}
+                    {% endfor %}
+                </p>
+                {% endif %}
+                {% if recommendations.get(book_id) %}
+                <p class="small text-muted mt-2 mb-0">
+                    <i class="fas fa-users"></i> Also borrowed:
+                    {% for other_id, title in recommendations[book_id] %}
+                    <a href="/books?search={{ title|urlencode }}">{{ title }}</a>{% if not loop.last %}, {% endif %}
+                    {% endfor %}
+                </p>
+                {% endif %}
+            </div>
+            <div class="card-footer">
+                <div class="d-grid gap-2">
+                    {% if book_id not in user_borrowed_ids %}
+                    {% if branch_stock.get(book_id) %}
+                    <form method="GET" action="/borrow/{{ book_id }}" class="input-group input-group-sm js-borrow {% if book.Available <= 0 %}d-none{% endif %}">
+                        <select name="branch" class="form-select" title="Branch to borrow from">
+                            {% for name, stock in branch_stock[book_id] if stock.Available > 0 %}
+                            <option value="{{ name }}">{{ name }} ({{ stock.Available }})</option>
+                            {% endfor %}
+                        </select>
+                        <button type="submit" class="btn btn-primary">
+                            <i class="fas fa-hand-holding"></i> Borrow
+                        </button>
+                    </form>
+                    {% else %}
+                    <a href="/borrow/{{ book_id }}" class="btn btn-primary btn-sm js-borrow {% if book.Available <= 0 %}d-none{% endif %}">
+                        <i class="fas fa-hand-holding"></i> Borrow
+                    </a>
+                    {% endif %}
+                    {% endif %}
+                    {% if book_id in user_borrowed_ids %}
+                    <a href="/return/{{ book_id }}" class="btn btn-warning btn-sm">
+                        <i class="fas fa-undo"></i> Return
+                    </a>
+                    {% endif %}
+                    {% if role == 'admin' %}
+                    <a href="/admin/update-book/{{ book_id }}" class="btn btn-outline-secondary btn-sm">
+                        <i class="fas fa-edit"></i> Edit
+                    </a>
+                    {% endif %}
+                </div>
+            </div>
+        </div>
+    </div>
+    {% endfor %}
+</div>
+{% else %}
+<div class="alert alert-info text-center">
+    <h4><i class="fas fa-book-open"></i> No Books Found</h4>
+    <p>{% if search_term %}No books match your search criteria.{% else %}The library is currently empty.{% endif %}</p>
+</div>
+{% endif %}
+
+<script>
+// Search-as-you-type: fill the datalist from /api/autocomplete instead of reloading the grid
+(function () {
+    var input = document.querySelector('#filter-form input[name="search"]');
+    var list = document.getElementById('search-suggestions');
+    var timer = null, last = '';
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var q = input.value;
+            if (!q.trim() || q === last) return;
+            last = q;
+            fetch('/api/autocomplete?q=' + encodeURIComponent(q))
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    if (input.value !== q) return;
+                    list.innerHTML = '';
+                    data.suggestions.forEach(function (suggestion) {
+                        var option = document.createElement('option');
+                        option.value = suggestion.text;
+                        option.label = suggestion.kind === 'author' ? 'Author' : 'Title';
+                        list.appendChild(option);
+                    });
+                });
+        }, 80);
+    });
+})();
+
+// Live availability: patch cards in place from /books/stream instead of reloading
+(function () {
+    if (!window.EventSource || !document.querySelector('[data-book-id]')) return;
+    var availableOnly = {{ 'true' if available_only else 'false' }};
+    function connect() {
+        var source = new EventSource('/books/stream');
+        source.addEventListener('availability', onAvailability);
+        source.addEventListener('resync', function () {
+            window.location.reload();
+        });
+        source.onerror = function () {
+            // A refused stream (503) is not retried by the browser itself
+            if (source.readyState === EventSource.CLOSED) setTimeout(connect, {{ stream_retry_ms }});
+        };
+    }
+    function onAvailability(event) {
+        JSON.parse(event.data).forEach(function (delta) {
+            var card = document.querySelector('[data-book-id="' + CSS.escape(delta.book_id) + '"]');
+            if (!card) return;
+            if (delta.deleted) {
+                card.remove();
+                return;
+            }
+            var available = delta.Available > 0;
+            var badge = card.querySelector('.js-availability');
+            badge.textContent = delta.Available + '/' + delta.TotalCopies + ' Available';
+            badge.classList.toggle('bg-success', available);
+            badge.classList.toggle('bg-danger', !available);
+            card.querySelectorAll('.js-borrow').forEach(function (control) {
+                control.classList.toggle('d-none', !available);
+                if (!available && control.checked) control.checked = false;
+            });
+            if (availableOnly) card.style.opacity = available ? '' : '0.5';
+        });
+    }
+    connect();
+})();
+</script>'''
+
+MY_BOOKS_HTML = '''<div class="row mb-4">
+    <div class="col-12">
+        <h2><i class="fas fa-bookmark"></i> My Borrowed Books</h2>
+        <p class="text-muted">Books currently borrowed by you</p>
+    </div>
+</div>
+
+{% if fine_total %}
+<div class="alert alert-warning">
+    <i class="fas fa-coins"></i> You owe <strong>{{ format_money(fine_total) }}</strong> in overdue fines.
+    Loans are due {{ loan_period }} days after borrowing.
+</div>
+{% endif %}
+
+{% if my_books %}
+<form id="batch-form" method="POST" action="/checkout" class="mb-3 text-end">
+    <input type="hidden" name="action" value="return">
+    <button type="submit" class="btn btn-warning">
+        <i class="fas fa-layer-group"></i> Return Selected
+    </button>
+</form>
+<div class="row">
+    {% for book_id, book in my_books.items() %}
+    <div class="col-md-6 col-lg-4 mb-4">
+        <div class="card book-card h-100 my-borrowed">
+            <div class="card-body">
+                <input class="form-check-input float-end" type="checkbox" name="book_ids" value="{{ book_id }}"
+                       form="batch-form" title="Select for batch return">
+                <h5 class="card-title"><a href="/books/{{ book_id }}" class="text-reset text-decoration-none">{{ book.Title }}</a></h5>
+                <p class="card-text">
+                    <strong>Author:</strong> {{ book.Author }}<br>
+                    <strong>Year:</strong> {{ book.Year }}<br>
+                    <strong>Book ID:</strong> <code>{{ book_id }}</code>
+                </p>
+                <div class="mb-3">
+                    <span class="badge bg-warning">
+                        <i class="fas fa-clock"></i> Borrowed by You
+                    </span>
+                    {% set loan = fines.get(book_id) %}
+                    {% if loan %}
+                    {% if loan.days_late %}
+                    <span class="badge bg-danger">{{ loan.days_late }} day(s) overdue</span>
+                    {% if loan.fine %}<span class="badge bg-dark">Fine {{ format_money(loan.fine) }}</span>{% endif %}
+                    {% else %}
+                    <span class="badge bg-light text-dark">Due {{ loan.due }}</span>
+                    {% endif %}
+                    {% endif %}
+                </div>
+                {% if recommendations.get(book_id) %}
+                <p class="small text-muted mb-0">
+                    <i class="fas fa-users"></i> Also borrowed:
+                    {% for other_id, title in recommendations[book_id] %}
+                    <a href="/books?search={{ title|urlencode }}">{{ title }}</a>{% if not loop.last %}, {% endif %}
+                    {% endfor %}
+                </p>
+                {% endif %}
+            </div>
+            <div class="card-footer">
+                <div class="d-grid gap-2">
+                    {% if branches %}
+                    <form method="GET" action="/return/{{ book_id }}" class="input-group input-group-sm">
+                        <select name="branch" class="form-select" title="Branch you are returning it to">
+                            {% for name in branches %}
+                            <option value="{{ name }}" {% if name == lent_from.get(book_id) %}selected{% endif %}>{{ name }}</option>
+                            {% endfor %}
+                        </select>
+                        <button type="submit" class="btn btn-warning">
+                            <i class="fas fa-undo"></i> Return Book
+                        </button>
+                    </form>
+                    {% else %}
+                    <a href="/return/{{ book_id }}" class="btn btn-warning btn-sm">
+                        <i class="fas fa-undo"></i> Return Book
+                    </a>
+                    {% endif %}
+                    <a href="/books" class="btn btn-outline-primary btn-sm">
+                        <i class="fas fa-search"></i> Browse More
+                    </a>
+                </div>
+            </div>
+        </div>
+    </div>
+    {% endfor %}
+</div>
+{% else %}
+<div class="alert alert-info text-center">
+    <h4><i class="fas fa-book-open"></i> No Books Borrowed</h4>
+    <p>You haven't borrowed any books yet.</p>
+    <a href="/books" class="btn btn-primary">Browse Books</a>
+</div>
+{% endif %}
+
+{% if suggested %}
+<div class="card mt-2">
+    <div class="card-header">
+        <h5 class="mb-0"><i class="fas fa-lightbulb"></i> Borrowed Together With Your Books</h5>
+    </div>
+    <ul class="list-group list-group-flush">
+        {% for book_id, book in suggested %}
+        <li class="list-group-item d-flex justify-content-between align-items-center">
+            <span><strong>{{ book.Title }}</strong> <span class="text-muted">by {{ book.Author }}</span></span>
+            {% if book.Available > 0 %}
+            <a href="/borrow/{{ book_id }}" class="btn btn-primary btn-sm">
+                <i class="fas fa-hand-holding"></i> Borrow
+            </a>
+            {% else %}
+            <span class="badge bg-danger">Unavailable</span>
+            {% endif %}
+        </li>
+        {% endfor %}
+    </ul>
+</div>
+{% endif %}'''
+
+MY_HISTORY_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <div>
+        <h2><i class="fas fa-history"></i> My History</h2>
+        <p class="text-muted mb-0">{{ total }} loan(s){% if date_from or date_to %} in the selected range{% endif %}</p>
+    </div>
+    <a href="/my-books" class="btn btn-secondary">
+        <i class="fas fa-bookmark"></i> My Books
+    </a>
+</div>
+
+<form method="GET" class="row g-2 align-items-end mb-4">
+    <div class="col-md-4">
+        <label for="from" class="form-label">Borrowed from</label>
+        <input type="date" class="form-control" id="from" name="from" value="{{ date_from or '' }}">
+    </div>
+    <div class="col-md-4">
+        <label for="to" class="form-label">Borrowed to</label>
+        <input type="date" class="form-control" id="to" name="to" value="{{ date_to or '' }}">
+    </div>
+    <div class="col-md-4 d-flex gap-2">
+        <button type="submit" class="btn btn-primary"><i class="fas fa-filter"></i> Filter</button>
+        <a href="/my-history" class="btn btn-outline-secondary">Clear</a>
+    </div>
+</form>
+
+{% if loans %}
+<div class="card">
+    <div class="card-body">
+        <table class="table table-striped mb-0">
+            <thead>
+                <tr><th>Book</th><th>Book ID</th><th>Borrowed</th><th>Returned</th><th>Status</th></tr>
+            </thead>
+            <tbody>
+                {% for loan in loans %}
+                <tr>
+                    <td>{{ loan.book_title }}</td>
+                    <td><code>{{ loan.book_id }}</code></td>
+                    <td>{{ loan.borrow_date }}</td>
+                    <td>{{ loan.return_date if loan.return_date else 'Not returned' }}</td>
+                    <td>
+                        <span class="badge bg-{{ 'success' if loan.return_date else 'warning' }}">
+                            {{ 'Returned' if loan.return_date else 'Borrowed' }}
+                        </span>
+                    </td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    </div>
+</div>
+{% if pages > 1 %}
+<nav class="mt-3">
+    <ul class="pagination justify-content-center">
+        {% for number in range(1, pages + 1) if number == 1 or number == pages or (number - page)|abs <= 2 %}
+        <li class="page-item {% if number == page %}active{% endif %}">
+            <a class="page-link" href="?{{ {'page': number, 'from': date_from or '', 'to': date_to or ''}|urlencode }}">{{ number }}</a>
+        </li>
+        {% endfor %}
+    </ul>
+</nav>
+{% endif %}
+{% else %}
+<div class="alert alert-info text-center">
+    <h4><i class="fas fa-book-open"></i> No Loans Found</h4>
+    <p>{% if date_from or date_to %}No loans in this date range.{% else %}You haven't borrowed any books yet.{% endif %}</p>
+</div>
+{% endif %}'''
+
+BOOK_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <div>
+        <h2><i class="fas fa-book"></i> {{ book.Title }}</h2>
+        <p class="text-muted mb-0">{{ book.Author }} &middot; {{ book.Year }} &middot; <code>{{ book_id }}</code></p>
+    </div>
+    <div class="d-flex gap-2">
+        {% if borrowed %}
+        <a href="/return/{{ book_id }}" class="btn btn-warning">
+            <i class="fas fa-undo"></i> Return
+        </a>
+        {% elif book.Available > 0 %}
+        <a href="/borrow/{{ book_id }}" class="btn btn-primary">
+            <i class="fas fa-hand-holding"></i> Borrow
+        </a>
+        {% endif %}
+        {% if role == 'admin' %}
+        <a href="/admin/update-book/{{ book_id }}" class="btn btn-outline-secondary">
+            <i class="fas fa-edit"></i> Edit
+        </a>
+        {% endif %}
+        <a href="/books" class="btn btn-secondary">
+            <i class="fas fa-arrow-left"></i> Back to Books
+        </a>
+    </div>
+</div>
+
+<div class="row mb-4">
+    <div class="col-md-4">
+        <div class="card h-100">
+            <div class="card-body">
+                <h5 class="card-title">Copies</h5>
+                <p class="mb-2">
+                    <span class="badge bg-{{ 'success' if book.Available > 0 else 'danger' }}">{{ book.Available }}/{{ book.TotalCopies }} Available</span>
+                    <span class="badge bg-secondary">{{ book.Borrowed }} on loan</span>
+                </p>
+                <p class="text-muted small mb-0">Borrowed {{ loan_count }} time(s) in all.</p>
+                {% if branch_stock %}
+                <table class="table table-sm mt-3 mb-0">
+                    <thead><tr><th>Branch</th><th>Available</th><th>Borrowed</th></tr></thead>
+                    <tbody>
+                        {% for branch, stock in branch_stock %}
+                        <tr><td>{{ branch }}</td><td>{{ stock.Available }}</td><td>{{ stock.Borrowed }}</td></tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% endif %}
+            </div>
+        </div>
+    </div>
+    <div class="col-md-8">
+        <div class="card h-100">
+            <div class="card-body">
+                <h5 class="card-title">Borrowed Together</h5>
+                {% if together %}
+                <ul class="mb-0">
+                    {% for other_id, title in together %}
+                    <li><a href="/books/{{ other_id }}">{{ title }}</a></li>
+                    {% endfor %}
+                </ul>
+                {% else %}
+                <p class="text-muted mb-0">No patron has borrowed this with other books yet.</p>
+                {% endif %}
+            </div>
+        </div>
+    </div>
+</div>
+
+{% if role == 'admin' %}
+<div class="card mb-4">
+    <div class="card-header">
+        <h5 class="mb-0"><i class="fas fa-user-clock"></i> Current Borrowers <span class="badge bg-secondary">{{ borrowers|length }}</span></h5>
+    </div>
+    <div class="card-body">
+        {% if borrowers %}
+        <table class="table table-striped mb-0">
+            <thead>
+                <tr><th>Username</th><th>Borrowed</th><th>Due</th><th>Fine</th>{% if branch_stock %}<th>Branch</th>{% endif %}</tr>
+            </thead>
+            <tbody>
+                {% for loan in borrowers %}
+                <tr>
+                    <td>{{ loan.username }}</td>
+                    <td>{{ loan.borrow_date }}</td>
+                    <td>
+                        {{ loan.due or '-' }}
+                        {% if loan.days_late %}<span class="badge bg-danger">{{ loan.days_late }} day(s) overdue</span>{% endif %}
+                    </td>
+                    <td>{{ format_money(loan.fine) if loan.fine else '-' }}</td>
+                    {% if branch_stock %}<td>{{ loan.branch or '-' }}</td>{% endif %}
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        {% else %}
+        <p class="text-muted mb-0">Nobody has this book right now.</p>
+        {% endif %}
+    </div>
+</div>
+
+<div class="card">
+    <div class="card-header">
+        <h5 class="mb-0"><i class="fas fa-history"></i> Loan History <span class="badge bg-secondary">{{ total }}</span></h5>
+    </div>
+    <div class="card-body">
+        {% if history %}
+        <table class="table table-striped mb-0">
+            <thead>
+                <tr><th>Username</th><th>Borrowed</th><th>Returned</th><th>Status</th></tr>
+            </thead>
+            <tbody>
+                {% for loan in history %}
+                <tr>
+                    <td>{{ loan.username }}</td>
+                    <td>{{ loan.borrow_date }}</td>
+                    <td>{{ loan.return_date if loan.return_date else 'Not returned' }}</td>
+                    <td>
+                        <span class="badge bg-{{ 'success' if loan.return_date else 'warning' }}">
+                            {{ 'Returned' if loan.return_date else 'Borrowed' }}
+                        </span>
+                    </td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        {% else %}
+        <p class="text-muted mb-0">This book has never been borrowed.</p>
+        {% endif %}
+    </div>
+</div>
+{% if pages > 1 %}
+<nav class="mt-3">
+    <ul class="pagination justify-content-center">
+        {% for number in range(1, pages + 1) if number == 1 or number == pages or (number - page)|abs <= 2 %}
+        <li class="page-item {% if number == page %}active{% endif %}">
+            <a class="page-link" href="?page={{ number }}">{{ number }}</a>
+        </li>
+        {% endfor %}
+    </ul>
+</nav>
+{% endif %}
+{% endif %}'''
+
+ADMIN_HTML = '''<div class="row mb-4">
+    <div class="col-12">
+        <h2><i class="fas fa-cog"></i> Admin Control Panel</h2>
+    </div>
+</div>
+
+<div class="row mb-4">
+    <div class="col-md-3">
+        <div class="card bg-primary text-white">
+            <div class="card-body text-center">
+                <h5><i class="fas fa-book"></i> Unique Books</h5>
+                <h3>{{ total_books }}</h3>
+            </div>
+        </div>
+    </div>
+    <div class="col-md-3">
+        <div class="card bg-info text-white">
             <div class="card-body text-center">
-                <h5 class="card-title"><i class="fas fa-check-circle"></i> Available</h5>
-                <h2 class="display-4">{{ total_available }}</h2>
+                <h5><i class="fas fa-copy"></i> Total Copies</h5>
+                <h3>{{ total_copies }}</h3>
             </div>
         </div>
     </div>
     <div class="col-md-3">
-        <div class="card bg-warning text-white">
+        <div class="card bg-success text-white">
             <div class="card-body text-center">
-                <h5 class="card-title"><i class="fas fa-users"></i> Borrowed</h5>
-                <h2 class="display-4">{{ total_borrowed }}</h2>
+                <h5><i class="fas fa-check"></i> Available</h5>
+                <h3>{{ total_available }}</h3>
             </div>
         </div>
     </div>
     <div class="col-md-3">
-        <div class="card bg-info text-white">
+        <div class="card bg-warning text-white">
             <div class="card-body text-center">
-                <h5 class="card-title"><i class="fas fa-bookmark"></i> My Books</h5>
-                <h2 class="display-4">{{ user_borrowed_count }}</h2>
+                <h5><i class="fas fa-users"></i> Borrowed</h5>
+                <h3>{{ total_borrowed }}</h3>
             </div>
         </div>
     </div>
@@ -371,178 +4729,306 @@ DASHBOARD_HTML = '''<div class="row mb-4">
     <div class="col-md-6">
         <div class="card">
             <div class="card-header">
-                <h5 class="mb-0"><i class="fas fa-compass"></i> Quick Navigation</h5>
+                <h5 class="mb-0"><i class="fas fa-book-medical"></i> Book Management</h5>
+            </div>
+            <div class="card-body">
+                <div class="d-grid gap-2">
+                    <a href="/admin/add-book" class="btn btn-success">
+                        <i class="fas fa-plus"></i> Add New Book
+                    </a>
+                    <a href="/admin/books/bulk" class="btn btn-outline-success">
+                        <i class="fas fa-pen-square"></i> Bulk Edit Books
+                    </a>
+                    <a href="/books" class="btn btn-primary">
+                        <i class="fas fa-eye"></i> View All Books
+                    </a>
+                    <a href="/admin/stats" class="btn btn-info">
+                        <i class="fas fa-chart-bar"></i> Detailed Statistics
+                    </a>
+                    <a href="/branches" class="btn btn-outline-primary">
+                        <i class="fas fa-map-marker-alt"></i> Branches &amp; Transfers
+                    </a>
+                    <form method="POST" action="/admin/recommendations/rebuild" class="d-grid">
+                        <button type="submit" class="btn btn-outline-secondary">
+                            <i class="fas fa-sync"></i> Rebuild "Borrowed Together"
+                        </button>
+                    </form>
+                </div>
+            </div>
+        </div>
+    </div>
+    
+    <div class="col-md-6">
+        <div class="card">
+            <div class="card-header">
+                <h5 class="mb-0"><i class="fas fa-users-cog"></i> User Management</h5>
             </div>
             <div class="card-body">
                 <div class="d-grid gap-2">
-                    <a href="/books" class="btn btn-outline-primary">
-                        <i class="fas fa-book-open"></i> View All Books
+                    <a href="/admin/users" class="btn btn-warning">
+                        <i class="fas fa-user-friends"></i> View All Users
                     </a>
-                    <a href="/books/available" class="btn btn-outline-success">
-                        <i class="fas fa-check"></i> Available Books
+                    <a href="/admin/borrow-records" class="btn btn-secondary">
+                        <i class="fas fa-history"></i> Borrow History
                     </a>
-                    <a href="/my-books" class="btn btn-outline-warning">
-                        <i class="fas fa-bookmark"></i> My Borrowed Books
+                    <a href="/admin/fines" class="btn btn-outline-danger">
+                        <i class="fas fa-coins"></i> Fines Report
                     </a>
-                    {% if role == 'admin' %}
-                    <a href="/admin" class="btn btn-outline-danger">
-                        <i class="fas fa-cog"></i> Admin Panel
+                    <a href="/admin/profiles" class="btn btn-outline-secondary">
+                        <i class="fas fa-stopwatch"></i> Request Profiles
                     </a>
-                    {% endif %}
+                    <a href="/admin/memory" class="btn btn-outline-secondary">
+                        <i class="fas fa-memory"></i> Memory
+                    </a>
+                    <a href="/admin/jobs" class="btn btn-outline-secondary">
+                        <i class="fas fa-tasks"></i> Background Jobs
+                    </a>
+                    <div class="text-center mt-3">
+                        <p class="mb-1"><strong>Total Users:</strong> {{ total_users }}</p>
+                        <p class="mb-0 text-muted">User registration is open to public</p>
+                    </div>
                 </div>
             </div>
         </div>
     </div>
-    
-    <div class="col-md-6">
+</div>'''
+
+ADD_BOOK_HTML = '''<div class="row justify-content-center">
+    <div class="col-md-8">
         <div class="card">
             <div class="card-header">
-                <h5 class="mb-0"><i class="fas fa-info-circle"></i> System Info</h5>
+                <h4 class="mb-0"><i class="fas fa-plus-circle"></i> Add New Book</h4>
             </div>
             <div class="card-body">
-                <p><strong>Role:</strong> <span class="badge bg-{{ 'danger' if role == 'admin' else 'primary' }}">{{ role|title }}</span></p>
-                <p><strong>Username:</strong> {{ username }}</p>
-                <p><strong>My Borrowed Books:</strong> {{ user_borrowed_count }}</p>
-                <p><strong>Access Level:</strong> 
-                    {% if role == 'admin' %}
-                        Full System Access
-                    {% else %}
-                        Book Browsing & Borrowing
+                <form method="POST">
+                    <div class="row">
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label for="book_id" class="form-label">Book ID *</label>
+                                <input type="text" class="form-control" id="book_id" name="book_id" required>
+                            </div>
+                        </div>
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label for="copies" class="form-label">Number of Copies *</label>
+                                <input type="number" class="form-control" id="copies" name="copies" min="1" required>
+                            </div>
+                        </div>
+                    </div>
+                    
+                    <div class="mb-3">
+                        <label for="title" class="form-label">Book Title *</label>
+                        <input type="text" class="form-control" id="title" name="title" required>
+                    </div>
+                    
+                    <div class="row">
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label for="author" class="form-label">Author *</label>
+                                <input type="text" class="form-control" id="author" name="author" required>
+                            </div>
+                        </div>
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label for="year" class="form-label">Publication Year</label>
+                                <input type="text" class="form-control" id="year" name="year">
+                            </div>
+                        </div>
+                    </div>
+
+                    <div class="alert alert-info">
+                        <i class="fas fa-info-circle"></i> 
+                        <strong>Note:</strong> If Book ID already exists, you can add additional copies below.
+                    </div>
+
+                    <div class="mb-3">
+                        <label for="additional_copies" class="form-label">Additional Copies (for existing books)</label>
+                        <input type="number" class="form-control" id="additional_copies" name="additional_copies" min="0" value="0">
+                    </div>
+
+                    {% if branches %}
+                    <div class="mb-3">
+                        <label for="branch" class="form-label">Shelve New Copies At</label>
+                        <select name="branch" id="branch" class="form-select">
+                            {% for name in branches %}
+                            <option value="{{ name }}">{{ name }}</option>
+                            {% endfor %}
+                        </select>
+                    </div>
                     {% endif %}
-                </p>
+
+                    <div class="d-grid gap-2">
+                        <button type="submit" class="btn btn-success">
+                            <i class="fas fa-save"></i> Save Book
+                        </button>
+                        <a href="/admin" class="btn btn-secondary">
+                            <i class="fas fa-arrow-left"></i> Back to Admin Panel
+                        </a>
+                    </div>
+                </form>
             </div>
         </div>
     </div>
 </div>'''
 
-BOOKS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
-    <h2>
-        <i class="fas fa-book"></i> 
-        {% if available_only %}Available Books{% else %}All Books{% endif %}
-    </h2>
-    
-    <div class="d-flex gap-2">
-        <form method="GET" class="d-flex">
-            <input type="text" name="search" class="form-control me-2" placeholder="Search books..." value="{{ search_term }}">
-            <button type="submit" class="btn btn-outline-primary">
-                <i class="fas fa-search"></i>
-            </button>
-        </form>
-        {% if not available_only %}
-        <a href="/books/available" class="btn btn-success">
-            <i class="fas fa-check"></i> Available Only
-        </a>
-        {% endif %}
-        <a href="/my-books" class="btn btn-warning">
-            <i class="fas fa-bookmark"></i> My Books
-        </a>
-        <a href="/books" class="btn btn-secondary">
-            <i class="fas fa-redo"></i> Reset
-        </a>
-    </div>
-</div>
-
-{% if books %}
-<div class="row">
-    {% for book_id, book in books.items() %}
-    <div class="col-md-6 col-lg-4 mb-4">
-        <div class="card book-card h-100 {% if book_id in user_borrowed_ids %}my-borrowed{% endif %}">
-            <div class="card-body">
-                <h5 class="card-title">{{ book.Title }}</h5>
-                <p class="card-text">
-                    <strong>Author:</strong> {{ book.Author }}<br>
-                    <strong>Year:</strong> {{ book.Year }}<br>
-                    <strong>Book ID:</strong> <code>{{ book_id }}</code>
-                </p>
-                <div class="mb-3">
-                    <span class="badge bg-{{ 'success' if book.Available > 0 else 'danger' }}">
-                        {{ book.Available }}/{{ book.TotalCopies }} Available
-                    </span>
-                    {% if book_id in user_borrowed_ids %}
-                    <span class="badge bg-warning mt-1">Borrowed by You</span>
-                    {% endif %}
-                </div>
+UPDATE_BOOK_HTML = '''<div class="row justify-content-center">
+    <div class="col-md-8">
+        <div class="card">
+            <div class="card-header">
+                <h4 class="mb-0"><i class="fas fa-edit"></i> Update Book: {{ book_id }}</h4>
             </div>
-            <div class="card-footer">
-                <div class="d-grid gap-2">
-                    {% if book.Available > 0 and book_id not in user_borrowed_ids %}
-                    <a href="/borrow/{{ book_id }}" class="btn btn-primary btn-sm">
-                        <i class="fas fa-hand-holding"></i> Borrow
-                    </a>
-                    {% endif %}
-                    {% if book_id in user_borrowed_ids %}
-                    <a href="/return/{{ book_id }}" class="btn btn-warning btn-sm">
-                        <i class="fas fa-undo"></i> Return
-                    </a>
-                    {% endif %}
-                    {% if role == 'admin' %}
-                    <a href="/admin/update-book/{{ book_id }}" class="btn btn-outline-secondary btn-sm">
-                        <i class="fas fa-edit"></i> Edit
-                    </a>
-                    {% endif %}
-                </div>
+            <div class="card-body">
+                <form method="POST">
+                    <div class="mb-3">
+                        <label for="title" class="form-label">Book Title *</label>
+                        <input type="text" class="form-control" id="title" name="title" value="{{ book.Title }}" required>
+                    </div>
+                    
+                    <div class="row">
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label for="author" class="form-label">Author *</label>
+                                <input type="text" class="form-control" id="author" name="author" value="{{ book.Author }}" required>
+                            </div>
+                        </div>
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label for="year" class="form-label">Publication Year</label>
+                                <input type="text" class="form-control" id="year" name="year" value="{{ book.Year }}">
+                            </div>
+                        </div>
+                    </div>
+
+                    <div class="mb-3">
+                        <label for="total_copies" class="form-label">Total Copies *</label>
+                        <input type="number" class="form-control" id="total_copies" name="total_copies" 
+                               value="{{ book.TotalCopies }}" min="{{ book.Borrowed }}" required>
+                        <div class="form-text">Cannot be less than currently borrowed copies ({{ book.Borrowed }})</div>
+                    </div>
+
+                    <div class="alert alert-warning">
+                        <i class="fas fa-exclamation-triangle"></i> 
+                        <strong>Current Status:</strong> 
+                        {{ book.Available }} available, {{ book.Borrowed }} borrowed out of {{ book.TotalCopies }} total copies.
+                    </div>
+
+                    <div class="d-grid gap-2">
+                        <button type="submit" class="btn btn-primary">
+                            <i class="fas fa-save"></i> Update Book
+                        </button>
+                        <a href="/admin" class="btn btn-secondary">
+                            <i class="fas fa-arrow-left"></i> Back to Admin Panel
+                        </a>
+                    </div>
+                </form>
             </div>
         </div>
     </div>
-    {% endfor %}
-</div>
-{% else %}
-<div class="alert alert-info text-center">
-    <h4><i class="fas fa-book-open"></i> No Books Found</h4>
-    <p>{% if search_term %}No books match your search criteria.{% else %}The library is currently empty.{% endif %}</p>
-</div>
-{% endif %}'''
+</div>'''
 
-MY_BOOKS_HTML = '''<div class="row mb-4">
-    <div class="col-12">
-        <h2><i class="fas fa-bookmark"></i> My Borrowed Books</h2>
-        <p class="text-muted">Books currently borrowed by you</p>
+USERS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-user-friends"></i> All Registered Users</h2>
+    <div>
+        <a href="/admin/fines" class="btn btn-outline-danger">
+            <i class="fas fa-coins"></i> Fines Report
+        </a>
+        <a href="/admin" class="btn btn-secondary">
+            <i class="fas fa-arrow-left"></i> Back to Admin
+        </a>
     </div>
 </div>
 
-{% if my_books %}
-<div class="row">
-    {% for book_id, book in my_books.items() %}
-    <div class="col-md-6 col-lg-4 mb-4">
-        <div class="card book-card h-100 my-borrowed">
-            <div class="card-body">
-                <h5 class="card-title">{{ book.Title }}</h5>
-                <p class="card-text">
-                    <strong>Author:</strong> {{ book.Author }}<br>
-                    <strong>Year:</strong> {{ book.Year }}<br>
-                    <strong>Book ID:</strong> <code>{{ book_id }}</code>
-                </p>
-                <div class="mb-3">
-                    <span class="badge bg-warning">
-                        <i class="fas fa-clock"></i> Borrowed by You
-                    </span>
-                </div>
-            </div>
-            <div class="card-footer">
-                <div class="d-grid gap-2">
-                    <a href="/return/{{ book_id }}" class="btn btn-warning btn-sm">
-                        <i class="fas fa-undo"></i> Return Book
-                    </a>
-                    <a href="/books" class="btn btn-outline-primary btn-sm">
-                        <i class="fas fa-search"></i> Browse More
-                    </a>
-                </div>
-            </div>
+<form method="GET" class="row g-2 mb-3">
+    <div class="col-md-5">
+        <input type="text" name="q" class="form-control" placeholder="Username starts with..." value="{{ prefix }}">
+    </div>
+    <div class="col-md-4">
+        <select name="role" class="form-select">
+            <option value="">All roles</option>
+            {% for name, count in roles %}
+            <option value="{{ name }}" {% if name == role %}selected{% endif %}>{{ name|title }} ({{ count }})</option>
+            {% endfor %}
+        </select>
+    </div>
+    <div class="col-md-3 d-grid">
+        <button type="submit" class="btn btn-primary"><i class="fas fa-search"></i> Search</button>
+    </div>
+</form>
+
+<div class="card">
+    <div class="card-body">
+        <p class="text-muted">{{ total }} user(s){% if prefix or role %} match{% endif %}</p>
+        <div class="table-responsive">
+            <table class="table table-striped">
+                <thead>
+                    <tr>
+                        <th>Username</th>
+                        <th>Role</th>
+                        <th>Status</th>
+                        <th>Borrowed Books</th>
+                        <th>Fines</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {% for username, user_info in users.items() %}
+                    <tr>
+                        <td>
+                            <i class="fas fa-user"></i> {{ username }}
+                            {% if username == session.username %}
+                            <span class="badge bg-info">You</span>
+                            {% endif %}
+                        </td>
+                        <td>
+                            <span class="badge bg-{{ 'danger' if user_info.role == 'admin' else 'primary' }}">
+                                {{ user_info.role|title }}
+                            </span>
+                        </td>
+                        <td>
+                            <span class="badge bg-success">Active</span>
+                        </td>
+                        <td>
+                            <span class="badge bg-warning">{{ open_loans[username] }}</span>
+                        </td>
+                        <td>
+                            {% if fines.get(username) %}
+                            <span class="badge bg-danger">{{ format_money(fines[username]) }}</span>
+                            {% else %}
+                            <span class="text-muted">-</span>
+                            {% endif %}
+                        </td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
         </div>
+        {% if pages > 1 %}
+        <nav>
+            <ul class="pagination mb-0">
+                <li class="page-item {% if page <= 1 %}disabled{% endif %}">
+                    <a class="page-link" href="?q={{ prefix|urlencode }}&role={{ role|urlencode }}&page={{ page - 1 }}">Previous</a>
+                </li>
+                <li class="page-item disabled"><span class="page-link">Page {{ page }} of {{ pages }}</span></li>
+                <li class="page-item {% if page >= pages %}disabled{% endif %}">
+                    <a class="page-link" href="?q={{ prefix|urlencode }}&role={{ role|urlencode }}&page={{ page + 1 }}">Next</a>
+                </li>
+            </ul>
+        </nav>
+        {% endif %}
     </div>
-    {% endfor %}
-</div>
-{% else %}
-<div class="alert alert-info text-center">
-    <h4><i class="fas fa-book-open"></i> No Books Borrowed</h4>
-    <p>You haven't borrowed any books yet.</p>
-    <a href="/books" class="btn btn-primary">Browse Books</a>
-</div>
-{% endif %}'''
+</div>'''
 
-ADMIN_HTML = '''<div class="row mb-4">
-    <div class="col-12">
-        <h2><i class="fas fa-cog"></i> Admin Control Panel</h2>
+STATS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-chart-bar"></i> Detailed Library Statistics</h2>
+    <div class="d-flex gap-2">
+        <form method="POST" action="/admin/jobs">
+            <input type="hidden" name="kind" value="stats">
+            <button type="submit" class="btn btn-info">
+                <i class="fas fa-file-csv"></i> Full Report (background)
+            </button>
+        </form>
+        <a href="/admin" class="btn btn-secondary">
+            <i class="fas fa-arrow-left"></i> Back to Admin
+        </a>
     </div>
 </div>
 
@@ -550,23 +5036,23 @@ ADMIN_HTML = '''<div class="row mb-4">
     <div class="col-md-3">
         <div class="card bg-primary text-white">
             <div class="card-body text-center">
-                <h5><i class="fas fa-book"></i> Unique Books</h5>
-                <h3>{{ total_books }}</h3>
+                <h6>Unique Books</h6>
+                <h3>{{ total_unique_books }}</h3>
             </div>
         </div>
     </div>
     <div class="col-md-3">
         <div class="card bg-info text-white">
             <div class="card-body text-center">
-                <h5><i class="fas fa-copy"></i> Total Copies</h5>
-                <h3>{{ total_copies }}</h3>
+                <h6>Total Copies</h6>
+                <h3>{{ total_all_copies }}</h3>
             </div>
         </div>
     </div>
     <div class="col-md-3">
         <div class="card bg-success text-white">
             <div class="card-body text-center">
-                <h5><i class="fas fa-check"></i> Available</h5>
+                <h6>Available</h6>
                 <h3>{{ total_available }}</h3>
             </div>
         </div>
@@ -574,344 +5060,912 @@ ADMIN_HTML = '''<div class="row mb-4">
     <div class="col-md-3">
         <div class="card bg-warning text-white">
             <div class="card-body text-center">
-                <h5><i class="fas fa-users"></i> Borrowed</h5>
+                <h6>Borrowed</h6>
                 <h3>{{ total_borrowed }}</h3>
             </div>
         </div>
     </div>
 </div>
 
-<div class="row">
-    <div class="col-md-6">
-        <div class="card">
-            <div class="card-header">
-                <h5 class="mb-0"><i class="fas fa-book-medical"></i> Book Management</h5>
+<div class="card mb-4">
+    <div class="card-header d-flex justify-content-between align-items-center">
+        <h5 class="mb-0"><i class="fas fa-chart-line"></i> Circulation Trends</h5>
+        <form method="GET" class="d-flex gap-2">
+            <input type="hidden" name="period" value="{{ period }}">
+            <select name="book_id" class="form-select form-select-sm" onchange="this.form.submit()">
+                <option value="">Whole library</option>
+                {% for book_id, book in books.items() %}
+                <option value="{{ book_id }}" {% if book_id == chart_book_id %}selected{% endif %}>{{ book.Title }}</option>
+                {% endfor %}
+            </select>
+            <div class="btn-group btn-group-sm">
+                {% for name in periods %}
+                <a href="?{{ {'period': name, 'book_id': chart_book_id}|urlencode }}"
+                   class="btn btn-{{ 'primary' if name == period else 'outline-primary' }}">{{ name|capitalize }}</a>
+                {% endfor %}
             </div>
-            <div class="card-body">
-                <div class="d-grid gap-2">
-                    <a href="/admin/add-book" class="btn btn-success">
-                        <i class="fas fa-plus"></i> Add New Book
-                    </a>
-                    <a href="/books" class="btn btn-primary">
-                        <i class="fas fa-eye"></i> View All Books
-                    </a>
-                    <a href="/admin/stats" class="btn btn-info">
-                        <i class="fas fa-chart-bar"></i> Detailed Statistics
-                    </a>
+        </form>
+    </div>
+    <div class="card-body">
+        <canvas id="circulation-chart" height="90"></canvas>
+        <form method="POST" action="/admin/jobs" class="text-end mt-2">
+            <input type="hidden" name="kind" value="rollups">
+            <button type="submit" class="btn btn-outline-secondary btn-sm">
+                <i class="fas fa-sync"></i> Backfill from loan files
+            </button>
+        </form>
+    </div>
+</div>
+<script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
+<script>
+(function () {
+    var series = {{ series|tojson }};
+    new Chart(document.getElementById('circulation-chart'), {
+        data: {
+            labels: series.map(function (row) { return row.bucket; }),
+            datasets: [
+                {type: 'bar', label: 'Borrows', data: series.map(function (row) { return row.borrows; }),
+                 backgroundColor: 'rgba(13, 110, 253, 0.6)'},
+                {type: 'bar', label: 'Returns', data: series.map(function (row) { return row.returns; }),
+                 backgroundColor: 'rgba(25, 135, 84, 0.6)'},
+                {type: 'line', label: 'Active loans', data: series.map(function (row) { return row.active; }),
+                 borderColor: 'rgb(255, 193, 7)', tension: 0.2}
+            ]
+        },
+        options: {scales: {y: {beginAtZero: true, ticks: {precision: 0}}}}
+    });
+})();
+</script>
+
+<div class="card">
+    <div class="card-header">
+        <h5 class="mb-0"><i class="fas fa-book"></i> Book-wise Breakdown</h5>
+    </div>
+    <div class="card-body">
+        {% for book_id, book in books.items() %}
+        <div class="mb-4 p-3 border rounded">
+            <h6>{{ book.Title }} <small class="text-muted">by {{ book.Author }} ({{ book.Year }})</small></h6>
+            <div class="row">
+                <div class="col-md-6">
+                    <p class="mb-1">Book ID: <code>{{ book_id }}</code></p>
+                    <p class="mb-1">Total Copies: {{ book.TotalCopies }}</p>
+                    <p class="mb-1">Available: <span class="available">{{ book.Available }}</span></p>
+                    <p class="mb-0">Borrowed: <span class="borrowed">{{ book.Borrowed }}</span></p>
+                </div>
+                <div class="col-md-6">
+                    {% if book.TotalCopies > 0 %}
+                    {% set borrowed_pct = (book.Borrowed / book.TotalCopies) * 100 %}
+                    <div class="progress mb-2" style="height: 20px;">
+                        <div class="progress-bar bg-warning" style="width: {{ borrowed_pct }}%">
+                            {{ "%.0f"|format(borrowed_pct) }}% Borrowed
+                        </div>
+                    </div>
+                    <small class="text-muted">
+                        Utilization: {{ "%.1f"|format(borrowed_pct) }}%
+                    </small>
+                    {% endif %}
                 </div>
             </div>
         </div>
+        {% endfor %}
     </div>
-    
-    <div class="col-md-6">
+</div>'''
+
+BORROW_HISTORY_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-history"></i> Borrow History</h2>
+    <div class="d-flex gap-2">
+        <form method="POST" action="/admin/jobs">
+            <input type="hidden" name="kind" value="export">
+            <button type="submit" class="btn btn-primary">
+                <i class="fas fa-file-export"></i> Export (background)
+            </button>
+        </form>
+        <a href="/admin/jobs" class="btn btn-outline-secondary">
+            <i class="fas fa-tasks"></i> Jobs
+        </a>
+        <a href="/admin" class="btn btn-secondary">
+            <i class="fas fa-arrow-left"></i> Back to Admin
+        </a>
+    </div>
+</div>
+
+<div class="card">
+    <div class="card-body">
+        <div class="table-responsive">
+            <table class="table table-striped">
+                <thead>
+                    <tr>
+                        <th>Username</th>
+                        <th>Book ID</th>
+                        <th>Book Title</th>
+                        <th>Borrow Date</th>
+                        <th>Return Date</th>
+                        <th>Status</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {% for record in borrow_history %}
+                    <tr>
+                        <td>{{ record.username }}</td>
+                        <td><code>{{ record.book_id }}</code></td>
+                        <td><a href="/books/{{ record.book_id }}">{{ record.book_title }}</a></td>
+                        <td>{{ record.borrow_date }}</td>
+                        <td>{{ record.return_date if record.return_date else 'Not returned' }}</td>
+                        <td>
+                            <span class="badge bg-{{ 'success' if record.return_date else 'warning' }}">
+                                {{ 'Returned' if record.return_date else 'Borrowed' }}
+                            </span>
+                        </td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
+        </div>
+    </div>
+</div>'''
+
+CHECKOUT_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-layer-group"></i> Desk Checkout &amp; Return</h2>
+    <a href="/books" class="btn btn-secondary">
+        <i class="fas fa-arrow-left"></i> Back to Books
+    </a>
+</div>
+
+<div class="row">
+    <div class="col-md-5">
+        <div class="card mb-4">
+            <div class="card-body">
+                <form method="POST">
+                    <div class="mb-3">
+                        <label class="form-label">Action</label>
+                        <select name="action" class="form-select">
+                            <option value="borrow" {% if action == 'borrow' %}selected{% endif %}>Borrow</option>
+                            <option value="return" {% if action == 'return' %}selected{% endif %}>Return</option>
+                        </select>
+                    </div>
+                    {% if branches %}
+                    <div class="mb-3">
+                        <label for="branch" class="form-label">Branch</label>
+                        <select name="branch" id="branch" class="form-select">
+                            <option value="">Any branch (borrow) / lending branch (return)</option>
+                            {% for name in branches %}
+                            <option value="{{ name }}" {% if name == branch %}selected{% endif %}>{{ name }}</option>
+                            {% endfor %}
+                        </select>
+                    </div>
+                    {% endif %}
+                    {% if session.role == 'admin' %}
+                    <div class="mb-3">
+                        <label for="username" class="form-label">Patron Username</label>
+                        <input type="text" class="form-control" id="username" name="username" value="{{ patron }}">
+                    </div>
+                    {% endif %}
+                    <div class="mb-3">
+                        <label for="book_ids" class="form-label">Book IDs</label>
+                        <textarea class="form-control" id="book_ids" name="book_ids" rows="6"
+                                  placeholder="Scan or type one ID per line">{{ book_ids|join('\n') }}</textarea>
+                        <div class="form-text">All books are processed together: if one fails, none are applied.</div>
+                    </div>
+                    <button type="submit" class="btn btn-primary w-100">
+                        <i class="fas fa-check-double"></i> Process All
+                    </button>
+                </form>
+            </div>
+        </div>
+    </div>
+
+    <div class="col-md-7">
+        {% if results %}
         <div class="card">
             <div class="card-header">
-                <h5 class="mb-0"><i class="fas fa-users-cog"></i> User Management</h5>
+                <h5 class="mb-0">
+                    {{ 'Applied' if applied else 'Not applied' }}
+                    <span class="badge bg-{{ 'success' if applied else 'danger' }}">{{ results|length }} item(s)</span>
+                </h5>
             </div>
             <div class="card-body">
-                <div class="d-grid gap-2">
-                    <a href="/admin/users" class="btn btn-warning">
-                        <i class="fas fa-user-friends"></i> View All Users
-                    </a>
-                    <a href="/admin/borrow-records" class="btn btn-secondary">
-                        <i class="fas fa-history"></i> Borrow History
-                    </a>
-                    <div class="text-center mt-3">
-                        <p class="mb-1"><strong>Total Users:</strong> {{ total_users }}</p>
-                        <p class="mb-0 text-muted">User registration is open to public</p>
-                    </div>
-                </div>
+                <table class="table table-striped mb-0">
+                    <thead>
+                        <tr><th>Book ID</th><th>Title</th><th>Result</th></tr>
+                    </thead>
+                    <tbody>
+                        {% for result in results %}
+                        <tr>
+                            <td><code>{{ result.book_id }}</code></td>
+                            <td>{{ result.title or '-' }}</td>
+                            <td>
+                                <span class="badge bg-{{ 'success' if result.ok else 'danger' }}">{{ result.message }}</span>
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
             </div>
         </div>
+        {% endif %}
     </div>
 </div>'''
 
-ADD_BOOK_HTML = '''<div class="row justify-content-center">
-    <div class="col-md-8">
-        <div class="card">
+BULK_EDIT_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-pen-square"></i> Bulk Edit Books</h2>
+    <a href="/admin" class="btn btn-secondary">
+        <i class="fas fa-arrow-left"></i> Back to Admin
+    </a>
+</div>
+
+<div class="row">
+    <div class="col-md-5">
+        <div class="card mb-4">
             <div class="card-header">
-                <h4 class="mb-0"><i class="fas fa-plus-circle"></i> Add New Book</h4>
+                <h5 class="mb-0"><i class="fas fa-filter"></i> 1. Select Books</h5>
             </div>
             <div class="card-body">
-                <form method="POST">
-                    <div class="row">
-                        <div class="col-md-6">
-                            <div class="mb-3">
-                                <label for="book_id" class="form-label">Book ID *</label>
-                                <input type="text" class="form-control" id="book_id" name="book_id" required>
-                            </div>
+                <form method="GET">
+                    <div class="mb-2">
+                        <input type="text" name="search" class="form-control" placeholder="Title or author contains..." value="{{ search_term }}">
+                    </div>
+                    <div class="row g-2 mb-2">
+                        <div class="col">
+                            <input type="number" name="year_from" class="form-control" placeholder="Year from" value="{{ filters.year_from or '' }}">
                         </div>
-                        <div class="col-md-6">
-                            <div class="mb-3">
-                                <label for="copies" class="form-label">Number of Copies *</label>
-                                <input type="number" class="form-control" id="copies" name="copies" min="1" required>
-                            </div>
+                        <div class="col">
+                            <input type="number" name="year_to" class="form-control" placeholder="Year to" value="{{ filters.year_to or '' }}">
                         </div>
                     </div>
-                    
-                    <div class="mb-3">
-                        <label for="title" class="form-label">Book Title *</label>
-                        <input type="text" class="form-control" id="title" name="title" required>
-                    </div>
-                    
-                    <div class="row">
-                        <div class="col-md-6">
-                            <div class="mb-3">
-                                <label for="author" class="form-label">Author *</label>
-                                <input type="text" class="form-control" id="author" name="author" required>
-                            </div>
+                    <div class="row g-2 mb-2">
+                        <div class="col-8">
+                            <input type="text" name="author" class="form-control" placeholder="Exact author" value="{{ filters.author }}">
                         </div>
-                        <div class="col-md-6">
-                            <div class="mb-3">
-                                <label for="year" class="form-label">Publication Year</label>
-                                <input type="text" class="form-control" id="year" name="year">
-                            </div>
+                        <div class="col-4">
+                            <input type="number" name="min_copies" min="0" class="form-control" placeholder="Min copies" value="{{ filters.min_copies if filters.min_copies is not none else '' }}">
                         </div>
                     </div>
+                    <div class="mb-2">
+                        <textarea class="form-control" name="book_ids" rows="3"
+                                  placeholder="...or list book IDs, one per line (replaces the filters)">{{ listed|join('\n') }}</textarea>
+                    </div>
+                    <button type="submit" class="btn btn-outline-primary w-100">
+                        <i class="fas fa-search"></i> Preview Selection
+                    </button>
+                </form>
+            </div>
+        </div>
 
-                    <div class="alert alert-info">
-                        <i class="fas fa-info-circle"></i> 
-                        <strong>Note:</strong> If Book ID already exists, you can add additional copies below.
+        <div class="card mb-4">
+            <div class="card-header">
+                <h5 class="mb-0"><i class="fas fa-edit"></i> 2. Apply to {{ selected }} Book(s)</h5>
+            </div>
+            <div class="card-body">
+                <form method="POST" onsubmit="return confirm('Apply this change to {{ selected }} book(s)?');">
+                    {% for book_id in listed %}
+                    <input type="hidden" name="book_ids" value="{{ book_id }}">
+                    {% endfor %}
+                    <div class="mb-3">
+                        <label class="form-label">Action</label>
+                        <select name="action" class="form-select">
+                            {% for value, label in actions.items() %}
+                            <option value="{{ value }}" {% if value == action %}selected{% endif %}>{{ label }}</option>
+                            {% endfor %}
+                        </select>
                     </div>
-
                     <div class="mb-3">
-                        <label for="additional_copies" class="form-label">Additional Copies (for existing books)</label>
-                        <input type="number" class="form-control" id="additional_copies" name="additional_copies" min="0" value="0">
+                        <label for="copies" class="form-label">Copies <small class="text-muted">(set / add)</small></label>
+                        <input type="number" class="form-control" id="copies" name="copies" value="{{ copies if copies is not none else '' }}">
                     </div>
-
-                    <div class="d-grid gap-2">
-                        <button type="submit" class="btn btn-success">
-                            <i class="fas fa-save"></i> Save Book
-                        </button>
-                        <a href="/admin" class="btn btn-secondary">
-                            <i class="fas fa-arrow-left"></i> Back to Admin Panel
-                        </a>
+                    <div class="mb-3">
+                        <label class="form-label">Details <small class="text-muted">(change details; blank fields are kept)</small></label>
+                        <input type="text" class="form-control mb-2" name="title" placeholder="Title" value="{{ fields.Title }}">
+                        <input type="text" class="form-control mb-2" name="author" placeholder="Author" value="{{ fields.Author }}">
+                        <input type="number" class="form-control" name="year" placeholder="Year" value="{{ fields.Year }}">
                     </div>
+                    <div class="form-text mb-3">All books are processed together: if one fails, none are changed.</div>
+                    <button type="submit" class="btn btn-primary w-100" {% if not selected %}disabled{% endif %}>
+                        <i class="fas fa-check-double"></i> Apply to All
+                    </button>
                 </form>
             </div>
         </div>
     </div>
+
+    <div class="col-md-7">
+        {% if results %}
+        <div class="card mb-4">
+            <div class="card-header">
+                <h5 class="mb-0">
+                    {{ 'Applied' if applied else 'Not applied' }}
+                    {% if failed %}<span class="badge bg-danger">{{ failed }} failed</span>{% endif %}
+                </h5>
+            </div>
+            <div class="card-body">
+                <table class="table table-striped mb-0">
+                    <thead>
+                        <tr><th>Book ID</th><th>Title</th><th>Result</th></tr>
+                    </thead>
+                    <tbody>
+                        {% for result in results %}
+                        <tr>
+                            <td><code>{{ result.book_id }}</code></td>
+                            <td>{{ result.title or '-' }}</td>
+                            <td>
+                                <span class="badge bg-{{ 'success' if result.ok else 'danger' }}">{{ result.message }}</span>
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+        {% endif %}
+
+        <div class="card">
+            <div class="card-header">
+                <h5 class="mb-0">Selection <span class="badge bg-primary">{{ selected }}</span></h5>
+            </div>
+            <div class="card-body">
+                {% if selection %}
+                <table class="table table-striped table-sm mb-0">
+                    <thead>
+                        <tr><th>Book ID</th><th>Title</th><th>Author</th><th>Year</th><th>Copies</th><th>Borrowed</th></tr>
+                    </thead>
+                    <tbody>
+                        {% for book_id, book in selection %}
+                        <tr>
+                            <td><code>{{ book_id }}</code></td>
+                            <td>{{ book.Title }}</td>
+                            <td>{{ book.Author }}</td>
+                            <td>{{ book.Year }}</td>
+                            <td>{{ book.TotalCopies }}</td>
+                            <td>{{ book.Borrowed }}</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% if selected > selection|length %}
+                <p class="text-muted small mt-2 mb-0">Showing the first {{ selection|length }} of {{ selected }}.</p>
+                {% endif %}
+                {% else %}
+                <p class="text-muted mb-0">No books selected. Use the filters or list book IDs.</p>
+                {% endif %}
+            </div>
+        </div>
+    </div>
 </div>'''
 
-UPDATE_BOOK_HTML = '''<div class="row justify-content-center">
+BRANCHES_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-map-marker-alt"></i> Branches</h2>
+    <a href="/books" class="btn btn-secondary">
+        <i class="fas fa-arrow-left"></i> Back to Books
+    </a>
+</div>
+
+<div class="row">
     <div class="col-md-8">
-        <div class="card">
+        <div class="card mb-4">
+            <div class="card-body">
+                {% if summary %}
+                <table class="table table-striped mb-0">
+                    <thead>
+                        <tr>
+                            <th>Branch</th><th>Titles</th><th>Copies</th><th>Available</th><th>Borrowed</th>
+                            {% if session.role == 'admin' %}<th></th>{% endif %}
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for name, totals in summary %}
+                        <tr>
+                            <td><strong>{{ name }}</strong></td>
+                            <td>{{ totals.Titles }}</td>
+                            <td>{{ totals.TotalCopies }}</td>
+                            <td class="available">{{ totals.Available }}</td>
+                            <td class="borrowed">{{ totals.Borrowed }}</td>
+                            {% if session.role == 'admin' %}
+                            <td class="text-end">
+                                {% if not totals.TotalCopies %}
+                                <form method="POST" action="/admin/branches/{{ name }}/delete" class="d-inline">
+                                    <button type="submit" class="btn btn-outline-danger btn-sm" title="Delete empty branch">
+                                        <i class="fas fa-trash"></i>
+                                    </button>
+                                </form>
+                                {% endif %}
+                            </td>
+                            {% endif %}
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                    <tfoot>
+                        <tr class="fw-bold">
+                            <td>All branches</td>
+                            <td></td>
+                            <td>{{ summary|sum(attribute='1.TotalCopies') }}</td>
+                            <td>{{ summary|sum(attribute='1.Available') }}</td>
+                            <td>{{ summary|sum(attribute='1.Borrowed') }}</td>
+                            {% if session.role == 'admin' %}<td></td>{% endif %}
+                        </tr>
+                    </tfoot>
+                </table>
+                {% else %}
+                <p class="text-muted mb-0">The library has no branches yet: every copy is held at a single site.</p>
+                {% endif %}
+            </div>
+        </div>
+
+        <div class="card mb-4">
             <div class="card-header">
-                <h4 class="mb-0"><i class="fas fa-edit"></i> Update Book: {{ book_id }}</h4>
+                <h5 class="mb-0"><i class="fas fa-search-location"></i> Where Is It?</h5>
             </div>
             <div class="card-body">
-                <form method="POST">
-                    <div class="mb-3">
-                        <label for="title" class="form-label">Book Title *</label>
-                        <input type="text" class="form-control" id="title" name="title" value="{{ book.Title }}" required>
+                <form method="GET" class="row g-2 mb-3">
+                    <div class="col">
+                        <input type="text" name="book_id" class="form-control" placeholder="Book ID" value="{{ book_id }}">
                     </div>
-                    
-                    <div class="row">
-                        <div class="col-md-6">
-                            <div class="mb-3">
-                                <label for="author" class="form-label">Author *</label>
-                                <input type="text" class="form-control" id="author" name="author" value="{{ book.Author }}" required>
-                            </div>
-                        </div>
-                        <div class="col-md-6">
-                            <div class="mb-3">
-                                <label for="year" class="form-label">Publication Year</label>
-                                <input type="text" class="form-control" id="year" name="year" value="{{ book.Year }}">
-                            </div>
-                        </div>
+                    <div class="col-auto">
+                        <button type="submit" class="btn btn-primary">Find</button>
                     </div>
+                </form>
+                {% if book_id %}
+                {% if book %}
+                <p><strong>{{ book.Title }}</strong> - {{ book.Available }}/{{ book.TotalCopies }} available across the network</p>
+                <ul class="list-group">
+                    {% for name, stock in availability %}
+                    <li class="list-group-item d-flex justify-content-between align-items-center">
+                        {{ name }}
+                        <span class="badge bg-{{ 'success' if stock.Available > 0 else 'danger' }}">
+                            {{ stock.Available }}/{{ stock.TotalCopies }} Available
+                        </span>
+                    </li>
+                    {% else %}
+                    <li class="list-group-item text-muted">Not held at any branch.</li>
+                    {% endfor %}
+                </ul>
+                {% else %}
+                <p class="text-muted mb-0">Book not found.</p>
+                {% endif %}
+                {% endif %}
+            </div>
+        </div>
+    </div>
 
+    {% if session.role == 'admin' %}
+    <div class="col-md-4">
+        <div class="card mb-4">
+            <div class="card-header">
+                <h5 class="mb-0"><i class="fas fa-plus"></i> Add Branch</h5>
+            </div>
+            <div class="card-body">
+                <form method="POST" action="/admin/branches">
                     <div class="mb-3">
-                        <label for="total_copies" class="form-label">Total Copies *</label>
-                        <input type="number" class="form-control" id="total_copies" name="total_copies" 
-                               value="{{ book.TotalCopies }}" min="{{ book.Borrowed }}" required>
-                        <div class="form-text">Cannot be less than currently borrowed copies ({{ book.Borrowed }})</div>
+                        <input type="text" name="branch" class="form-control" placeholder="e.g. main, north-end"
+                               pattern="[A-Za-z0-9_-]{1,32}" required>
+                        <div class="form-text">
+                            {% if summary %}New branches start empty; transfer copies to stock them.
+                            {% else %}The first branch takes over every existing copy.{% endif %}
+                        </div>
                     </div>
+                    <button type="submit" class="btn btn-success w-100">Add Branch</button>
+                </form>
+            </div>
+        </div>
 
-                    <div class="alert alert-warning">
-                        <i class="fas fa-exclamation-triangle"></i> 
-                        <strong>Current Status:</strong> 
-                        {{ book.Available }} available, {{ book.Borrowed }} borrowed out of {{ book.TotalCopies }} total copies.
+        {% if summary|length > 1 %}
+        <div class="card mb-4">
+            <div class="card-header">
+                <h5 class="mb-0"><i class="fas fa-exchange-alt"></i> Transfer Copies</h5>
+            </div>
+            <div class="card-body">
+                <form method="POST" action="/admin/branches/transfer">
+                    <div class="mb-2">
+                        <input type="text" name="book_id" class="form-control" placeholder="Book ID" value="{{ book_id }}" required>
                     </div>
-
-                    <div class="d-grid gap-2">
-                        <button type="submit" class="btn btn-primary">
-                            <i class="fas fa-save"></i> Update Book
-                        </button>
-                        <a href="/admin" class="btn btn-secondary">
-                            <i class="fas fa-arrow-left"></i> Back to Admin Panel
-                        </a>
+                    <div class="row g-2 mb-2">
+                        <div class="col">
+                            <select name="from_branch" class="form-select" title="From">
+                                {% for name, totals in summary %}<option value="{{ name }}">{{ name }}</option>{% endfor %}
+                            </select>
+                        </div>
+                        <div class="col">
+                            <select name="to_branch" class="form-select" title="To">
+                                {% for name, totals in summary %}<option value="{{ name }}" {% if loop.index == 2 %}selected{% endif %}>{{ name }}</option>{% endfor %}
+                            </select>
+                        </div>
+                    </div>
+                    <div class="mb-3">
+                        <input type="number" name="copies" class="form-control" min="1" value="1">
+                        <div class="form-text">Only copies on the shelf can be moved.</div>
                     </div>
+                    <button type="submit" class="btn btn-primary w-100">Transfer</button>
                 </form>
             </div>
         </div>
+        {% endif %}
     </div>
+    {% endif %}
 </div>'''
 
-USERS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
-    <h2><i class="fas fa-user-friends"></i> All Registered Users</h2>
+FINES_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-coins"></i> Overdue Fines</h2>
+    <a href="/admin/users" class="btn btn-secondary">
+        <i class="fas fa-arrow-left"></i> Back to Users
+    </a>
+</div>
+
+<div class="row mb-4">
+    <div class="col-md-4">
+        <div class="card bg-danger text-white">
+            <div class="card-body text-center">
+                <h5>Outstanding</h5>
+                <h3>{{ format_money(total_outstanding) }}</h3>
+            </div>
+        </div>
+    </div>
+    <div class="col-md-4">
+        <div class="card bg-warning text-white">
+            <div class="card-body text-center">
+                <h5>Overdue Loans</h5>
+                <h3>{{ overdue_count }}</h3>
+            </div>
+        </div>
+    </div>
+    <div class="col-md-4">
+        <div class="card bg-secondary text-white">
+            <div class="card-body text-center">
+                <h5>Patrons Owing</h5>
+                <h3>{{ patrons_owing }}</h3>
+            </div>
+        </div>
+    </div>
+</div>
+
+<div class="row">
+    <div class="col-md-8">
+        <div class="card mb-4">
+            <div class="card-body">
+                {% if loans %}
+                <table class="table table-striped">
+                    <thead>
+                        <tr><th>Patron</th><th>Book</th><th>Due</th><th>Days Late</th><th>Fine</th></tr>
+                    </thead>
+                    <tbody>
+                        {% for loan in loans %}
+                        <tr>
+                            <td>{{ loan.username }}</td>
+                            <td>{{ loan.book_title }} <code>{{ loan.book_id }}</code></td>
+                            <td>{{ loan.due }}</td>
+                            <td>{{ loan.days_late }}</td>
+                            <td>{% if loan.fine %}<strong>{{ format_money(loan.fine) }}</strong>{% else %}<span class="text-muted">grace</span>{% endif %}</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% if pages > 1 %}
+                <nav>
+                    <ul class="pagination mb-0">
+                        <li class="page-item {% if page <= 1 %}disabled{% endif %}">
+                            <a class="page-link" href="?page={{ page - 1 }}">Previous</a>
+                        </li>
+                        <li class="page-item disabled"><span class="page-link">Page {{ page }} of {{ pages }}</span></li>
+                        <li class="page-item {% if page >= pages %}disabled{% endif %}">
+                            <a class="page-link" href="?page={{ page + 1 }}">Next</a>
+                        </li>
+                    </ul>
+                </nav>
+                {% endif %}
+                {% else %}
+                <p class="text-muted mb-0">No loans are overdue.</p>
+                {% endif %}
+            </div>
+        </div>
+    </div>
+
+    <div class="col-md-4">
+        <div class="card mb-4">
+            <div class="card-header">
+                <h5 class="mb-0">Top Balances</h5>
+            </div>
+            <ul class="list-group list-group-flush">
+                {% for username, total in top_patrons %}
+                <li class="list-group-item d-flex justify-content-between">
+                    {{ username }} <strong>{{ format_money(total) }}</strong>
+                </li>
+                {% else %}
+                <li class="list-group-item text-muted">Nobody owes anything.</li>
+                {% endfor %}
+            </ul>
+        </div>
+        <div class="card">
+            <div class="card-header">
+                <h5 class="mb-0">Rates</h5>
+            </div>
+            <div class="card-body small">
+                <p>Loans are due {{ loan_period }} days after borrowing. Fines as of {{ day }}.</p>
+                <table class="table table-sm mb-0">
+                    <thead><tr><th>Role</th><th>Per Day</th><th>Grace</th><th>Cap</th></tr></thead>
+                    <tbody>
+                        {% for role, rule in rules %}
+                        <tr>
+                            <td>{{ role|title }}</td>
+                            <td>{{ format_money(rule.daily_rate) }}</td>
+                            <td>{{ rule.grace_days }} days</td>
+                            <td>{{ format_money(rule.cap) }}</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+    </div>
+</div>'''
+
+PROFILES_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-stopwatch"></i> Request Profiles</h2>
     <a href="/admin" class="btn btn-secondary">
         <i class="fas fa-arrow-left"></i> Back to Admin
     </a>
 </div>
 
-<div class="card">
+<p class="text-muted">
+    Add <code>?_profile=1</code> to any URL (or send an <code>X-Profile: 1</code> header) while logged in as an
+    admin to run that request under cProfile. The last {{ ring_size }} profiles are kept in memory.
+</p>
+
+{% for profile in profiles %}
+<div class="card mb-3">
+    <div class="card-header d-flex justify-content-between align-items-center">
+        <span>
+            <strong>#{{ profile.id }}</strong>
+            <code>{{ profile.method }} {{ profile.path }}</code>
+            <span class="badge bg-{{ 'success' if profile.status < 400 else 'danger' }}">{{ profile.status }}</span>
+            <span class="text-muted">{{ profile.started }} &middot; {{ profile.username }}</span>
+        </span>
+        <span>
+            <strong>{{ '%.1f'|format(profile.total_time * 1000) }} ms</strong>,
+            {{ profile.total_calls }} calls
+            <a href="/admin/profiles/{{ profile.id }}.prof" class="btn btn-outline-primary btn-sm ms-2">
+                <i class="fas fa-download"></i> .prof
+            </a>
+        </span>
+    </div>
     <div class="card-body">
-        <div class="table-responsive">
-            <table class="table table-striped">
+        {% if profile.highlights %}
+        <p class="mb-2">
+            {% for name, entry in profile.highlights.items() %}
+            <span class="badge bg-info text-dark me-1">{{ name }}: {{ '%.1f'|format(entry.cumtime * 1000) }} ms ({{ entry.calls }}x)</span>
+            {% endfor %}
+        </p>
+        {% endif %}
+        <details>
+            <summary>Top functions by cumulative time</summary>
+            <table class="table table-sm table-striped mt-2 mb-0">
                 <thead>
-                    <tr>
-                        <th>Username</th>
-                        <th>Role</th>
-                        <th>Status</th>
-                        <th>Borrowed Books</th>
-                    </tr>
+                    <tr><th>Function</th><th>Calls</th><th>Own (ms)</th><th>Cumulative (ms)</th></tr>
                 </thead>
                 <tbody>
-                    {% for username, user_info in users.items() %}
+                    {% for row in profile.top %}
                     <tr>
-                        <td>
-                            <i class="fas fa-user"></i> {{ username }}
-                            {% if username == session.username %}
-                            <span class="badge bg-info">You</span>
-                            {% endif %}
-                        </td>
-                        <td>
-                            <span class="badge bg-{{ 'danger' if user_info.role == 'admin' else 'primary' }}">
-                                {{ user_info.role|title }}
-                            </span>
-                        </td>
-                        <td>
-                            <span class="badge bg-success">Active</span>
-                        </td>
-                        <td>
-                            <span class="badge bg-warning">{{ get_user_borrowed_count(username) }}</span>
-                        </td>
+                        <td><code>{{ row.function }}</code></td>
+                        <td>{{ row.calls }}{% if row.primitive_calls != row.calls %}/{{ row.primitive_calls }}{% endif %}</td>
+                        <td>{{ '%.2f'|format(row.tottime * 1000) }}</td>
+                        <td>{{ '%.2f'|format(row.cumtime * 1000) }}</td>
                     </tr>
                     {% endfor %}
                 </tbody>
             </table>
-        </div>
+        </details>
     </div>
-</div>'''
+</div>
+{% else %}
+<div class="alert alert-info text-center">
+    <h4><i class="fas fa-stopwatch"></i> No Profiles Yet</h4>
+    <p>Profile a page by adding <code>?_profile=1</code> to its URL.</p>
+</div>
+{% endfor %}'''
 
-STATS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
-    <h2><i class="fas fa-chart-bar"></i> Detailed Library Statistics</h2>
+MEMORY_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-memory"></i> Memory</h2>
     <a href="/admin" class="btn btn-secondary">
         <i class="fas fa-arrow-left"></i> Back to Admin
     </a>
 </div>
 
 <div class="row mb-4">
-    <div class="col-md-3">
-        <div class="card bg-primary text-white">
-            <div class="card-body text-center">
-                <h6>Unique Books</h6>
-                <h3>{{ total_unique_books }}</h3>
-            </div>
-        </div>
-    </div>
-    <div class="col-md-3">
-        <div class="card bg-info text-white">
-            <div class="card-body text-center">
-                <h6>Total Copies</h6>
-                <h3>{{ total_all_copies }}</h3>
-            </div>
-        </div>
-    </div>
-    <div class="col-md-3">
-        <div class="card bg-success text-white">
-            <div class="card-body text-center">
-                <h6>Available</h6>
-                <h3>{{ total_available }}</h3>
+    <div class="col-md-6">
+        <div class="card h-100">
+            <div class="card-header"><h5 class="mb-0">Dataset &amp; Index Sizes (estimated)</h5></div>
+            <div class="card-body">
+                <table class="table table-sm mb-0">
+                    <thead><tr><th>Structure</th><th>Records</th><th>Size</th></tr></thead>
+                    <tbody>
+                        {% for name, entry in datasets.items() %}
+                        <tr><td>{{ name }}</td><td>{{ entry.records }}</td><td>{{ '%.1f'|format(entry.bytes / 1024) }} KiB</td></tr>
+                        {% endfor %}
+                        {% for name, size in indexes.items() %}
+                        <tr><td>{{ name }} index</td><td>-</td><td>{{ '%.1f'|format(size / 1024) }} KiB</td></tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
             </div>
         </div>
     </div>
-    <div class="col-md-3">
-        <div class="card bg-warning text-white">
-            <div class="card-body text-center">
-                <h6>Borrowed</h6>
-                <h3>{{ total_borrowed }}</h3>
+    <div class="col-md-6">
+        <div class="card h-100">
+            <div class="card-header"><h5 class="mb-0">tracemalloc</h5></div>
+            <div class="card-body">
+                {% if status.tracing %}
+                <p class="mb-1"><strong>Traced:</strong> {{ '%.1f'|format(status.traced_bytes / 1048576) }} MiB
+                    (peak {{ '%.1f'|format(status.peak_bytes / 1048576) }} MiB)</p>
+                <p class="mb-1"><strong>Tracing overhead:</strong> {{ '%.1f'|format(status.overhead_bytes / 1048576) }} MiB,
+                    {{ status.frames }} frames per trace</p>
+                <p><strong>Baseline:</strong> {{ status.baseline or 'none' }}</p>
+                <form method="POST" class="d-flex gap-2">
+                    <button name="action" value="baseline" class="btn btn-primary btn-sm">Take Baseline</button>
+                    <button name="action" value="snapshot" class="btn btn-info btn-sm">Snapshot &amp; Diff</button>
+                    <button name="action" value="stop" class="btn btn-outline-danger btn-sm">Stop Tracing</button>
+                </form>
+                {% else %}
+                <p class="text-muted">Tracing is off. It slows every allocation down, so only turn it on while investigating.</p>
+                <form method="POST">
+                    <button name="action" value="start" class="btn btn-warning btn-sm">Start Tracing</button>
+                </form>
+                {% endif %}
             </div>
         </div>
     </div>
 </div>
 
+{% if report %}
 <div class="card">
-    <div class="card-header">
-        <h5 class="mb-0"><i class="fas fa-book"></i> Book-wise Breakdown</h5>
-    </div>
+    <div class="card-header"><h5 class="mb-0">Top Allocations by Function{% if status.baseline %} (vs baseline){% endif %}</h5></div>
     <div class="card-body">
-        {% for book_id, book in books.items() %}
-        <div class="mb-4 p-3 border rounded">
-            <h6>{{ book.Title }} <small class="text-muted">by {{ book.Author }} ({{ book.Year }})</small></h6>
-            <div class="row">
-                <div class="col-md-6">
-                    <p class="mb-1">Book ID: <code>{{ book_id }}</code></p>
-                    <p class="mb-1">Total Copies: {{ book.TotalCopies }}</p>
-                    <p class="mb-1">Available: <span class="available">{{ book.Available }}</span></p>
-                    <p class="mb-0">Borrowed: <span class="borrowed">{{ book.Borrowed }}</span></p>
-                </div>
-                <div class="col-md-6">
-                    {% if book.TotalCopies > 0 %}
-                    {% set borrowed_pct = (book.Borrowed / book.TotalCopies) * 100 %}
-                    <div class="progress mb-2" style="height: 20px;">
-                        <div class="progress-bar bg-warning" style="width: {{ borrowed_pct }}%">
-                            {{ "%.0f"|format(borrowed_pct) }}% Borrowed
-                        </div>
-                    </div>
-                    <small class="text-muted">
-                        Utilization: {{ "%.1f"|format(borrowed_pct) }}%
-                    </small>
+        <table class="table table-sm table-striped mb-0">
+            <thead>
+                <tr><th>Function</th><th>Size</th><th>Blocks</th>{% if status.baseline %}<th>Size &Delta;</th><th>Blocks &Delta;</th>{% endif %}</tr>
+            </thead>
+            <tbody>
+                {% for row in report %}
+                <tr>
+                    <td><code>{{ row.function }}</code></td>
+                    <td>{{ '%.1f'|format(row.bytes / 1024) }} KiB</td>
+                    <td>{{ row.blocks }}</td>
+                    {% if status.baseline %}
+                    <td>{{ '%+.1f'|format(row.bytes_diff / 1024) }} KiB</td>
+                    <td>{{ '%+d'|format(row.blocks_diff) }}</td>
                     {% endif %}
-                </div>
-            </div>
-        </div>
-        {% endfor %}
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
     </div>
-</div>'''
+</div>
+{% endif %}'''
 
-BORROW_HISTORY_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
-    <h2><i class="fas fa-history"></i> Borrow History</h2>
+JOBS_HTML = '''<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2><i class="fas fa-tasks"></i> Background Jobs</h2>
     <a href="/admin" class="btn btn-secondary">
         <i class="fas fa-arrow-left"></i> Back to Admin
     </a>
 </div>
 
+<div class="card mb-4">
+    <div class="card-body">
+        <div class="row g-3">
+            <div class="col-md-3">
+                <form method="POST" action="/admin/jobs" class="d-grid">
+                    <input type="hidden" name="kind" value="stats">
+                    <button type="submit" class="btn btn-info"><i class="fas fa-chart-bar"></i> Full Statistics Report</button>
+                </form>
+            </div>
+            <div class="col-md-3">
+                <form method="POST" action="/admin/jobs" class="d-grid">
+                    <input type="hidden" name="kind" value="export">
+                    <button type="submit" class="btn btn-primary"><i class="fas fa-file-export"></i> Export Data</button>
+                </form>
+            </div>
+            <div class="col-md-3">
+                <form method="POST" action="/admin/jobs" enctype="multipart/form-data">
+                    <input type="hidden" name="kind" value="import">
+                    <div class="input-group">
+                        <input type="file" name="file" class="form-control" required>
+                        <button type="submit" class="btn btn-success"><i class="fas fa-file-import"></i> Import</button>
+                    </div>
+                    <div class="form-text">Lines of id,title,author,year,copies</div>
+                </form>
+            </div>
+            <div class="col-md-3">
+                <form method="POST" action="/admin/jobs">
+                    <input type="hidden" name="kind" value="reconcile">
+                    <button type="submit" class="btn btn-secondary w-100"><i class="fas fa-balance-scale"></i> Reconcile Counts</button>
+                    <div class="form-check form-check-inline mt-1">
+                        <input class="form-check-input" type="checkbox" name="full" value="1" id="reconcile-full">
+                        <label class="form-check-label small" for="reconcile-full">Full scan</label>
+                    </div>
+                    <div class="form-check form-check-inline">
+                        <input class="form-check-input" type="checkbox" name="repair" value="1" id="reconcile-repair">
+                        <label class="form-check-label small" for="reconcile-repair">Repair</label>
+                    </div>
+                </form>
+            </div>
+            <div class="col-md-3">
+                <form method="POST" action="/admin/jobs">
+                    <input type="hidden" name="kind" value="compact">
+                    <div class="input-group">
+                        <input type="number" name="days" class="form-control" value="365" min="1">
+                        <button type="submit" class="btn btn-warning"><i class="fas fa-compress"></i> Compact</button>
+                    </div>
+                    <div class="form-text">Archive loans returned more than this many days ago</div>
+                </form>
+            </div>
+        </div>
+    </div>
+</div>
+
+{% if jobs %}
 <div class="card">
     <div class="card-body">
-        <div class="table-responsive">
-            <table class="table table-striped">
-                <thead>
-                    <tr>
-                        <th>Username</th>
-                        <th>Book ID</th>
-                        <th>Book Title</th>
-                        <th>Borrow Date</th>
-                        <th>Return Date</th>
-                        <th>Status</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {% for record in borrow_history %}
-                    <tr>
-                        <td>{{ record.username }}</td>
-                        <td><code>{{ record.book_id }}</code></td>
-                        <td>{{ record.book_title }}</td>
-                        <td>{{ record.borrow_date }}</td>
-                        <td>{{ record.return_date if record.return_date else 'Not returned' }}</td>
-                        <td>
-                            <span class="badge bg-{{ 'success' if record.return_date else 'warning' }}">
-                                {{ 'Returned' if record.return_date else 'Borrowed' }}
-                            </span>
-                        </td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
-            </table>
-        </div>
+        <table class="table table-striped mb-0">
+            <thead>
+                <tr><th>Job</th><th>Submitted</th><th>By</th><th>Status</th><th>Progress</th><th>Message</th><th></th></tr>
+            </thead>
+            <tbody>
+                {% for job in jobs %}
+                <tr data-job-id="{{ job.job_id }}" data-status="{{ job.status }}">
+                    <td>{{ job.label }} <code>{{ job.job_id }}</code></td>
+                    <td>{{ job.submitted }}</td>
+                    <td>{{ job.username }}</td>
+                    <td>
+                        <span class="badge bg-{{ {'done': 'success', 'failed': 'danger', 'cancelled': 'secondary'}.get(job.status, 'info') }}">{{ job.status }}</span>
+                    </td>
+                    <td style="min-width: 120px">
+                        <div class="progress"><div class="progress-bar" style="width: {{ job.progress }}%">{{ job.progress }}%</div></div>
+                    </td>
+                    <td class="job-message">{{ job.message }}</td>
+                    <td>
+                        {% if job.result %}
+                        <a href="/admin/jobs/{{ job.job_id }}/result" class="btn btn-outline-primary btn-sm">
+                            <i class="fas fa-download"></i> {{ job.result }}
+                        </a>
+                        {% elif job.status in ('queued', 'running') %}
+                        <form method="POST" action="/admin/jobs/{{ job.job_id }}/cancel">
+                            <button type="submit" class="btn btn-outline-danger btn-sm">Cancel</button>
+                        </form>
+                        {% endif %}
+                    </td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
     </div>
-</div>'''
+</div>
+{% else %}
+<div class="alert alert-info text-center">
+    <h4><i class="fas fa-tasks"></i> No Jobs Yet</h4>
+</div>
+{% endif %}
+
+<script>
+// Poll unfinished jobs and reload once they are all done
+(function () {
+    var rows = document.querySelectorAll('tr[data-status="queued"], tr[data-status="running"]');
+    if (!rows.length) return;
+    var timer = setInterval(function () {
+        var pending = Array.prototype.map.call(rows, function (row) {
+            return fetch('/admin/jobs/' + row.dataset.jobId)
+                .then(function (response) { return response.json(); })
+                .then(function (job) {
+                    var bar = row.querySelector('.progress-bar');
+                    bar.style.width = job.progress + '%';
+                    bar.textContent = job.progress + '%';
+                    row.querySelector('.job-message').textContent = job.message;
+                    return job.status === 'queued' || job.status === 'running';
+                });
+        });
+        Promise.all(pending).then(function (active) {
+            if (active.indexOf(true) === -1) {
+                clearInterval(timer);
+                window.location.reload();
+            }
+        });
+    }, 1000);
+})();
+</script>'''
 
 CHANGE_PASSWORD_HTML = '''<div class="row justify-content-center">
     <div class="col-md-6">
@@ -946,6 +6000,17 @@ CHANGE_PASSWORD_HTML = '''<div class="row justify-content-center">
 
 # ============= WEB ROUTES =============
 
+@app.before_request
+def check_dataset_versions():
+    # One shared-memory read per request; only changed files are re-read
+    refresh_snapshot()
+
+@app.route('/ready')
+def readiness():
+    """Readiness probe: 200 once data and indexes are warm, 503 until then"""
+    status = warm_up_status.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route('/', methods=['GET', 'POST'])
 def home():
     if request.method == 'POST':
@@ -962,13 +6027,23 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        users = load_users()
-        if username in users and users[username]['password'] == password:
+        user = get_users().get(username)
+        if user is not None and check_password(user['password'], password):
+            if password_needs_rehash(user['password']):
+                # Plain-text or differently tuned hash: store it at today's cost
+                new_hash = hash_password(password)
+                with library_transaction() as txn:
+                    if txn.users.get(username) == user:
+                        txn.update_user(username, password=new_hash)
+                        txn.commit()
             session['username'] = username
-            session['role'] = users[username]['role']
+            session['role'] = user['role']
             flash(f'Login successful! Welcome {username}', 'success')
             return redirect(url_for('dashboard'))
         else:
+            wait = charge_failed_login(username)
+            if wait:
+                return too_many_requests(wait)
             flash('Invalid username or password!', 'error')
     
     # GET request - show login page
@@ -981,21 +6056,27 @@ def register():
         password = request.form['password']
         confirm_password = request.form['confirm_password']
         
-        users = load_users()
-        
         if not username:
             flash('Username cannot be empty!', 'error')
-        elif username in users:
+        elif not USERNAME_PATTERN.fullmatch(username):
+            flash('Usernames cannot contain "|" or spaces!', 'error')
+        elif username in get_users():
             flash('Username already exists!', 'error')
         elif password != confirm_password:
             flash('Passwords do not match!', 'error')
         elif len(password) < 4:
             flash('Password must be at least 4 characters!', 'error')
         else:
-            users[username] = {"password": password, "role": "member"}
-            save_users(users)
-            flash('Registration successful! You can now login.', 'success')
-            return redirect(url_for('login'))
+            # Hashed before taking the write lock, so other writers don't wait on it
+            password_hash = hash_password(password)
+            with library_transaction() as txn:
+                if username in txn.users:
+                    flash('Username already exists!', 'error')
+                else:
+                    txn.put_user(username, {"password": password_hash, "role": "member"})
+                    txn.commit()
+                    flash('Registration successful! You can now login.', 'success')
+                    return redirect(url_for('login'))
     
     # GET request - show registration page
     return render_template_string(BASE_HTML.replace('{% block content %}{% endblock %}', REGISTER_HTML))
@@ -1003,7 +6084,7 @@ def register():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    books = load_from_file(BOOKS_FILE)
+    books = get_books()
     total_books = len(books)
     total_available = sum(book['Available'] for book in books.values())
     total_borrowed = sum(book['Borrowed'] for book in books.values())
@@ -1022,7 +6103,7 @@ def dashboard():
 @app.route('/my-books')
 @login_required
 def my_books():
-    books = load_from_file(BOOKS_FILE)
+    books = get_books()
     user_borrowed_ids = get_user_borrowed_books(session['username'])
     
     my_books = {}
@@ -1030,113 +6111,362 @@ def my_books():
         if book_id in books:
             my_books[book_id] = books[book_id]
     
+    history = {borrow['book_id'] for borrow in get_borrows().get(session['username'], ())}
+    suggested = [(book_id, books[book_id])
+                 for book_id, users in cooccurrence_index.recommend(history) if book_id in books]
+    
     return render_template_string(
         BASE_HTML.replace('{% block content %}{% endblock %}', MY_BOOKS_HTML),
-        my_books=my_books
+        my_books=my_books,
+        recommendations=book_recommendations(books, my_books),
+        suggested=suggested,
+        fines=fine_engine.for_user(session['username']),
+        fine_total=fine_engine.table().totals.get(session['username'], 0),
+        loan_period=LOAN_PERIOD_DAYS,
+        format_money=format_money,
+        branches=sorted(get_branches()),
+        lent_from={book_id: (open_loan(session['username'], book_id) or {}).get('branch') for book_id in my_books}
     )
 
-@app.route('/books')
-@login_required
-def view_books():
-    books = load_from_file(BOOKS_FILE)
+def book_recommendations(books, book_ids, limit=3):
+    """{book_id: [(other_id, title), ...]} of books most often borrowed alongside each"""
+    recommendations = {}
+    for book_id in book_ids:
+        others = [(other_id, books[other_id]['Title'])
+                  for other_id, users in cooccurrence_index.neighbours(book_id) if other_id in books]
+        if others:
+            recommendations[book_id] = others[:limit]
+    return recommendations
+
+def parse_int_arg(name):
+    """Optional integer query parameter; blank or invalid values are ignored"""
+    try:
+        return int(request.args.get(name, '').strip())
+    except ValueError:
+        return None
+
+def book_filters(available_only=False):
+    """The search term and facet filters of a /books-style query string"""
     search_term = request.args.get('search', '')
-    
-    if search_term:
+    filters = {
+        'year_from': parse_int_arg('year_from'),
+        'year_to': parse_int_arg('year_to'),
+        'author': request.args.get('author', '').strip(),
+        'available': available_only or request.args.get('available') == '1',
+        'min_copies': parse_int_arg('min_copies'),
+    }
+    return search_term, filters
+
+def facet_books(books, filters):
+    """The books matching every facet filter, or None when no facet is set"""
+    book_ids = facet_index.search(
+        year_from=filters['year_from'],
+        year_to=filters['year_to'],
+        author=filters['author'],
+        available_only=filters['available'],
+        min_copies=filters['min_copies']
+    )
+    if book_ids is None:
+        return None
+    return {book_id: books[book_id] for book_id in book_ids if book_id in books}
+
+def search_books(books, search_term):
+    """The books whose title or author contains search_term, ignoring case"""
+    hits = trigram_index.substring_matches(search_term)
+    if hits is None:
+        # Too short for the trigram index: plain substring scan
         filtered_books = {}
         for book_id, book in books.items():
             if (search_term.lower() in book['Title'].lower() or 
                 search_term.lower() in book['Author'].lower()):
                 filtered_books[book_id] = book
+        return filtered_books
+    return {book_id: books[book_id] for book_id in hits if book_id in books}
+
+def render_books_page(available_only=False):
+    """Book grid for /books and /books/available with search and facet filters"""
+    books = get_books()
+    search_term, filters = book_filters(available_only)
+    
+    faceted = facet_books(books, filters)
+    if faceted is not None:
+        books = faceted
+    
+    close_matches = set()
+    if search_term:
+        filtered_books = search_books(books, search_term)
+        
+        # Typo-tolerant matches ("Jhon Smith", "Wilsen") after the exact ones
+        for book_id, score in trigram_index.similar(search_term):
+            if book_id in books and book_id not in filtered_books:
+                filtered_books[book_id] = books[book_id]
+                close_matches.add(book_id)
         books = filtered_books
     
+    filtered = faceted is not None or bool(search_term)
+    facets = facet_index.facet_counts(books.keys() if filtered else None)
     user_borrowed_ids = get_user_borrowed_books(session['username'])
     
     return render_template_string(
         BASE_HTML.replace('{% block content %}{% endblock %}', BOOKS_HTML),
         books=books, 
         search_term=search_term,
+        available_only=available_only,
+        filters=filters,
+        facets=facets,
+        close_matches=close_matches,
+        recommendations=book_recommendations(get_books(), books),
+        branch_stock={book_id: branch_index.availability(book_id) for book_id in books} if get_branches() else {},
         role=session['role'],
-        user_borrowed_ids=user_borrowed_ids
+        user_borrowed_ids=user_borrowed_ids,
+        stream_retry_ms=STREAM_REFUSED_RETRY_MS
+    )
+
+HISTORY_PAGE_SIZE = 20
+
+def parse_date_arg(name):
+    """Optional YYYY-MM-DD query parameter; blank or invalid values are ignored"""
+    value = request.args.get(name, '').strip()
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+@app.route('/my-history')
+@login_required
+def my_history():
+    """The patron's own loans, newest first, from the per-user history index"""
+    books = get_books()
+    date_from, date_to = parse_date_arg('from'), parse_date_arg('to')
+    page = max(1, parse_int_arg('page') or 1)
+    loans, total = loan_history_index.page(session['username'], date_from, date_to, page, HISTORY_PAGE_SIZE)
+    
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', MY_HISTORY_HTML),
+        loans=[{**loan, 'book_title': books.get(loan['book_id'], {}).get('Title', 'Unknown Book')} for loan in loans],
+        total=total,
+        page=page,
+        pages=max(1, -(-total // HISTORY_PAGE_SIZE)),
+        date_from=date_from,
+        date_to=date_to
     )
 
+@app.route('/books')
+@login_required
+def view_books():
+    return render_books_page()
+
 @app.route('/books/available')
 @login_required
 def available_books():
-    books = load_from_file(BOOKS_FILE)
-    available_books = {id: book for id, book in books.items() if book['Available'] > 0}
-    user_borrowed_ids = get_user_borrowed_books(session['username'])
+    return render_books_page(available_only=True)
+
+@app.route('/books/stream')
+@login_required
+def books_stream():
+    """Server-sent availability deltas for the open /books pages"""
+    subscriber = availability_feed.subscribe()
+    if subscriber is None:
+        return Response(f"retry: {STREAM_REFUSED_RETRY_MS}\n\n", status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(STREAM_REFUSED_RETRY_MS // 1000)})
+    response = Response(availability_events(subscriber), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also when the client is gone before the generator ever started
+    response.call_on_close(lambda: availability_feed.unsubscribe(subscriber))
+    return response
+
+@app.route('/books/<book_id>')
+@login_required
+def book_detail(book_id):
+    """One book: details, branch stock, and for admins its borrowers and paged loan history"""
+    books = get_books()
+    book = books.get(book_id)
+    if book is None:
+        flash('Book not found!', 'error')
+        return redirect(url_for('view_books'))
+    
+    page = max(1, parse_int_arg('page') or 1)
+    borrowers, history, total = [], [], 0
+    if session['role'] == 'admin':
+        borrowers = [{'username': username, **loan, **fine_engine.for_user(username).get(book_id, {})}
+                     for username, loan in book_loan_index.borrowers(book_id)]
+        rows, total = book_loan_index.page(book_id, page, HISTORY_PAGE_SIZE)
+        history = [{'username': username, **loan} for username, loan in rows]
     
     return render_template_string(
-        BASE_HTML.replace('{% block content %}{% endblock %}', BOOKS_HTML),
-        books=available_books, 
-        available_only=True,
+        BASE_HTML.replace('{% block content %}{% endblock %}', BOOK_HTML),
+        book_id=book_id,
+        book=book,
         role=session['role'],
-        user_borrowed_ids=user_borrowed_ids
+        borrowed=is_book_borrowed_by_user(session['username'], book_id),
+        branch_stock=branch_index.availability(book_id),
+        together=book_recommendations(books, [book_id], limit=5).get(book_id, []),
+        loan_count=loan_counters.total_by_book[book_id],
+        borrowers=borrowers,
+        history=history,
+        total=total,
+        page=page,
+        pages=max(1, -(-total // HISTORY_PAGE_SIZE)),
+        format_money=format_money
+    )
+
+@app.route('/branches')
+@login_required
+def view_branches():
+    """Per-branch totals and a per-book "which branch has it" lookup"""
+    book_id = request.args.get('book_id', '').strip()
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', BRANCHES_HTML),
+        summary=branch_index.summary(),
+        book_id=book_id,
+        book=get_books().get(book_id),
+        availability=branch_index.availability(book_id)
+    )
+
+@app.route('/api/books/<book_id>/availability')
+@login_required
+def book_availability(book_id):
+    """Network-wide and per-branch copy counts of one book, as JSON"""
+    book = get_books().get(book_id)
+    if book is None:
+        return jsonify(error='Book not found'), 404
+    return jsonify(
+        book_id=book_id,
+        available=book['Available'],
+        total=book['TotalCopies'],
+        branches=[{'branch': branch, 'available': stock['Available'], 'borrowed': stock['Borrowed'],
+                   'total': stock['TotalCopies']} for branch, stock in branch_index.availability(book_id)]
     )
 
+@app.route('/api/autocomplete')
+@login_required
+def autocomplete():
+    """Top title/author completions for a search-box prefix, as JSON"""
+    prefix = request.args.get('q', '')
+    limit = min(parse_int_arg('k') or PrefixIndex.TOP_K, PrefixIndex.TOP_K)
+    return jsonify(query=prefix, suggestions=prefix_index.complete(prefix, limit))
+
 @app.route('/borrow/<book_id>')
 @login_required
 def borrow_book(book_id):
-    books = load_from_file(BOOKS_FILE)
     username = session['username']
     
-    if book_id in books:
-        book = books[book_id]
+    with library_transaction() as txn:
+        book = txn.books.get(book_id)
+        branch, branch_error = lending_branch(txn, book_id, request.args.get('branch', '').strip())
         
-        if book["Available"] > 0:
-            if is_book_borrowed_by_user(username, book_id):
-                flash(f'You have already borrowed "{book["Title"]}"!', 'error')
-                return redirect(url_for('view_books'))
-            
-            book["Available"] -= 1
-            book["Borrowed"] += 1
-            
-            if borrow_book_for_user(username, book_id):
-                if save_to_file(books, BOOKS_FILE):
-                    flash(f'You have borrowed "{book["Title"]}" successfully!', 'success')
-                else:
-                    flash('Error saving data!', 'error')
-            else:
-                flash('Error recording borrow!', 'error')
-        else:
+        if book is None:
+            flash('Book not found!', 'error')
+        elif book["Available"] <= 0:
             flash(f'Sorry, all copies of "{book["Title"]}" are borrowed.', 'error')
-    else:
-        flash('Book not found!', 'error')
+        elif is_book_borrowed_by_user(username, book_id):
+            flash(f'You have already borrowed "{book["Title"]}"!', 'error')
+        elif branch_error:
+            flash(f'{branch_error}!', 'error')
+        elif not borrow_book_for_user(username, book_id, branch):
+            flash('Error recording borrow!', 'error')
+        else:
+            txn.update_book(book_id, Available=book["Available"] - 1, Borrowed=book["Borrowed"] + 1)
+            if txn.commit():
+                flash(f'You have borrowed "{book["Title"]}"{f" from {branch}" if branch else ""} successfully!', 'success')
+            else:
+                flash('Error saving data!', 'error')
     
     return redirect(url_for('view_books'))
 
 @app.route('/return/<book_id>')
 @login_required
 def return_book(book_id):
-    books = load_from_file(BOOKS_FILE)
     username = session['username']
+    branch = request.args.get('branch', '').strip() or None
     
-    if book_id in books:
-        book = books[book_id]
+    with library_transaction() as txn:
+        book = txn.books.get(book_id)
+        loan = open_loan(username, book_id)
         
-        if is_book_borrowed_by_user(username, book_id):
-            book["Available"] += 1
-            book["Borrowed"] -= 1
-            
-            if return_book_for_user(username, book_id):
-                if save_to_file(books, BOOKS_FILE):
-                    flash(f'"{book["Title"]}" returned successfully!', 'success')
-                else:
-                    flash('Error saving data!', 'error')
-            else:
-                flash('Error recording return!', 'error')
-        else:
+        if book is None:
+            flash('Book not found!', 'error')
+        elif loan is None:
             flash('You cannot return this book as you have not borrowed it!', 'error')
-    else:
-        flash('Book not found!', 'error')
+        elif branch and branch not in txn.branches:
+            flash(f'Unknown branch "{branch}"!', 'error')
+        elif not return_book_for_user(username, book_id):
+            flash('Error recording return!', 'error')
+        else:
+            stage_branch_return(txn, book_id, loan.get('branch'), branch)
+            txn.update_book(book_id, Available=book["Available"] + 1, Borrowed=book["Borrowed"] - 1)
+            if txn.commit():
+                flash(f'"{book["Title"]}" returned successfully!', 'success')
+            else:
+                flash('Error saving data!', 'error')
     
     return redirect(url_for('view_books'))
 
+@app.route('/checkout', methods=['GET', 'POST'])
+@login_required
+def batch_checkout():
+    """Borrow or return a list of books in one all-or-nothing transaction.
+
+    Accepts the desk form (or the selection forms on /books and /my-books),
+    or a JSON body {"action": ..., "book_ids": [...], "username": ...}
+    answered with per-item results as JSON.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if request.is_json and (data is not None or request.method == 'POST'):
+        json_book_ids = parse_json_batch(data, ('action', 'branch', 'username'))
+        if json_book_ids is None:
+            return jsonify(error='Expected a JSON object with a "book_ids" list'), 400
+    source = data if data is not None else request.form
+    action = str(source.get('action') or 'borrow')
+    branch = str(source.get('branch') or '').strip() or None
+    patron = session['username']
+    book_ids = []
+    applied, results = False, []
+    
+    if request.method == 'POST':
+        if data is not None:
+            book_ids = json_book_ids
+        else:
+            book_ids = parse_book_ids(request.form.getlist('book_ids'))
+        
+        # Librarians at the desk can check books in and out for any patron
+        if session.get('role') == 'admin' and source.get('username'):
+            patron = str(source.get('username')).strip()
+        
+        if patron not in get_users():
+            results = [{'book_id': book_id, 'title': None, 'ok': False, 'message': 'Unknown patron'}
+                       for book_id in book_ids]
+        elif action == 'return':
+            applied, results = return_books_for_user(patron, book_ids, branch)
+        else:
+            applied, results = borrow_books_for_user(patron, book_ids, branch)
+        
+        if data is not None:
+            return jsonify(applied=applied, username=patron, action=action, results=results)
+        
+        if not book_ids:
+            flash('Please select at least one book!', 'error')
+        elif applied:
+            flash(f'{len(results)} book(s) {"returned" if action == "return" else "borrowed"} successfully!', 'success')
+        else:
+            flash('No changes were made - see the results below.', 'error')
+    
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', CHECKOUT_HTML),
+        action=action,
+        patron=patron if patron != session['username'] else '',
+        branch=branch,
+        branches=sorted(get_branches()),
+        book_ids=book_ids,
+        applied=applied,
+        results=results
+    )
+
 @app.route('/admin')
 @admin_required
 def admin_panel():
-    books = load_from_file(BOOKS_FILE)
-    users = load_users()
+    books = get_books()
+    users = get_users()
     
     total_unique_books = len(books)
     total_all_copies = sum(book['TotalCopies'] for book in books.values())
@@ -1152,10 +6482,21 @@ def admin_panel():
         total_users=len(users)
     )
 
+@app.route('/admin/recommendations/rebuild', methods=['POST'])
+@admin_required
+def rebuild_recommendations():
+    """Recompute the "borrowed together" counts in the background"""
+    job = job_runner.submit('recommendations', session['username'])
+    if job is None:
+        flash('The job queue is full, please try again shortly.', 'error')
+        return redirect(url_for('admin_panel'))
+    flash(f'{JOB_TYPES["recommendations"][0]} started (job {job.job_id}).', 'success')
+    return redirect(url_for('admin_jobs'))
+
 @app.route('/admin/add-book', methods=['GET', 'POST'])
 @admin_required
 def add_book():
-    books = load_from_file(BOOKS_FILE)
+    books = get_books()
     
     if request.method == 'POST':
         book_id = request.form['book_id']
@@ -1172,38 +6513,49 @@ def add_book():
             flash('Invalid number for copies!', 'error')
             return redirect(url_for('add_book'))
         
-        if book_id in books:
-            try:
-                copies = int(request.form.get('additional_copies', 0))
-                if copies > 0:
-                    books[book_id]['TotalCopies'] += copies
-                    books[book_id]['Available'] += copies
-                    if save_to_file(books, BOOKS_FILE):
-                        flash(f'Added {copies} copies to existing book!', 'success')
-                else:
-                    flash('No additional copies added.', 'info')
-            except ValueError:
-                flash('Invalid number for additional copies!', 'error')
-        else:
-            books[book_id] = {
-                "Title": book_name,
-                "Author": author_name,
-                "Year": year_published,
-                "TotalCopies": total_copies,
-                "Available": total_copies,
-                "Borrowed": 0
-            }
-            if save_to_file(books, BOOKS_FILE):
-                flash('Book added successfully!', 'success')
+        with library_transaction() as txn:
+            branch = request.form.get('branch')
+            if branch not in txn.branches:
+                branch = None  # the commit shelves them at the book's main branch
+            if book_id in txn.books:
+                try:
+                    copies = int(request.form.get('additional_copies', 0))
+                    if copies > 0:
+                        book = txn.books[book_id]
+                        txn.update_book(book_id,
+                                        TotalCopies=book['TotalCopies'] + copies,
+                                        Available=book['Available'] + copies)
+                        if branch:
+                            txn.adjust_holding(branch, book_id, copies)
+                        if txn.commit():
+                            flash(f'Added {copies} copies to existing book!', 'success')
+                    else:
+                        flash('No additional copies added.', 'info')
+                except ValueError:
+                    flash('Invalid number for additional copies!', 'error')
+            else:
+                txn.put_book(book_id, {
+                    "Title": book_name,
+                    "Author": author_name,
+                    "Year": year_published,
+                    "TotalCopies": total_copies,
+                    "Available": total_copies,
+                    "Borrowed": 0
+                })
+                if branch:
+                    txn.adjust_holding(branch, book_id, total_copies)
+                if txn.commit():
+                    flash('Book added successfully!', 'success')
         
         return redirect(url_for('admin_panel'))
     
-    return render_template_string(BASE_HTML.replace('{% block content %}{% endblock %}', ADD_BOOK_HTML), books=books)
+    return render_template_string(BASE_HTML.replace('{% block content %}{% endblock %}', ADD_BOOK_HTML), books=books,
+                                  branches=sorted(get_branches()))
 
 @app.route('/admin/update-book/<book_id>', methods=['GET', 'POST'])
 @admin_required
 def update_book(book_id):
-    books = load_from_file(BOOKS_FILE)
+    books = get_books()
     
     if book_id not in books:
         flash('Book not found!', 'error')
@@ -1212,24 +6564,29 @@ def update_book(book_id):
     book = books[book_id]
     
     if request.method == 'POST':
-        book['Title'] = request.form['title']
-        book['Author'] = request.form['author']
-        book['Year'] = request.form['year']
-        
         try:
             new_copies = int(request.form['total_copies'])
-            if new_copies >= book['Borrowed']:
-                book['Available'] = new_copies - book['Borrowed']
-                book['TotalCopies'] = new_copies
-            else:
-                flash('Total copies cannot be less than borrowed copies!', 'error')
-                return redirect(url_for('update_book', book_id=book_id))
         except ValueError:
             flash('Invalid number for copies!', 'error')
             return redirect(url_for('update_book', book_id=book_id))
         
-        if save_to_file(books, BOOKS_FILE):
-            flash('Book updated successfully!', 'success')
+        # Re-read under the write lock: a borrow may have landed since the GET
+        with library_transaction() as txn:
+            book = txn.books.get(book_id)
+            if book is None:
+                flash('Book not found!', 'error')
+            elif new_copies < book['Borrowed']:
+                flash('Total copies cannot be less than borrowed copies!', 'error')
+                return redirect(url_for('update_book', book_id=book_id))
+            else:
+                txn.update_book(book_id,
+                                Title=request.form['title'],
+                                Author=request.form['author'],
+                                Year=request.form['year'],
+                                Available=new_copies - book['Borrowed'],
+                                TotalCopies=new_copies)
+                if txn.commit():
+                    flash('Book updated successfully!', 'success')
         return redirect(url_for('admin_panel'))
     
     return render_template_string(
@@ -1241,58 +6598,245 @@ def update_book(book_id):
 @app.route('/admin/delete-book/<book_id>')
 @admin_required
 def delete_book(book_id):
-    books = load_from_file(BOOKS_FILE)
-    
-    if book_id in books:
-        book = books[book_id]
-        if book['Borrowed'] > 0:
+    with library_transaction() as txn:
+        book = txn.books.get(book_id)
+        if book is None:
+            flash('Book not found!', 'error')
+        elif book['Borrowed'] > 0:
             flash(f'Cannot delete book! {book["Borrowed"]} copies are currently borrowed.', 'error')
         else:
-            del books[book_id]
-            if save_to_file(books, BOOKS_FILE):
+            txn.delete_book(book_id)
+            if txn.commit():
                 flash('Book deleted successfully!', 'success')
-    else:
-        flash('Book not found!', 'error')
     
     return redirect(url_for('admin_panel'))
 
+BULK_EDIT_SHOWN = 200
+
+@app.route('/admin/books/bulk', methods=['GET', 'POST'])
+@admin_required
+def bulk_edit_books():
+    """Set or add copies, change details of, or delete many books in one write.
+
+    Books are the ones listed in book_ids or, when none are listed, the ones
+    matching the /books search and filters in the query string. A JSON body
+    {"action": ..., "book_ids": [...], "copies": ..., "title"/"author"/"year": ...}
+    is answered with per-item results as JSON.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if request.is_json and (data is not None or request.method == 'POST'):
+        json_book_ids = parse_json_batch(data, ('action', 'copies', 'title', 'author', 'year'))
+        if json_book_ids is None:
+            return jsonify(error='Expected a JSON object with a "book_ids" list'), 400
+    search_term, filters = book_filters()
+    if data is not None:
+        listed = json_book_ids
+    else:
+        listed = parse_book_ids(request.values.getlist('book_ids'))
+    book_ids = listed
+    if not listed:
+        books = get_books()
+        matches = facet_books(books, filters)
+        if search_term:
+            matches = search_books(books if matches is None else matches, search_term)
+        book_ids = list(matches) if matches is not None else []
+
+    action, copies, fields = 'set_copies', None, {}
+    applied, results = False, []
+    if request.method == 'POST':
+        action, copies, fields, error = parse_bulk_edit(data if data is not None else request.form)
+        if error is None and not book_ids:
+            error = 'Select books with the filters or list their IDs!'
+        if error is None:
+            applied, results = edit_books(book_ids, action, copies, fields)
+
+        if data is not None:
+            if error:
+                return jsonify(error=error), 400
+            return jsonify(applied=applied, action=action, results=results)
+
+        if error:
+            flash(error, 'error')
+        elif applied:
+            flash(f'{BULK_BOOK_ACTIONS[action]}: {len(results)} book(s) updated in one write!', 'success')
+        else:
+            flash('No changes were made - see the results below.', 'error')
+
+    books = get_books()
+    selection = [(book_id, books[book_id]) for book_id in book_ids if book_id in books]
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', BULK_EDIT_HTML),
+        search_term=search_term,
+        filters=filters,
+        listed=listed,
+        selected=len(selection),
+        selection=selection[:BULK_EDIT_SHOWN],
+        actions=BULK_BOOK_ACTIONS,
+        action=action,
+        copies=copies,
+        fields=fields,
+        applied=applied,
+        failed=sum(1 for result in results if not result['ok']),
+        # Failures first: with hundreds of books they are what the admin needs to see
+        results=sorted(results, key=lambda result: result['ok'])[:BULK_EDIT_SHOWN]
+    )
+
+@app.route('/admin/branches', methods=['POST'])
+@admin_required
+def add_branch():
+    branch = request.form.get('branch', '').strip()
+    with library_transaction() as txn:
+        if not BRANCH_ID_PATTERN.fullmatch(branch):
+            flash('Branch names are 1-32 letters, digits, "-" or "_"!', 'error')
+        elif branch in txn.branches:
+            flash(f'Branch "{branch}" already exists!', 'error')
+        else:
+            first = not txn.branches
+            txn.add_branch(branch)
+            if first:
+                # The first branch takes over every copy and lent every open
+                # loan, so branch counts add up from the start
+                for book_id, book in txn.books.items():
+                    txn.adjust_holding(branch, book_id, book['TotalCopies'])
+                for username, user_borrows in txn.borrows.items():
+                    for i, borrow in enumerate(user_borrows):
+                        if not borrow['return_date'] and not borrow.get('branch'):
+                            txn.update_loan(username, i, branch=branch)
+            if txn.commit():
+                flash(f'Branch "{branch}" added' + (' with all existing copies!' if first else '!'), 'success')
+    return redirect(url_for('view_branches'))
+
+@app.route('/admin/branches/<branch>/delete', methods=['POST'])
+@admin_required
+def delete_branch(branch):
+    with library_transaction() as txn:
+        inventory = txn.branches.get(branch)
+        if inventory is None:
+            flash('Branch not found!', 'error')
+        elif inventory:
+            flash(f'Cannot delete branch! It still holds {len(inventory)} title(s); transfer them first.', 'error')
+        else:
+            txn.delete_branch(branch)
+            if txn.commit():
+                flash(f'Branch "{branch}" deleted!', 'success')
+    return redirect(url_for('view_branches'))
+
+@app.route('/admin/branches/transfer', methods=['POST'])
+@admin_required
+def transfer_copies():
+    """Move copies on the shelf of one branch to another; network totals don't change"""
+    book_id = request.form.get('book_id', '').strip()
+    source, target = request.form.get('from_branch', ''), request.form.get('to_branch', '')
+    try:
+        copies = int(request.form.get('copies', 1))
+    except ValueError:
+        copies = 0
+    
+    with library_transaction() as txn:
+        on_shelf = shelf_copies(txn, book_id).get(source, 0)
+        if book_id not in txn.books:
+            flash('Book not found!', 'error')
+        elif source not in txn.branches or target not in txn.branches or source == target:
+            flash('Choose two different branches!', 'error')
+        elif copies <= 0:
+            flash('Number of copies must be positive!', 'error')
+        elif on_shelf < copies:
+            flash(f'{source} has only {on_shelf} copies of "{book_id}" on the shelf!', 'error')
+        else:
+            txn.adjust_holding(source, book_id, -copies)
+            txn.adjust_holding(target, book_id, copies)
+            if txn.commit():
+                flash(f'Moved {copies} copies of "{txn.books[book_id]["Title"]}" from {source} to {target}!', 'success')
+    return redirect(url_for('view_branches', book_id=book_id))
+
+USERS_PAGE_SIZE = 50
+
 @app.route('/admin/users')
 @admin_required
 def view_users():
-    users = load_users()
-    
-    def get_user_borrowed_count(username):
-        return len(get_user_borrowed_books(username))
+    """Paginated user directory with username prefix search and a role filter"""
+    users = get_users()
+    prefix = request.args.get('q', '').strip()
+    role = request.args.get('role', '').strip()
+    page = max(1, parse_int_arg('page') or 1)
+    usernames, total = user_directory.page(prefix, role, page, USERS_PAGE_SIZE)
     
     return render_template_string(
         BASE_HTML.replace('{% block content %}{% endblock %}', USERS_HTML),
-        users=users,
-        get_user_borrowed_count=get_user_borrowed_count
+        users={username: users[username] for username in usernames if username in users},
+        open_loans=loan_counters.open_by_user,
+        fines=fine_engine.table().totals,
+        format_money=format_money,
+        prefix=prefix,
+        role=role,
+        roles=user_directory.role_counts(),
+        total=total,
+        page=page,
+        pages=max(1, -(-total // USERS_PAGE_SIZE))
+    )
+
+FINES_PAGE_SIZE = 50
+
+@app.route('/admin/fines')
+@admin_required
+def fines_report():
+    """Every overdue loan with its fine, largest first"""
+    books = get_books()
+    table = fine_engine.table()
+    overdue = fine_engine.overdue()
+    page = max(1, parse_int_arg('page') or 1)
+    start = (page - 1) * FINES_PAGE_SIZE
+    
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', FINES_HTML),
+        loans=[{**loan, 'book_title': books.get(loan['book_id'], {}).get('Title', 'Unknown Book')}
+               for loan in overdue[start:start + FINES_PAGE_SIZE]],
+        overdue_count=len(overdue),
+        patrons_owing=len(table.totals),
+        total_outstanding=sum(table.totals.values()),
+        top_patrons=sorted(table.totals.items(), key=lambda item: (-item[1], item[0]))[:10],
+        page=page,
+        pages=max(1, -(-len(overdue) // FINES_PAGE_SIZE)),
+        day=table.day,
+        rules=sorted(ROLE_FINE_RULES.items()),
+        loan_period=LOAN_PERIOD_DAYS,
+        format_money=format_money
     )
 
 @app.route('/admin/stats')
 @admin_required
 def library_stats():
-    books = load_from_file(BOOKS_FILE)
+    books = get_books()
     total_unique_books = len(books)
     total_all_copies = sum(book['TotalCopies'] for book in books.values())
     total_available = sum(book['Available'] for book in books.values())
     total_borrowed = sum(book['Borrowed'] for book in books.values())
     
+    period = request.args.get('period', 'day')
+    if period not in ROLLUP_PERIODS:
+        period = 'day'
+    chart_book_id = request.args.get('book_id', '')
+    if chart_book_id not in books:
+        chart_book_id = ''
+    
     return render_template_string(
         BASE_HTML.replace('{% block content %}{% endblock %}', STATS_HTML),
         books=books,
         total_unique_books=total_unique_books,
         total_all_copies=total_all_copies,
         total_available=total_available,
-        total_borrowed=total_borrowed
+        total_borrowed=total_borrowed,
+        period=period,
+        periods=ROLLUP_PERIODS,
+        chart_book_id=chart_book_id,
+        series=circulation_rollups.series(period, chart_book_id)
     )
 
 @app.route('/admin/borrow-records')
 @admin_required
 def borrow_history():
-    borrows = load_borrows()
-    books = load_from_file(BOOKS_FILE)
+    borrows = get_borrows()
+    books = get_books()
     
     history = []
     for username, user_borrows in borrows.items():
@@ -1314,6 +6858,158 @@ def borrow_history():
         borrow_history=history
     )
 
+@app.route('/admin/profiles')
+@admin_required
+def view_profiles():
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', PROFILES_HTML),
+        profiles=list(_profiles),
+        ring_size=PROFILE_RING_SIZE
+    )
+
+@app.route('/admin/profiles/<int:profile_id>.prof')
+@admin_required
+def download_profile(profile_id):
+    """Raw pstats data, for snakeviz or python -m pstats"""
+    profile = get_profile(profile_id)
+    if profile is None:
+        flash('Profile not found (it may have been rotated out)!', 'error')
+        return redirect(url_for('view_profiles'))
+    return send_file(io.BytesIO(profile['raw']), mimetype='application/octet-stream',
+                     as_attachment=True, download_name=f'request-{profile_id}.prof')
+
+@app.route('/admin/memory', methods=['GET', 'POST'])
+@admin_required
+def memory_profile():
+    report = None
+    if request.method == 'POST':
+        action = request.form.get('action')
+        with _memory_lock:
+            if action == 'start' and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                _memory_baseline.clear()
+                flash('Memory tracing started. Take a baseline, exercise the app, then snapshot.', 'info')
+            elif action == 'stop':
+                tracemalloc.stop()
+                _memory_baseline.clear()
+                flash('Memory tracing stopped.', 'info')
+            elif action in ('baseline', 'snapshot') and not tracemalloc.is_tracing():
+                flash('Start tracing first!', 'error')
+            elif action == 'baseline':
+                _memory_baseline['snapshot'] = take_memory_snapshot()
+                _memory_baseline['taken'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                flash('Baseline taken.', 'success')
+            elif action == 'snapshot':
+                report = memory_report()
+    
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', MEMORY_HTML),
+        datasets=dataset_memory(max_age=0),
+        indexes=index_memory(),
+        status=tracemalloc_status(),
+        report=report
+    )
+
+@app.route('/admin/metrics')
+@admin_required
+def metrics():
+    """Process metrics as JSON for scraping.
+
+    Record counts are always included; the byte estimates walk the datasets,
+    so they are opt-in with ?sizes=1 (and re-walked at a bounded rate).
+    """
+    snapshot = current_snapshot()
+    if request.args.get('sizes') == '1':
+        datasets = dataset_memory()
+    else:
+        datasets = {name: {'records': len(getattr(snapshot, name))} for name in DATASETS}
+    return jsonify({
+        'pid': os.getpid(),
+        'versions': dict(snapshot.versions),
+        'datasets': datasets,
+        'jinja_cached_templates': len(app.jinja_env.cache or ()),
+        'request_profiles': len(_profiles),
+        'tracemalloc': tracemalloc_status(),
+        'rate_limits': rate_limiter.stats(),
+    })
+
+@app.route('/admin/jobs', methods=['GET', 'POST'])
+@admin_required
+def admin_jobs():
+    """Job list, and submission of new jobs (form, or JSON {"kind": ..., ...})"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) if request.is_json else None
+        source = data if data is not None else request.form
+        kind = source.get('kind')
+        params, prepare, error = {}, None, None
+        
+        if kind not in JOB_TYPES:
+            error = 'Unknown job type!'
+        elif kind == 'compact':
+            try:
+                params['days'] = int(source.get('days', 365))
+                if params['days'] <= 0:
+                    error = 'Number of days must be positive!'
+            except (TypeError, ValueError):
+                error = 'Invalid number of days!'
+        elif kind == 'reconcile':
+            params['full'] = source.get('full') in (True, '1')
+            params['repair'] = source.get('repair') in (True, '1')
+        elif kind == 'import':
+            upload = request.files.get('file')
+            if upload is None or not upload.filename:
+                error = 'Please choose a file to import!'
+            else:
+                prepare = lambda job: upload.save(job.path("input"))
+        
+        job, queue_full = None, False
+        if error is None:
+            job = job_runner.submit(kind, session['username'], params, prepare)
+            if job is None:
+                queue_full = True
+                error = 'The job queue is full, please try again shortly.'
+        
+        if data is not None:
+            if error:
+                return jsonify(error=error), 503 if queue_full else 400
+            return jsonify(job_id=job.job_id, status_url=url_for('job_status', job_id=job.job_id)), 202
+        if error:
+            flash(error, 'error')
+        else:
+            flash(f'{JOB_TYPES[kind][0]} started (job {job.job_id}).', 'success')
+        return redirect(url_for('admin_jobs'))
+    
+    return render_template_string(
+        BASE_HTML.replace('{% block content %}{% endblock %}', JOBS_HTML),
+        jobs=[job.to_dict() for job in job_runner.all_jobs()]
+    )
+
+@app.route('/admin/jobs/<job_id>')
+@admin_required
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify(error='Job not found'), 404
+    return jsonify(job.to_dict())
+
+@app.route('/admin/jobs/<job_id>/cancel', methods=['POST'])
+@admin_required
+def cancel_job(job_id):
+    if job_runner.cancel(job_id):
+        flash('Cancellation requested.', 'info')
+    else:
+        flash('Job is not running in this worker or has already finished!', 'error')
+    return redirect(url_for('admin_jobs'))
+
+@app.route('/admin/jobs/<job_id>/result')
+@admin_required
+def job_result(job_id):
+    job = job_runner.get(job_id)
+    if job is None or job.status != 'done' or not job.result or not os.path.exists(job.path("result")):
+        flash('No result available for this job!', 'error')
+        return redirect(url_for('admin_jobs'))
+    return send_file(os.path.abspath(job.path("result")), as_attachment=True, download_name=job.result)
+
 @app.route('/change-password', methods=['GET', 'POST'])
 @login_required
 def change_password():
@@ -1322,20 +7018,25 @@ def change_password():
         new_password = request.form['new_password']
         confirm_password = request.form['confirm_password']
         
-        users = load_users()
         username = session['username']
+        stored = get_users()[username]['password']
         
-        if users[username]['password'] != current_password:
+        if not check_password(stored, current_password):
             flash('Current password is incorrect!', 'error')
         elif new_password != confirm_password:
             flash('New passwords do not match!', 'error')
         elif len(new_password) < 4:
             flash('Password must be at least 4 characters!', 'error')
         else:
-            users[username]['password'] = new_password
-            save_users(users)
-            flash('Password changed successfully!', 'success')
-            return redirect(url_for('dashboard'))
+            password_hash = hash_password(new_password)
+            with library_transaction() as txn:
+                if txn.users[username]['password'] != stored:
+                    flash('Your password was changed in the meantime, please try again!', 'error')
+                else:
+                    txn.update_user(username, password=password_hash)
+                    txn.commit()
+                    flash('Password changed successfully!', 'success')
+                    return redirect(url_for('dashboard'))
     
     return render_template_string(BASE_HTML.replace('{% block content %}{% endblock %}', CHANGE_PASSWORD_HTML))
 
@@ -1345,7 +7046,273 @@ def logout():
     flash('Logged out successfully!', 'info')
     return redirect(url_for('login'))
 
+# ============= STARTUP WARM-UP =============
+
+# Without a warm-up, the first request of a process parses every file and
+# builds every derived index (search, recommendations, rollups...) before it
+# can answer. warm_up() does that at startup instead: the datasets are read
+# side by side, then the indexes are built. With background=True both happen
+# in a thread while the server already accepts requests: a request waits for
+# the data (a few seconds) but not for the indexes (much longer on a large
+# history); pages read whatever the indexes hold so far. /ready answers 503
+# until the indexes are complete, for load balancers and deploy scripts.
+
+class WarmUp:
+    """Progress and timings of the startup warm-up, logged and served on /ready"""
+
+    def __init__(self):
+        self.started = None
+        self.loaded = None
+        self.finished = None
+        self.indexes = {}
+
+    def run(self):
+        self.started = time.perf_counter()
+        defer_index_updates()
+        try:
+            snapshot = refresh_snapshot()
+            self.loaded = time.perf_counter()
+            for name, seconds in dataset_load_seconds.items():
+                print(f"📦 Loaded {name} in {seconds:.2f}s")
+            print(f"🔥 Data ready in {self.loaded - self.started:.2f}s: {len(snapshot.books)} books, "
+                  f"{len(snapshot.users)} users, {sum(map(len, snapshot.borrows.values()))} loans")
+        finally:
+            # Even if loading failed, so listeners don't stay deferred for good
+            run_deferred_index_updates(self.indexes)
+        self.finished = time.perf_counter()
+        slowest = sorted(self.indexes.items(), key=lambda item: -item[1])[:5]
+        print(f"🗂️  Indexes built in {self.finished - self.loaded:.2f}s ("
+              + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in slowest) + ")")
+        print(f"✅ Warmed up in {self.finished - self.started:.2f}s")
+
+    def status(self):
+        """Readiness summary; ready once every dataset is loaded and no index build is pending"""
+        loaded = all(version is not None for version in current_snapshot().versions.values())
+        ready = loaded and _index_backlog is None
+        if ready:
+            phase = "ready"
+        elif loaded:
+            phase = "indexing"
+        else:
+            phase = "loading" if self.started is not None else "cold"
+        now = time.perf_counter()
+        return {
+            'ready': ready,
+            'phase': phase,
+            'elapsed': round(((self.finished or now) - self.started), 3) if self.started is not None else None,
+            'datasets': {name: round(seconds, 3) for name, seconds in dataset_load_seconds.items()},
+            'indexes': {name: round(seconds, 3) for name, seconds in self.indexes.items()},
+        }
+
+warm_up_status = WarmUp()
+
+def warm_up(background=False):
+    """Load every dataset and build every derived index, now or in a thread.
+
+    A process that forks workers afterwards must warm up in the foreground:
+    the thread would not be carried into the workers.
+    """
+    if not background:
+        warm_up_status.run()
+        return None
+    defer_index_updates()  # before any request can publish the first snapshot
+    thread = threading.Thread(target=warm_up_status.run, name="library-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+# ============= PRODUCTION SERVER =============
+
+# `python librareay_webapp.py serve` runs a pre-fork server: the parent
+# binds the socket, loads every dataset and builds the indexes once, then
+# forks workers that share that memory copy-on-write (with --workers 0 the
+# single process warms up in the background instead, see warm_up()). Each worker serves
+# requests from a fixed pool of threads. Gunicorn (gthread workers) is used
+# when installed; otherwise a built-in Werkzeug-based server does the same,
+# except that Werkzeug closes every connection after one response, so there
+# --keep-alive only bounds how long a connection may sit idle.
+#
+# A /books/stream client holds its thread for minutes, so streams may only
+# take STREAM_THREAD_SHARE of each worker's threads (extra ones get a 503
+# and retry later); the rest are always left for ordinary requests.
+
+STREAM_THREAD_SHARE = 0.5
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug WSGI server handling connections on a fixed pool of threads.
+
+    The accept loop blocks while every thread is busy, so excess clients
+    wait in the listen backlog instead of piling up inside the process.
+    Long-lived streams can't fill the pool: serve_production() caps them
+    at STREAM_THREAD_SHARE of the threads.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, handler, fd):
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="library-http")
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+def request_handler(keep_alive, access_log):
+    """WSGIRequestHandler that drops a connection idle for keep_alive seconds"""
+    attrs = {'timeout': keep_alive if keep_alive > 0 else None}
+    if not access_log:
+        attrs['log_request'] = lambda self, code="-", size="-": None
+    return type("LibraryRequestHandler", (WSGIRequestHandler,), attrs)
+
+def serve_gunicorn(host, port, workers, threads, backlog, keep_alive, access_log):
+    class LibraryServer(GunicornApplication):
+        def load_config(self):
+            settings = {
+                'bind': f"{host}:{port}",
+                'workers': max(1, workers),
+                'threads': threads,
+                'worker_class': "gthread",
+                'backlog': backlog,
+                'keepalive': int(keep_alive),
+                'preload_app': True,
+                'accesslog': "-" if access_log else None,
+                'pre_fork': lambda server, worker: gc.freeze(),
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            warm_up()  # preload_app: runs once in the master, before forking
+            return app
+
+    LibraryServer().run()
+
+def serve_production(host="0.0.0.0", port=5000, workers=2, threads=8, backlog=128, keep_alive=5,
+                     access_log=True, server="auto"):
+    """Pre-fork server; workers=0 serves from this process (the only option without fork())"""
+    availability_feed.max_subscribers = min(availability_feed.max_subscribers, int(threads * STREAM_THREAD_SHARE))
+    if server == "gunicorn" or (server == "auto" and GunicornApplication is not None and workers > 0):
+        if GunicornApplication is None:
+            raise SystemExit("gunicorn is not installed (pip install gunicorn), use --server builtin")
+        return serve_gunicorn(host, port, workers, threads, backlog, keep_alive, access_log)
+    
+    listener = socket.create_server((host, port), backlog=backlog, reuse_port=False)
+    listener.set_inheritable(True)
+    single_process = workers <= 0 or not hasattr(os, "fork")
+    warm_up(background=single_process)
+    handler = request_handler(keep_alive, access_log)
+    
+    def serve():
+        server = PooledWSGIServer(host, port, app, threads, handler, listener.fileno())
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.pool.shutdown(wait=True)
+    
+    if single_process:
+        print(f"🌐 Serving on http://{host}:{port} with {threads} threads")
+        serve()
+        return
+    
+    # Objects loaded so far are never collected, so the collector doesn't
+    # touch (and un-share) their pages in the workers
+    gc.freeze()
+    children = {}
+    stopping = False
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent decides when workers stop
+            try:
+                serve()
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"🌐 Serving on http://{host}:{port}: {workers} workers x {threads} threads, "
+          f"backlog {backlog}, keep-alive {keep_alive}s")
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if started is not None and not stopping:
+            print(f"❌ Worker {pid} exited (status {status}), restarting")
+            if time.monotonic() - started < 1:
+                time.sleep(1)  # don't spin if workers die on startup
+            spawn()
+    listener.close()
+
+def serve_main(argv):
+    """python librareay_webapp.py serve [options]"""
+    parser = argparse.ArgumentParser(prog="librareay_webapp.py serve",
+                                     description="Run the library app on a pre-fork, multi-threaded WSGI server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="forked worker processes; 0 serves from a single process (default: CPU count)")
+    parser.add_argument("--threads", type=int, default=8, help="request threads per worker (default 8)")
+    parser.add_argument("--backlog", type=int, default=128, help="listen backlog (default 128)")
+    parser.add_argument("--keep-alive", type=float, default=5,
+                        help="seconds an idle keep-alive connection is held (default 5)")
+    parser.add_argument("--no-access-log", action="store_true", help="don't log every request")
+    parser.add_argument("--server", choices=("auto", "gunicorn", "builtin"), default="auto",
+                        help="gunicorn if installed, else the built-in pre-fork server (default auto)")
+    args = parser.parse_args(argv)
+    serve_production(args.host, args.port, args.workers, args.threads, args.backlog, args.keep_alive,
+                     access_log=not args.no_access_log, server=args.server)
+    return 0
+
+def debug_main(argv):
+    """python librareay_webapp.py debug [--host HOST] [--port PORT]"""
+    parser = argparse.ArgumentParser(prog="librareay_webapp.py debug",
+                                     description="Run the Flask development server with the reloader and the "
+                                                 "interactive debugger. Never expose it: the debugger runs any "
+                                                 "code it is sent.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args(argv)
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        warm_up(background=True)  # only in the reloader's serving child
+    app.run(debug=True, host=args.host, port=args.port)
+    return 0
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['reconcile']:
+        sys.exit(reconcile_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serve_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['users']:
+        sys.exit(users_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['debug']:
+        sys.exit(debug_main(sys.argv[2:]))
     print("📚 Library Management System - Web Version")
     print("🌐 Starting web server...")
     print("📍 Access the application at: http://localhost:5000")
@@ -1355,4 +7322,7 @@ if __name__ == '__main__':
     print("   - library_users.txt (User accounts)")
     print("   - library_books.txt (Book inventory)") 
     print("   - library_borrows.txt (Borrow tracking)")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    print("🐞 For the development server with the debugger (local use only) run:")
+    print("   python librareay_webapp.py debug")
+    # Same as "serve": options such as --port or --workers can be given directly
+    sys.exit(serve_main(sys.argv[1:]))
\ No newline at end of file
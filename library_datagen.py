@@ -0,0 +1,279 @@
+# library_datagen.py
+"""Synthetic data for librareay_webapp at production scale.
+
+Writes library_books.txt, library_users.txt and library_borrows.txt with the
+app's own line formatters, so the files load exactly like real data:
+
+    book popularity follows a Zipf law: the k-th most borrowed title is
+        borrowed about 1/k^s times as often as the most borrowed one
+    loan durations are log-normal around a median of two weeks
+    a chosen share of loans is still open (borrowed recently, some overdue);
+        a book never has more open loans than copies and no patron holds
+        two open loans of the same book
+    Available + Borrowed == TotalCopies and Borrowed == open loans, so the
+        reconciler has nothing to repair
+
+Loans are generated and written one patron at a time, so memory does not
+grow with the number of borrow lines; only a few per-book and per-user
+numbers are kept. The same seed and arguments always give the same files.
+Every patron shares one password (--password), hashed once; the admin
+account is admin/admin123.
+
+Usage:
+    python library_datagen.py --out data --books 100000 --users 200000 --loans 10000000
+    python library_datagen.py --books 500 --users 50 --loans 2000 --open-ratio 0.2 --seed 7 --force
+"""
+import argparse
+import bisect
+import math
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime
+
+from librareay_webapp import (BOOKS_FILE, USERS_FILE, BORROWS_FILE, VERSIONS_FILE, BRANCHES_DIR, DatasetVersions,
+                              book_line, user_line, loan_line, hash_password)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+DAY = 86400
+
+ADJECTIVES = ("Silent", "Hidden", "Lost", "Golden", "Broken", "Endless", "Distant", "Crimson", "Quiet", "Wild",
+              "Forgotten", "Bright", "Hollow", "Ancient", "Restless", "Frozen", "Secret", "Burning", "Last", "Open")
+NOUNS = ("River", "Garden", "Kingdom", "Algorithm", "Harbor", "Mountain", "Archive", "Signal", "Forest", "Engine",
+         "Library", "Empire", "Compass", "Season", "Network", "Island", "Theory", "Voyage", "Mirror", "Circuit")
+FIRST_NAMES = ("Ada", "Alan", "Grace", "Linus", "Maya", "Omar", "Priya", "Chen", "Sofia", "Kwame",
+               "Elena", "Yuki", "Noah", "Fatima", "Lars", "Amara", "Diego", "Ingrid", "Ravi", "Zoe")
+LAST_NAMES = ("Smith", "Okafor", "Tanaka", "Garcia", "Novak", "Haddad", "Kowalski", "Nguyen", "Moreau", "Silva",
+              "Andersen", "Rahman", "Rossi", "Kim", "Petrov", "Mensah", "Cohen", "Larsen", "Iyer", "Walsh")
+
+# ============= DISTRIBUTIONS =============
+
+def zipf_cumulative(count, exponent):
+    """Running totals of 1/rank^exponent, for drawing ranks with bisect"""
+    cumulative = array("d")
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += rank ** -exponent
+        cumulative.append(total)
+    return cumulative
+
+def rank_order(count, rng):
+    """Map popularity rank -> book index with an affine permutation, so the
+    most popular books are scattered through the catalogue without storing
+    a shuffled list"""
+    if count == 1:
+        return lambda rank: 0
+    while True:
+        step = rng.randrange(1, count)
+        if math.gcd(step, count) == 1:
+            break
+    offset = rng.randrange(count)
+    return lambda rank: (rank * step + offset) % count
+
+def loan_counts(users, loans, rng, sigma=1.0):
+    """Loans per user: log-normal activity (a few heavy readers, many light
+    ones), rounded so the counts add up to exactly `loans`"""
+    activity = array("d", (rng.lognormvariate(-sigma * sigma / 2, sigma) for _ in range(users)))
+    total = sum(activity) or 1.0
+    running, assigned = 0.0, 0
+    for weight in activity:
+        running += weight
+        target = round(loans * running / total)
+        yield target - assigned
+        assigned = target
+
+# ============= GENERATOR =============
+
+class DatasetGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.end = int(datetime.strptime(args.end_date, "%Y-%m-%d").timestamp()) + DAY - 1
+        self.start = self.end - args.history_days * DAY
+        self.cumulative = zipf_cumulative(args.books, args.zipf)
+        self.order = rank_order(args.books, self.rng)
+        self.width = max(6, len(str(args.books)))
+        self.copies = array("i", bytes(4 * args.books))
+        self.on_loan = array("i", bytes(4 * args.books))
+        self.median_seconds = args.median_loan_days * DAY
+        self.stats = {"loans": 0, "open": 0, "open_refused": 0, "overdue": 0}
+
+    def book_id(self, index):
+        return f"B{index + 1:0{self.width}d}"
+
+    def draw_book(self):
+        rank = bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.order(min(rank, len(self.cumulative) - 1))
+
+    def stock_copies(self):
+        """Copies per book sized to its expected share of the open loans, so
+        popular titles get more copies but the hottest can still run out"""
+        args, total = self.args, self.cumulative[-1]
+        expected_open = args.loans * args.open_ratio
+        for rank in range(args.books):
+            share = (rank + 1) ** -args.zipf / total
+            demand = math.ceil(expected_open * share * args.copy_headroom)
+            self.copies[self.order(rank)] = max(1, min(args.max_copies, demand)) + self.rng.randint(0, 1)
+        # The --max-copies cap on bestsellers can leave fewer copies than open
+        # loans; spread the shortfall over the catalogue
+        shortfall = expected_open * args.copy_headroom - sum(self.copies)
+        if shortfall > 0:
+            extra = math.ceil(shortfall / args.books)
+            for index in range(args.books):
+                self.copies[index] += extra
+
+    def duration(self):
+        seconds = self.rng.lognormvariate(math.log(self.median_seconds), self.args.loan_sigma)
+        return int(min(max(seconds, 600), self.args.max_loan_days * DAY))
+
+    def user_loans(self, count):
+        """(borrow time, book index, return time or None) for one patron, oldest first"""
+        rng, held, loans = self.rng, set(), []
+        for _ in range(count):
+            duration = self.duration()
+            book = None
+            if rng.random() < self.args.open_ratio:
+                # Popular titles first; once those are all out, any title
+                # with a free copy, which keeps the open ratio on target
+                for attempt in range(12):
+                    candidate = self.draw_book() if attempt < 4 else rng.randrange(self.args.books)
+                    if candidate not in held and self.on_loan[candidate] < self.copies[candidate]:
+                        book = candidate
+                        break
+                if book is None:
+                    self.stats["open_refused"] += 1
+            if book is not None:
+                # Seen mid-loan: anywhere between just borrowed and due back
+                borrowed = self.end - int(duration * rng.random())
+                held.add(book)
+                self.on_loan[book] += 1
+                self.stats["open"] += 1
+                if self.end - borrowed > 14 * DAY:
+                    self.stats["overdue"] += 1
+                loans.append((borrowed, book, None))
+            else:
+                latest = max(self.start, self.end - duration)
+                borrowed = rng.randint(self.start, latest)
+                loans.append((borrowed, self.draw_book(), min(borrowed + duration, self.end)))
+        loans.sort()
+        return loans
+
+    def write_users(self, f):
+        args = self.args
+        f.write(user_line("admin", {"password": hash_password("admin123", salt=self.rng.randbytes(16)), "role": "admin"}))
+        shared = hash_password(args.password, salt=self.rng.randbytes(16))
+        for i in range(args.users):
+            f.write(user_line(self.username(i), {"password": shared, "role": "member"}))
+
+    def username(self, index):
+        return f"patron{index:0{len(str(self.args.users))}d}"
+
+    def write_borrows(self, f, progress):
+        written = 0
+        for i, count in enumerate(loan_counts(self.args.users, self.args.loans, self.rng)):
+            if not count:
+                continue
+            username = self.username(i)
+            for borrowed, book, returned in self.user_loans(count):
+                f.write(loan_line(username, {
+                    'book_id': self.book_id(book),
+                    'borrow_date': time.strftime(DATE_FORMAT, time.localtime(borrowed)),
+                    'return_date': time.strftime(DATE_FORMAT, time.localtime(returned)) if returned else None,
+                }))
+            written += count
+            if written // 1_000_000 != (written - count) // 1_000_000:
+                progress(f"{written:,} loans")
+        self.stats["loans"] = written
+
+    def write_books(self, f):
+        rng, end_year = self.rng, datetime.fromtimestamp(self.end).year
+        for index in range(self.args.books):
+            copies, borrowed = self.copies[index], self.on_loan[index]
+            f.write(book_line(self.book_id(index), {
+                "Title": f"The {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}" + (f" {index // 400 + 1}" if index >= 400 else ""),
+                "Author": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                "Year": rng.randint(1900, end_year),
+                "TotalCopies": copies,
+                "Available": copies - borrowed,
+                "Borrowed": borrowed,
+            }))
+
+# ============= CLI =============
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", default=".", help="directory to write the data files to (default .)")
+    parser.add_argument("--books", type=int, default=10_000, help="catalogue size (default 10000)")
+    parser.add_argument("--users", type=int, default=5_000, help="patron accounts, plus admin (default 5000)")
+    parser.add_argument("--loans", type=int, default=100_000, help="borrow records (default 100000)")
+    parser.add_argument("--open-ratio", type=float, default=0.05,
+                        help="share of loans still open (default 0.05)")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of book popularity (default 1.1)")
+    parser.add_argument("--median-loan-days", type=float, default=14, help="median loan duration (default 14)")
+    parser.add_argument("--loan-sigma", type=float, default=0.6,
+                        help="log-normal spread of loan durations (default 0.6)")
+    parser.add_argument("--max-loan-days", type=int, default=180, help="longest loan (default 180)")
+    parser.add_argument("--history-days", type=int, default=3 * 365, help="days of loan history (default 1095)")
+    parser.add_argument("--end-date", default=datetime.now().strftime("%Y-%m-%d"),
+                        help="last day of the history, YYYY-MM-DD (default today; set it to reproduce a run later)")
+    parser.add_argument("--max-copies", type=int, default=40, help="most copies of one book (default 40)")
+    parser.add_argument("--copy-headroom", type=float, default=1.3,
+                        help="copies per expected open loan of a book (default 1.3)")
+    parser.add_argument("--password", default="password", help="password of every patron (default 'password')")
+    parser.add_argument("--seed", type=int, default=42, help="random seed (default 42)")
+    parser.add_argument("--force", action="store_true", help="overwrite existing data files")
+    args = parser.parse_args()
+    if min(args.books, args.users) < 1 or args.loans < 0 or not 0 <= args.open_ratio <= 1:
+        parser.error("--books and --users must be positive, --loans >= 0 and --open-ratio within 0..1")
+
+    os.makedirs(args.out, exist_ok=True)
+    targets = {name: os.path.join(args.out, name) for name in (USERS_FILE, BORROWS_FILE, BOOKS_FILE)}
+    existing = [path for path in targets.values() if os.path.exists(path)]
+    if existing and not args.force:
+        print(f"❌ {', '.join(existing)} already exist(s); use --force to overwrite")
+        return 1
+    if os.path.isdir(os.path.join(args.out, BRANCHES_DIR)):
+        print(f"⚠️  {BRANCHES_DIR}/ is left as it is and will not match the new books; remove it for a single-site library")
+
+    started = time.monotonic()
+    progress = lambda message: print(f"   ... {message} ({time.monotonic() - started:.0f}s)", file=sys.stderr)
+    generator = DatasetGenerator(args)
+    generator.stock_copies()
+    # Written under temporary names and renamed at the end, so a running app
+    # (or an interrupted run) never sees a half-generated dataset
+    temporary = {name: os.path.join(args.out, f".tmp-{name}") for name in targets}
+    try:
+        with open(temporary[USERS_FILE], "w", encoding="utf-8") as f:
+            generator.write_users(f)
+        with open(temporary[BORROWS_FILE], "w", encoding="utf-8") as f:
+            generator.write_borrows(f, progress)
+        with open(temporary[BOOKS_FILE], "w", encoding="utf-8") as f:
+            generator.write_books(f)
+        for name, path in targets.items():
+            os.replace(temporary[name], path)
+    finally:
+        for path in temporary.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+    versions_path = os.path.join(args.out, VERSIONS_FILE)
+    if os.path.exists(versions_path):
+        # Tell app workers already serving this directory to reload
+        versions = DatasetVersions(versions_path)
+        with versions.write_lock:
+            for name in ("books", "users", "borrows"):
+                versions.bump(name)
+
+    stats = generator.stats
+    print(f"✅ {args.books:,} books, {args.users + 1:,} users, {stats['loans']:,} loans in {args.out} "
+          f"({time.monotonic() - started:.1f}s)")
+    print(f"   open loans: {stats['open']:,} ({stats['open'] / max(1, stats['loans']):.1%}, "
+          f"{stats['overdue']:,} overdue); {stats['open_refused']:,} wanted open but no copy was free")
+    for path in targets.values():
+        print(f"   {path}: {os.path.getsize(path) / 1e6:,.1f} MB")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
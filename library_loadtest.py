@@ -0,0 +1,369 @@
+# library_loadtest.py
+"""Load test for the borrow/return hot path of librareay_webapp.
+
+Starts the app on a throwaway copy of generated data, drives /borrow/<id>
+and /return/<id> from many simulated patrons spread over client processes
+and threads (a share of them all fighting over one "hot" book), then
+reports throughput and latency percentiles and checks that the files on
+disk are still consistent:
+
+    Available + Borrowed == TotalCopies, Available >= 0
+    Borrowed == number of open loans in library_borrows.txt
+    open loans == successful borrows - successful returns seen by clients
+
+Usage:
+    python library_loadtest.py --duration 10 --client-processes 4 --threads 8
+    python library_loadtest.py --servers 3          # three app processes, one data dir
+    python library_loadtest.py --server-mode forking
+    python library_loadtest.py --server-mode production --workers 4
+    python library_loadtest.py --compare --read-fraction 0.5   # dev server vs. production server
+    python library_loadtest.py --rate-limits    # keep the app's rate limits on; 429s count as "limited"
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+HOT_BOOK = "HOT"
+PASSWORD = "loadtest"
+
+SERVER_SNIPPET = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import librareay_webapp
+from werkzeug.serving import run_simple
+port, mode, workers, threads = int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), int(sys.argv[5])
+if mode == "production":
+    librareay_webapp.serve_production("127.0.0.1", port, workers=workers, threads=threads, access_log=False)
+elif mode == "forking":
+    run_simple("127.0.0.1", port, librareay_webapp.app, threaded=False, processes=16)
+else:
+    run_simple("127.0.0.1", port, librareay_webapp.app, threaded=True)
+"""
+
+# ============= TEST DATA =============
+
+def write_dataset(directory, books, hot_copies, users):
+    """Generated books (plus the hot book), patrons and an empty loan file"""
+    rng = random.Random(42)
+    with open(os.path.join(directory, "library_books.txt"), "w", encoding="utf-8") as f:
+        f.write(f"{HOT_BOOK},The Hot Book,Load Tester,2024,{hot_copies},{hot_copies},0\n")
+        for i in range(books):
+            copies = rng.randint(1, 5)
+            f.write(f"LT{i:05d},Load Test Volume {i},Author {i % 97},{1950 + i % 75},{copies},{copies},0\n")
+    with open(os.path.join(directory, "library_users.txt"), "w", encoding="utf-8") as f:
+        f.write("admin|admin123|admin\n")
+        for i in range(users):
+            f.write(f"patron{i}|{PASSWORD}|member\n")
+    open(os.path.join(directory, "library_borrows.txt"), "w", encoding="utf-8").close()
+
+# ============= SERVERS =============
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_servers(directory, count, mode, workers=2, threads=8, rate_limits=False):
+    """Start count app processes sharing directory; returns [(process, port)]"""
+    servers = []
+    # Every simulated patron comes from 127.0.0.1, so the per-IP limits would
+    # cap the whole run at one client's budget
+    env = dict(os.environ, LIBRARY_RATE_LIMITS="on" if rate_limits else "off")
+    for i in range(count):
+        port = free_port()
+        log = open(os.path.join(directory, f"server-{port}.log"), "w")
+        process = subprocess.Popen([sys.executable, "-c", SERVER_SNIPPET, REPO_DIR, str(port), mode,
+                                    str(workers), str(threads)],
+                                   cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+        servers.append((process, port))
+    deadline = time.monotonic() + 30
+    for process, port in servers:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"app server on port {port} did not start (see server-{port}.log)")
+                time.sleep(0.1)
+    return servers
+
+def stop_servers(servers):
+    for process, port in servers:
+        process.terminate()
+    for process, port in servers:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+# ============= CLIENTS =============
+
+class Patron:
+    """One simulated user with its own keep-alive connection and session"""
+
+    def __init__(self, username, port, serializer):
+        self.username = username
+        self.port = port
+        self.serializer = serializer
+        self.conn = None
+        self.cookie = ""
+
+    def request(self, method, path, body=None):
+        headers = {"Cookie": self.cookie}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                return response
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def login(self):
+        response = self.request("POST", "/login", urlencode({"username": self.username, "password": PASSWORD}))
+        while response.status == 429:
+            time.sleep(int(response.getheader("Retry-After", "1")))
+            response = self.request("POST", "/login", urlencode({"username": self.username, "password": PASSWORD}))
+        self.cookie = session_cookie(response)
+        # Render a page once so the login flash is consumed and not resent
+        self.cookie = session_cookie(self.request("GET", "/dashboard")) or self.cookie
+
+    def outcome(self, response):
+        """'ok' or 'rejected' from the flash the app stored in the session"""
+        cookie = session_cookie(response)
+        try:
+            flashes = self.serializer.loads(cookie.split("=", 1)[1]).get("_flashes", [])
+        except Exception:
+            return "error"
+        return "ok" if flashes and flashes[-1][0] == "success" else "rejected"
+
+def session_cookie(response):
+    for header, value in response.getheaders():
+        if header.lower() == "set-cookie" and value.startswith("session="):
+            return value.split(";", 1)[0]
+    return ""
+
+def signing_serializer():
+    sys.path.insert(0, REPO_DIR)
+    import librareay_webapp
+    return librareay_webapp.app.session_interface.get_signing_serializer(librareay_webapp.app)
+
+def run_client(args):
+    """One client process: threads of patrons looping until the deadline"""
+    import threading
+    client_id, ports, options = args
+    serializer = signing_serializer()
+    results = []
+    lock = threading.Lock()
+
+    def patron_loop(index):
+        rng = random.Random(client_id * 10000 + index)
+        username = f"patron{client_id * options['threads'] + index}"
+        patron = Patron(username, ports[index % len(ports)], serializer)
+        patron.login()
+        held = set()
+        samples = []
+        while time.monotonic() < options["deadline"]:
+            if rng.random() < options["read_fraction"]:
+                started = time.perf_counter()
+                try:
+                    response = patron.request("GET", "/books")
+                    outcome = "ok" if response.status == 200 else "limited" if response.status == 429 else "error"
+                except (http.client.HTTPException, OSError):
+                    outcome = "error"
+                samples.append(("browse", False, time.perf_counter() - started, outcome))
+                continue
+            if held and (len(held) >= options["max_held"] or rng.random() < 0.5):
+                op, book_id = "return", rng.choice(sorted(held))
+            else:
+                op = "borrow"
+                if rng.random() < options["hot_fraction"]:
+                    book_id = HOT_BOOK
+                else:
+                    book_id = f"LT{rng.randrange(options['books']):05d}"
+            started = time.perf_counter()
+            try:
+                response = patron.request("GET", f"/{op}/{book_id}")
+                if response.status == 429:
+                    outcome = "limited"
+                else:
+                    outcome = patron.outcome(response) if response.status == 302 else "error"
+            except (http.client.HTTPException, OSError):
+                outcome = "error"
+            samples.append((op, book_id == HOT_BOOK, time.perf_counter() - started, outcome))
+            if outcome == "ok":
+                (held.add if op == "borrow" else held.discard)(book_id)
+        with lock:
+            results.extend(samples)
+
+    threads = [threading.Thread(target=patron_loop, args=(i,)) for i in range(options["threads"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# ============= REPORT & CHECKS =============
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def report(samples, elapsed):
+    print(f"\n📊 {len(samples)} requests in {elapsed:.1f}s = {len(samples) / elapsed:.0f} req/s")
+    print(f"{'operation':<16}{'count':>8}{'ok':>8}{'rejected':>10}{'limited':>9}{'errors':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    groups = {}
+    for op, hot, latency, outcome in samples:
+        groups.setdefault(f"{op}{' (hot)' if hot else ''}", []).append((latency, outcome))
+    for name in sorted(groups):
+        entries = groups[name]
+        latencies = sorted(latency * 1000 for latency, outcome in entries)
+        outcomes = [outcome for latency, outcome in entries]
+        print(f"{name:<16}{len(entries):>8}{outcomes.count('ok'):>8}{outcomes.count('rejected'):>10}"
+              f"{outcomes.count('limited'):>9}{outcomes.count('error'):>8}{percentile(latencies, 0.5):>9.1f}{percentile(latencies, 0.95):>9.1f}"
+              f"{percentile(latencies, 0.99):>9.1f}{latencies[-1]:>9.1f}")
+
+def check_consistency(directory, samples):
+    """Problems found in the data files after the run (empty list when consistent)"""
+    books = {}
+    with open(os.path.join(directory, "library_books.txt"), encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split(",")
+            if len(parts) == 7:
+                books[parts[0]] = tuple(int(value) for value in parts[4:])
+    open_loans, open_pairs = {}, set()
+    problems = []
+    with open(os.path.join(directory, "library_borrows.txt"), encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split("|")
+            if len(parts) >= 4 and parts[3] == "None":
+                open_loans[parts[1]] = open_loans.get(parts[1], 0) + 1
+                if (parts[0], parts[1]) in open_pairs:
+                    problems.append(f"{parts[0]} holds two open loans of {parts[1]}")
+                open_pairs.add((parts[0], parts[1]))
+    for book_id, (total, available, borrowed) in books.items():
+        if available + borrowed != total:
+            problems.append(f"{book_id}: Available {available} + Borrowed {borrowed} != TotalCopies {total}")
+        if available < 0:
+            problems.append(f"{book_id}: Available is negative ({available})")
+        if borrowed != open_loans.get(book_id, 0):
+            problems.append(f"{book_id}: Borrowed {borrowed} != {open_loans.get(book_id, 0)} open loans")
+    for book_id in open_loans.keys() - books.keys():
+        problems.append(f"{book_id}: open loans for a book that does not exist")
+    borrowed_ok = sum(1 for op, hot, latency, outcome in samples if op == "borrow" and outcome == "ok")
+    returned_ok = sum(1 for op, hot, latency, outcome in samples if op == "return" and outcome == "ok")
+    if borrowed_ok - returned_ok != sum(open_loans.values()):
+        problems.append(f"clients saw {borrowed_ok} borrows and {returned_ok} returns succeed, "
+                        f"but {sum(open_loans.values())} loans are open")
+    return problems
+
+def run_load(args, mode):
+    """One run against fresh data and servers; returns (samples, elapsed, problems)"""
+    directory = tempfile.mkdtemp(prefix="library-loadtest-")
+    patrons = args.client_processes * args.threads
+    write_dataset(directory, args.books, args.hot_copies, patrons)
+    print(f"📁 Data in {directory}: {args.books + 1} books, {patrons} patrons")
+    servers = start_servers(directory, args.servers, mode, args.workers, args.server_threads, args.rate_limits)
+    ports = [port for process, port in servers]
+    print(f"🌐 {args.servers} {mode} app server(s) on port(s) {', '.join(map(str, ports))}")
+
+    samples = []
+    try:
+        options = {
+            "threads": args.threads,
+            "books": args.books,
+            "hot_fraction": args.hot_fraction,
+            "read_fraction": args.read_fraction,
+            "max_held": args.max_held,
+            "deadline": time.monotonic() + args.duration,
+        }
+        print(f"🚀 {patrons} patrons for {args.duration:g}s...")
+        started = time.monotonic()
+        with multiprocessing.Pool(args.client_processes) as pool:
+            for results in pool.imap_unordered(run_client, [(i, ports, options) for i in range(args.client_processes)]):
+                samples.extend(results)
+        elapsed = time.monotonic() - started
+    finally:
+        stop_servers(servers)
+
+    report(samples, elapsed)
+    problems = check_consistency(directory, samples)
+    if problems:
+        print(f"\n❌ {len(problems)} consistency problem(s):")
+        for problem in problems[:50]:
+            print(f"   - {problem}")
+    else:
+        print("\n✅ Counts consistent: Available + Borrowed == TotalCopies and Borrowed == open loans")
+    if args.keep or problems:
+        print(f"📁 Data kept in {directory}")
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+    return samples, elapsed, problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load (default 10)")
+    parser.add_argument("--client-processes", type=int, default=2, help="client processes (default 2)")
+    parser.add_argument("--threads", type=int, default=8, help="patrons (threads) per client process (default 8)")
+    parser.add_argument("--servers", type=int, default=1, help="app processes sharing the data files (default 1)")
+    parser.add_argument("--server-mode", choices=("threaded", "forking", "production"), default="threaded",
+                        help="werkzeug dev server model, or the app's `serve` production server")
+    parser.add_argument("--workers", type=int, default=2, help="production server: worker processes (default 2)")
+    parser.add_argument("--server-threads", type=int, default=8,
+                        help="production server: threads per worker (default 8)")
+    parser.add_argument("--compare", action="store_true",
+                        help="run the threaded dev server, then the production server, and compare req/s")
+    parser.add_argument("--books", type=int, default=200, help="catalogue size (default 200)")
+    parser.add_argument("--hot-fraction", type=float, default=0.3,
+                        help="share of borrows aimed at the single hot book (default 0.3)")
+    parser.add_argument("--hot-copies", type=int, default=3, help="copies of the hot book (default 3)")
+    parser.add_argument("--max-held", type=int, default=3, help="books a patron holds before returning (default 3)")
+    parser.add_argument("--read-fraction", type=float, default=0.0,
+                        help="share of requests that browse /books instead of borrowing (default 0)")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="leave the app's rate limits on (off by default: every patron shares one IP)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data directory")
+    args = parser.parse_args()
+
+    if not args.compare:
+        samples, elapsed, problems = run_load(args, args.server_mode)
+        return 1 if problems else 0
+
+    runs = {}
+    for mode in ("threaded", "production"):
+        print(f"\n===== {mode} =====")
+        runs[mode] = run_load(args, mode)
+    print(f"\n{'server':<28}{'req/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for mode, (samples, elapsed, problems) in runs.items():
+        latencies = sorted(latency * 1000 for op, hot, latency, outcome in samples)
+        errors = sum(1 for op, hot, latency, outcome in samples if outcome == "error")
+        label = "dev (werkzeug threaded)" if mode == "threaded" else \
+            f"production ({args.workers}w x {args.server_threads}t)"
+        print(f"{label:<28}{len(samples) / elapsed:>8.0f}{percentile(latencies, 0.5):>9.1f}"
+              f"{percentile(latencies, 0.99):>9.1f}{errors:>8}")
+    dev, production = (len(runs[m][0]) / runs[m][1] for m in ("threaded", "production"))
+    print(f"\n⚡ production / dev = {production / dev:.2f}x")
+    return 1 if any(problems for samples, elapsed, problems in runs.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Each test runs the app against its own small copy of the data files.
+
+librareay_webapp keeps its data files relative to the working directory and
+reads its settings and opens the dataset version file at import, so the
+fixtures change into a temporary directory and import the module afresh.
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BOOKS = (
+    "B001,Python Programming,John Smith,2020,3,2,1\n"
+    "B002,Data Science Handbook,Emily Johnson,2019,2,2,0\n"
+    "B003,Web Development Basics,Mike Brown,2021,1,1,0\n"
+)
+USERS = (
+    "admin|admin123|admin\n"
+    "john|john123|member\n"
+    "sarah|sarah123|member\n"
+)
+BORROWS = "john|B001|2025-11-03 10:00:00|None\n"
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    for filename, contents in (("library_books.txt", BOOKS), ("library_users.txt", USERS),
+                               ("library_borrows.txt", BORROWS)):
+        (tmp_path / filename).write_text(contents, encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def load_webapp(data_dir, monkeypatch):
+    """load_webapp(rate_limits=False) imports a fresh librareay_webapp in data_dir"""
+    def load(rate_limits=False):
+        monkeypatch.setenv("LIBRARY_RATE_LIMITS", "on" if rate_limits else "off")
+        monkeypatch.delitem(sys.modules, "librareay_webapp", raising=False)
+        return importlib.import_module("librareay_webapp")
+    return load
+
+@pytest.fixture
+def webapp(load_webapp):
+    return load_webapp()
+
+def log_in(client, username, role):
+    with client.session_transaction() as session:
+        session['username'] = username
+        session['role'] = role
+    return client
+
+@pytest.fixture
+def admin(webapp):
+    return log_in(webapp.app.test_client(), 'admin', 'admin')
+
+@pytest.fixture
+def member(webapp):
+    return log_in(webapp.app.test_client(), 'john', 'member')
+
+def data_files(directory):
+    """{file name: bytes} of the data files, to check nothing was written"""
+    return {name: (directory / name).read_bytes() for name in sorted(os.listdir(directory))
+            if name.startswith("library_") and name.endswith(".txt")}
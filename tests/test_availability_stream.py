@@ -0,0 +1,16 @@
+def test_stream_refused_when_full(member, webapp):
+    webapp.availability_feed.max_subscribers = 1
+
+    first = member.get('/books/stream', buffered=False)
+    assert first.status_code == 200
+
+    refused = member.get('/books/stream')
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == str(webapp.STREAM_REFUSED_RETRY_MS // 1000)
+    assert refused.get_data(as_text=True).startswith(f"retry: {webapp.STREAM_REFUSED_RETRY_MS}")
+
+    # Closing the first stream gives its slot back
+    first.close()
+    second = member.get('/books/stream', buffered=False)
+    assert second.status_code == 200
+    second.close()
@@ -0,0 +1,49 @@
+from conftest import data_files
+
+def test_batch_borrow_applies_every_item(admin, webapp):
+    response = admin.post('/checkout', json={'action': 'borrow', 'book_ids': ['B002', 'B003'], 'username': 'sarah'})
+
+    assert response.status_code == 200
+    assert response.json['applied']
+    assert [result['ok'] for result in response.json['results']] == [True, True]
+    books = webapp.get_books()
+    assert (books['B002']['Borrowed'], books['B003']['Available']) == (1, 0)
+
+def test_batch_borrow_is_all_or_nothing(admin, webapp, data_dir):
+    before = data_files(data_dir)
+
+    # The unknown book fails, so the other two must not be applied either
+    response = admin.post('/checkout', json={'book_ids': ['B002', 'B999', 'B003'], 'username': 'sarah'})
+
+    assert response.status_code == 200
+    assert not response.json['applied']
+    assert [result['message'] for result in response.json['results']] == [
+        'Not applied: other items failed', 'Book not found', 'Not applied: other items failed']
+    assert data_files(data_dir) == before
+    assert webapp.get_books()['B002']['Borrowed'] == 0
+
+def test_batch_borrow_write_failure_partway(admin, webapp, data_dir, monkeypatch):
+    before = data_files(data_dir)
+
+    def fail(data, staged):
+        raise OSError("No space left on device")
+    monkeypatch.setitem(webapp.DATASET_WRITERS, "books", fail)
+    response = admin.post('/checkout', json={'book_ids': ['B002', 'B003'], 'username': 'sarah'})
+
+    assert not response.json['applied']
+    assert {result['message'] for result in response.json['results']} == {'Error saving data'}
+    assert data_files(data_dir) == before
+    assert not webapp.get_borrows().get('sarah')
+
+def test_batch_return(member, webapp):
+    response = member.post('/checkout', json={'action': 'return', 'book_ids': ['B001']})
+
+    assert response.json['applied']
+    assert webapp.get_books()['B001']['Borrowed'] == 0
+
+def test_checkout_rejects_malformed_json(member):
+    for body in ('{"book_ids": [', '["B001"]', '{"book_ids": "B001"}', '{"book_ids": [{"id": "B001"}]}',
+                 '{"book_ids": ["B001"], "action": ["borrow"]}'):
+        response = member.post('/checkout', data=body, content_type='application/json')
+        assert response.status_code == 400, body
+        assert 'error' in response.json
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from conftest import log_in
+
+@pytest.fixture
+def branches(admin, webapp, data_dir):
+    admin.post('/admin/branches', data={'branch': 'north'})
+    admin.post('/admin/branches', data={'branch': 'south'})
+    admin.post('/admin/branches/transfer', data={'book_id': 'B002', 'from_branch': 'north',
+                                                 'to_branch': 'south', 'copies': 1})
+    return data_dir / "library_branches"
+
+def shard_files(directory):
+    return {name: os.stat(directory / name).st_ino for name in os.listdir(directory)}
+
+def stock(client, book_id):
+    return {entry['branch']: (entry['total'], entry['available'], entry['borrowed'])
+            for entry in client.get(f'/api/books/{book_id}/availability').json['branches']}
+
+def test_first_branch_takes_every_copy_and_loan(branches, admin, webapp):
+    assert (branches / "north.txt").read_text(encoding="utf-8").splitlines()[0] == "B001,3"
+    assert webapp.get_borrows()['john'][0]['branch'] == 'north'
+    assert stock(admin, 'B001') == {'north': (3, 2, 1)}
+
+def test_borrow_and_return_write_no_shard(branches, member, admin):
+    before = shard_files(branches)
+
+    member.get('/borrow/B002?branch=south')
+    assert stock(admin, 'B002') == {'north': (1, 1, 0), 'south': (1, 0, 1)}
+    member.get('/return/B002?branch=south')
+    assert stock(admin, 'B002') == {'north': (1, 1, 0), 'south': (1, 1, 0)}
+
+    assert shard_files(branches) == before
+
+def test_copy_handed_in_elsewhere_moves_branch(branches, member, admin):
+    member.get('/borrow/B002?branch=south')
+    member.get('/return/B002?branch=north')
+
+    assert stock(admin, 'B002') == {'north': (2, 2, 0)}
+    assert "B002" not in (branches / "south.txt").read_text(encoding="utf-8")
+
+def test_borrow_at_branch_without_copies_on_shelf(branches, member, webapp):
+    member.get('/borrow/B002?branch=south')
+    log_in(webapp.app.test_client(), 'sarah', 'member').get('/borrow/B002?branch=south')
+
+    assert 'sarah' not in webapp.get_borrows()
@@ -0,0 +1,33 @@
+from conftest import data_files
+
+def test_bulk_add_copies(admin, webapp):
+    response = admin.post('/admin/books/bulk', json={'action': 'add_copies', 'copies': 2, 'book_ids': ['B002', 'B003']})
+
+    assert response.status_code == 200
+    assert response.json['applied']
+    books = webapp.get_books()
+    assert (books['B002']['TotalCopies'], books['B003']['Available']) == (4, 3)
+
+def test_bulk_set_copies_is_all_or_nothing(admin, webapp, data_dir):
+    before = data_files(data_dir)
+
+    # B001 has a copy out, so it can't go down to none
+    response = admin.post('/admin/books/bulk', json={'action': 'set_copies', 'copies': 0, 'book_ids': ['B002', 'B001']})
+
+    assert not response.json['applied']
+    assert [result['ok'] for result in response.json['results']] == [False, False]
+    assert data_files(data_dir) == before
+
+def test_bulk_edit_rejects_malformed_json(admin):
+    for body in ('{"action": "delete", "book_ids": [', '"B001"', '{"action": "delete", "book_ids": {"B001": 1}}',
+                 '{"action": "add_copies", "copies": [2], "book_ids": ["B001"]}',
+                 '{"action": "edit", "title": {"x": 1}, "book_ids": ["B001"]}'):
+        response = admin.post('/admin/books/bulk', data=body, content_type='application/json')
+        assert response.status_code == 400, body
+        assert 'error' in response.json
+
+def test_bulk_edit_rejects_invalid_values(admin):
+    response = admin.post('/admin/books/bulk', json={'action': 'add_copies', 'copies': 'many', 'book_ids': ['B001']})
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid number for copies!'
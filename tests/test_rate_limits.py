@@ -0,0 +1,69 @@
+import pytest
+
+from conftest import log_in
+
+@pytest.fixture
+def limited(load_webapp, monkeypatch):
+    monkeypatch.setenv("LIBRARY_PASSWORD_ITERATIONS", "1000")
+    return load_webapp(rate_limits=True)
+
+def register(client, username, address='10.0.0.1'):
+    return client.post('/register', data={'username': username, 'password': 'secret1', 'confirm_password': 'secret1'},
+                       environ_base={'REMOTE_ADDR': address})
+
+def test_register_burst_gets_429_with_retry_after(limited):
+    client = limited.app.test_client()
+    burst = limited.ROUTE_RATE_LIMITS['register'].burst
+
+    assert all(register(client, f"reader{i}").status_code != 429 for i in range(burst))
+    response = register(client, "one_too_many")
+
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert "one_too_many" not in limited.get_users()
+    # Another address has its own bucket
+    assert register(client, "elsewhere", '10.0.0.2').status_code != 429
+
+def test_json_request_gets_json_429(limited):
+    client = log_in(limited.app.test_client(), 'john', 'member')
+    limit = limited.ROUTE_RATE_LIMITS['batch_checkout']
+
+    responses = [client.post('/checkout', json={'book_ids': []}) for _ in range(limit.burst + 1)]
+
+    assert responses[-1].status_code == 429
+    assert responses[-1].json['retry_after'] == int(responses[-1].headers['Retry-After'])
+
+def test_wrong_passwords_never_lock_out_the_owner(limited):
+    client = limited.app.test_client()
+    guesses = limited.ROUTE_RATE_LIMITS['failed_login'].burst + 1
+    codes = [client.post('/login', data={'username': 'john', 'password': 'guess'},
+                         environ_base={'REMOTE_ADDR': f'10.0.1.{i}'}).status_code for i in range(guesses)]
+
+    assert codes[-1] == 429
+    response = client.post('/login', data={'username': 'john', 'password': 'john123'},
+                           environ_base={'REMOTE_ADDR': '10.0.2.1'})
+    assert response.status_code == 302
+
+def test_logins_do_not_use_write_slots(limited):
+    for _ in range(limited.MAX_CONCURRENT_WRITES):
+        assert limited.rate_limiter.enter('writes', 'test')
+    client = limited.app.test_client()
+
+    response = client.post('/login', data={'username': 'john', 'password': 'john123'})
+    assert response.status_code == 302
+    assert client.get('/borrow/B002').status_code == 429
+
+    for _ in range(limited.MAX_CONCURRENT_LOGINS):
+        assert limited.rate_limiter.enter('logins', 'test')
+    response = client.post('/login', data={'username': 'sarah', 'password': 'sarah123'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+
+def test_proxy_hops_key_on_forwarded_address(load_webapp, monkeypatch):
+    monkeypatch.setenv("LIBRARY_PROXY_HOPS", "1")
+    webapp = load_webapp(rate_limits=True)
+    client = webapp.app.test_client()
+
+    client.post('/register', data={'username': 'x'}, headers={'X-Forwarded-For': '203.0.113.7'})
+
+    assert ('ip', '203.0.113.7', 'register') in webapp.rate_limiter.buckets
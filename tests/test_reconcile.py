@@ -0,0 +1,30 @@
+def test_repair_closes_orphan_loan(load_webapp, data_dir):
+    with open(data_dir / "library_borrows.txt", "a", encoding="utf-8") as f:
+        f.write("sarah|B404|2025-11-04 09:00:00|None\n")
+    webapp = load_webapp()
+
+    mode, found, repairs = webapp.reconcile(full=True, repair=True)
+
+    assert mode == "full"
+    assert [(entry['book_id'], entry['kind']) for entry in found] == [('B404', 'orphan_loans')]
+    assert repairs == ["B404: closed sarah's open loan of a missing book"]
+    assert all(loan['return_date'] for loan in webapp.get_borrows()['sarah'])
+
+    mode, found, repairs = webapp.reconcile()
+    assert mode.startswith("incremental")
+    assert (found, repairs) == ([], [])
+    assert webapp.reconcile(full=True)[1:] == ([], [])
+
+def test_incremental_run_checks_changed_books(webapp):
+    webapp.reconcile(full=True)
+
+    with webapp.library_transaction() as txn:
+        # A count change that no loan explains
+        txn.update_book('B002', Available=1, Borrowed=1)
+        assert txn.commit()
+
+    mode, found, repairs = webapp.reconcile(repair=True)
+    assert mode == "incremental (1 changed book(s))"
+    assert [entry['book_id'] for entry in found] == ['B002']
+    assert webapp.get_books()['B002']['Borrowed'] == 0
+    assert webapp.reconcile()[1:] == ([], [])
@@ -0,0 +1,33 @@
+import os
+import stat
+
+import pytest
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="POSIX file modes")
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def test_save_keeps_data_file_permissions(member, data_dir):
+    for filename in ("library_books.txt", "library_borrows.txt"):
+        os.chmod(data_dir / filename, 0o640)
+
+    assert member.get('/borrow/B002').status_code == 302
+
+    assert "john|B002|" in (data_dir / "library_borrows.txt").read_text(encoding="utf-8")
+    assert mode(data_dir / "library_books.txt") == 0o640
+    assert mode(data_dir / "library_borrows.txt") == 0o640
+
+def test_new_file_gets_umask_default(webapp, data_dir):
+    webapp.atomic_write_lines("library_new.txt", ["x\n"])
+
+    assert mode(data_dir / "library_new.txt") == 0o666 & ~webapp._UMASK
+
+def test_failed_stage_leaves_no_temp_file(webapp, data_dir):
+    with pytest.raises(RuntimeError):
+        with webapp.staged_files() as staged:
+            staged.write("library_books.txt", ["B009,Title,Author,2024,1,1,0\n"])
+            raise RuntimeError("stop")
+
+    assert not [name for name in os.listdir(data_dir) if name.startswith(".tmp-")]
+    assert "B009" not in (data_dir / "library_books.txt").read_text(encoding="utf-8")
@@ -0,0 +1,33 @@
+import os
+
+from conftest import data_files
+
+def test_commit_writes_every_dataset(webapp, data_dir):
+    with webapp.library_transaction() as txn:
+        webapp.borrow_book_for_user('sarah', 'B002')
+        txn.update_book('B002', Available=1, Borrowed=1)
+        assert txn.commit()
+
+    assert "sarah|B002|" in (data_dir / "library_borrows.txt").read_text(encoding="utf-8")
+    assert "B002,Data Science Handbook,Emily Johnson,2019,2,1,1" in \
+        (data_dir / "library_books.txt").read_text(encoding="utf-8")
+    assert webapp.get_books()['B002']['Borrowed'] == 1
+
+def test_failed_write_changes_nothing(webapp, data_dir, monkeypatch):
+    webapp.refresh_snapshot()
+    before_files = data_files(data_dir)
+    before_versions = dict(webapp.current_snapshot().versions)
+
+    def fail(data, staged):
+        raise OSError("No space left on device")
+    # borrows is staged before books, so this fails after one file was written out
+    monkeypatch.setitem(webapp.DATASET_WRITERS, "books", fail)
+    with webapp.library_transaction() as txn:
+        webapp.borrow_book_for_user('sarah', 'B002')
+        txn.update_book('B002', Available=1, Borrowed=1)
+        assert not txn.commit()
+
+    assert data_files(data_dir) == before_files
+    assert dict(webapp.current_snapshot().versions) == before_versions
+    assert webapp.get_books()['B002']['Borrowed'] == 0
+    assert not [name for name in os.listdir(data_dir) if name.startswith(".tmp-")]
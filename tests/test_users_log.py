@@ -0,0 +1,47 @@
+def test_last_line_without_newline_is_loaded(load_webapp, data_dir):
+    (data_dir / "library_users.txt").write_bytes(b"admin|admin123|admin\nbob|pw1234|member")
+    webapp = load_webapp()
+
+    assert sorted(webapp.load_users()) == ['admin', 'bob']
+
+def test_single_unterminated_account_is_not_replaced(load_webapp, data_dir):
+    (data_dir / "library_users.txt").write_bytes(b"solo|pw1234|member")
+    webapp = load_webapp()
+
+    assert sorted(webapp.load_users()) == ['solo']
+    assert (data_dir / "library_users.txt").read_bytes() == b"solo|pw1234|member"
+
+def test_unreadable_users_file_is_left_alone(load_webapp, data_dir):
+    (data_dir / "library_users.txt").write_bytes(b"\n  \n")
+    webapp = load_webapp()
+
+    assert webapp.load_users() == {}
+    assert (data_dir / "library_users.txt").read_bytes() == b"\n  \n"
+
+def test_missing_users_file_gets_default_admin(load_webapp, data_dir):
+    (data_dir / "library_users.txt").unlink()
+    webapp = load_webapp()
+
+    assert sorted(webapp.load_users()) == ['admin']
+    assert (data_dir / "library_users.txt").exists()
+
+def test_partial_append_is_read_once_the_size_settles(webapp, data_dir):
+    assert sorted(webapp.load_users()) == ['admin', 'john', 'sarah']
+    with open(data_dir / "library_users.txt", "ab") as f:
+        f.write(b"carl|pw1234|member\ndan|pw1234|member")
+
+    # dan's line may still be being written: left for the next read
+    assert sorted(webapp.load_users()) == ['admin', 'carl', 'john', 'sarah']
+    assert sorted(webapp.load_users()) == ['admin', 'carl', 'dan', 'john', 'sarah']
+
+def test_append_after_unterminated_line_keeps_records_apart(load_webapp, data_dir):
+    (data_dir / "library_users.txt").write_bytes(b"admin|admin123|admin")
+    webapp = load_webapp()
+    users = dict(webapp.load_users())
+    users['eve'] = webapp.freeze_record({'password': 'pw1234', 'role': 'member'})
+
+    with webapp.staged_files() as staged:
+        webapp.append_users(users, staged)
+
+    assert (data_dir / "library_users.txt").read_text(encoding="utf-8").splitlines() == [
+        "admin|admin123|admin", "eve|pw1234|member"]